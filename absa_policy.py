@@ -0,0 +1,60 @@
+#! usr/bin/python3
+
+"""Selection of the arm kept at an ABSA when several BSMs of outer qubits succeed.
+
+The inner qubits of the kept arm are measured in the X basis and all the others in the Z basis,
+so the choice decides which trees have to be decodable:
+    FIRST_SUCCESS       the first arm with a successful BSM (the original protocol)
+    MAX_DECODABILITY    the first successful arm for which every inner qubit of the hop can be decoded given the loss pattern
+    MIN_EXPECTED_ERROR  among those, the arm whose logical results XOR the fewest physical results,
+                        each of which may be flipped by a channel error
+"""
+
+from enum import Enum
+
+import lookup_tree_code_helper
+from rgs_config import Node
+
+ArmSelectionPolicy = Enum("ArmSelectionPolicy", ["FIRST_SUCCESS", "MAX_DECODABILITY", "MIN_EXPECTED_ERROR"])
+
+
+def select_bsm_arm(policy: ArmSelectionPolicy, bsm_successes: list[bool], left_roots: list[Node], right_roots: list[Node]) -> int:
+    """return the index of the arm to keep (-1 if no BSM succeeded)
+    `left_roots` and `right_roots` are the trees of both sides of the ABSA with their loss pattern (`is_lost`) already known"""
+    candidates = [i for i, success in enumerate(bsm_successes) if success]
+    if len(candidates) == 0:
+        return -1
+    if policy == ArmSelectionPolicy.FIRST_SUCCESS or len(candidates) == 1:
+        return candidates[0]
+
+    # the weight of a logical result is the number of physical results in its parity (None if it cannot be decoded)
+    z_weights = [
+        (lookup_tree_code_helper.parity_weight_z(left), lookup_tree_code_helper.parity_weight_z(right))
+        for left, right in zip(left_roots, right_roots)
+    ]
+    undecodable_z_arms = [i for i, (left, right) in enumerate(z_weights) if left is None or right is None]
+    if len(undecodable_z_arms) > 1:
+        # at least one arm measured in Z cannot be decoded whatever we choose
+        return candidates[0]
+
+    best_arm = -1
+    best_weight = None
+    total_z_weight = sum(left + right for left, right in z_weights if left is not None and right is not None)
+    for i in candidates:
+        if len(undecodable_z_arms) == 1 and undecodable_z_arms[0] != i:
+            continue
+        x_weight_left = lookup_tree_code_helper.parity_weight_x(left_roots[i])
+        x_weight_right = lookup_tree_code_helper.parity_weight_x(right_roots[i])
+        if x_weight_left is None or x_weight_right is None:
+            continue
+        if policy == ArmSelectionPolicy.MAX_DECODABILITY:
+            return i
+        # the Z results of arm i are not needed when it is kept
+        weight = x_weight_left + x_weight_right + total_z_weight
+        if i not in undecodable_z_arms:
+            weight -= sum(z_weights[i])  # type: ignore
+        if best_weight is None or weight < best_weight:
+            best_arm, best_weight = i, weight
+
+    # no choice makes the hop decodable, keep the original behaviour
+    return best_arm if best_arm != -1 else candidates[0]
@@ -0,0 +1,156 @@
+#! usr/bin/python3
+
+"""Control-variate estimation of the success and error rates.
+
+The theoretical model gives the exact probabilities of the component events of a hop under photon loss:
+    BSM        some arm of the hop has a successful BSM                    `prob_bell(m, p)`
+    X          the logical X of a tree can be decoded from its loss pattern  `prob_logical_measure_x(bv, p)`
+    Z          the logical Z of a tree can be decoded from its loss pattern  `prob_logical_measure_z(bv, p)`
+For every shot, all the hops are presampled (so the trial does not stop the sampling at the first failed hop) and the
+control indicators are, per hop, the BSM indicator and the fractions of the 2m trees whose X and Z can be decoded.
+Their means are known, so the sample means of the success and error indicators are adjusted by the regression on the
+controls: y_cv = mean(y) - beta (mean(c) - E[c]) with beta estimated from the same shots.
+The estimators only keep sums, so runs (e.g., from several processes) can be merged.
+"""
+
+import numpy as np
+
+from lookup_tree_code_helper import is_decodable_x, is_decodable_z
+from rgs_config import RgsConfig
+from rgs_theoretical_model import prob_bell, prob_logical_measure_x, prob_logical_measure_z
+
+
+def component_indicators(conf: RgsConfig) -> np.ndarray:
+    """(BSM, fraction of X-decodable trees, fraction of Z-decodable trees) of every hop of a trial with presampled hops"""
+    indicators = np.zeros(3 * conf.number_of_hops)
+    for hop_index in range(conf.number_of_hops):
+        outer_losses = conf.presampled_outer_losses[hop_index]
+        bsm_coins = conf.presampled_bsm_coins[hop_index]
+        if outer_losses is None or bsm_coins is None:
+            raise RuntimeError(f"hop {hop_index} was not presampled")
+        roots = conf.measurement_trees[2 * hop_index] + conf.measurement_trees[2 * hop_index + 1]
+        indicators[3 * hop_index] = any(
+            not left_lost and not right_lost and coin for (left_lost, right_lost), coin in zip(outer_losses, bsm_coins)
+        )
+        indicators[3 * hop_index + 1] = np.mean([is_decodable_x(root) for root in roots])
+        indicators[3 * hop_index + 2] = np.mean([is_decodable_z(root) for root in roots])
+    return indicators
+
+
+def component_means(conf: RgsConfig) -> np.ndarray:
+    """known means of `component_indicators`"""
+    p = 1 - conf.loss_probability
+    means = [prob_bell(conf.m, p), prob_logical_measure_x(conf.bv, p), prob_logical_measure_z(conf.bv, p)]
+    return np.tile(means, conf.number_of_hops)
+
+
+class ControlVariateEstimate:
+    """Streaming control-variate estimators of the success probability, the probability of a successful trial with a wrong
+    Bell pair and the error rate of the delivered pairs"""
+
+    def __init__(self):
+        self.shots = 0
+        self.means: np.ndarray | None = None
+        # sums of the controls c and of the responses y = (success, error)
+        self.control_sum: np.ndarray | None = None
+        self.control_squared_sum: np.ndarray | None = None
+        self.response_sum = np.zeros(2)
+        self.response_squared_sum = np.zeros((2, 2))
+        self.response_control_sum: np.ndarray | None = None
+
+    def record(self, controls: np.ndarray, means: np.ndarray, is_successful: bool, is_correct: bool | None):
+        if self.means is None:
+            k = len(means)
+            self.means = np.array(means, dtype=float)
+            self.control_sum = np.zeros(k)
+            self.control_squared_sum = np.zeros((k, k))
+            self.response_control_sum = np.zeros((2, k))
+        elif not np.array_equal(self.means, means):
+            raise ValueError("the control means differ from the ones of the recorded shots")
+        response = np.array([is_successful, is_successful and not is_correct], dtype=float)
+        self.shots += 1
+        self.control_sum += controls
+        self.control_squared_sum += np.outer(controls, controls)
+        self.response_sum += response
+        self.response_squared_sum += np.outer(response, response)
+        self.response_control_sum += np.outer(response, controls)
+
+    def record_trial(self, conf: RgsConfig, is_successful: bool, is_correct: bool | None):
+        self.record(component_indicators(conf), component_means(conf), is_successful, is_correct)
+
+    def merge(self, other: "ControlVariateEstimate"):
+        """combine the estimators of another run with the same parameters into this one"""
+        if other.shots == 0:
+            return
+        if self.shots == 0:
+            for name, value in vars(other).items():
+                setattr(self, name, value.copy() if isinstance(value, np.ndarray) else value)
+            return
+        if not np.array_equal(self.means, other.means):
+            raise ValueError("the control means differ from the ones of the recorded shots")
+        sums = ["control_sum", "control_squared_sum", "response_sum", "response_squared_sum", "response_control_sum"]
+        for name in ["shots"] + sums:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def __statistics(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """(plain means of y, adjusted means of y, covariance of y, residual covariance of y given c)"""
+        n = self.shots
+        response_mean = self.response_sum / n
+        control_mean = self.control_sum / n  # type: ignore
+        response_covariance = (self.response_squared_sum - n * np.outer(response_mean, response_mean)) / (n - 1)
+        control_covariance = (self.control_squared_sum - n * np.outer(control_mean, control_mean)) / (n - 1)  # type: ignore
+        cross_covariance = (self.response_control_sum - n * np.outer(response_mean, control_mean)) / (n - 1)  # type: ignore
+        # a control without variance (e.g., no loss) gets no coefficient
+        beta = cross_covariance @ np.linalg.pinv(control_covariance)
+        adjusted_mean = response_mean - beta @ (control_mean - self.means)
+        # residual covariance, with the degrees of freedom taken by the coefficients
+        k = np.linalg.matrix_rank(control_covariance) if n > 1 else 0
+        residual_covariance = (response_covariance - beta @ cross_covariance.T) * (n - 1) / max(n - 1 - k, 1)
+        return response_mean, adjusted_mean, response_covariance, residual_covariance
+
+    def success_probability(self) -> tuple[float, float]:
+        """(estimate, standard error) of the probability of a successful trial"""
+        if self.shots < 2:
+            return np.nan, np.nan
+        _, adjusted_mean, _, residual_covariance = self.__statistics()
+        return float(adjusted_mean[0]), float(np.sqrt(max(residual_covariance[0, 0], 0) / self.shots))
+
+    def logical_error_probability(self) -> tuple[float, float]:
+        """(estimate, standard error) of the probability of a successful trial delivering a wrong Bell pair"""
+        if self.shots < 2:
+            return np.nan, np.nan
+        _, adjusted_mean, _, residual_covariance = self.__statistics()
+        return float(adjusted_mean[1]), float(np.sqrt(max(residual_covariance[1, 1], 0) / self.shots))
+
+    def conditional_error_rate(self) -> tuple[float, float]:
+        """(estimate, standard error) of the logical error rate of the delivered Bell pairs
+        (ratio of the adjusted means, delta method)"""
+        if self.shots < 2:
+            return np.nan, np.nan
+        _, adjusted_mean, _, residual_covariance = self.__statistics()
+        if adjusted_mean[0] <= 0:
+            return np.nan, np.nan
+        rate = adjusted_mean[1] / adjusted_mean[0]
+        gradient = np.array([-rate, 1]) / adjusted_mean[0]
+        return float(rate), float(np.sqrt(max(gradient @ residual_covariance @ gradient, 0) / self.shots))
+
+    def variance_reduction(self) -> float:
+        """ratio of the variances of the plain and adjusted success estimators, i.e., the factor saved in shots"""
+        if self.shots < 2:
+            return np.nan
+        _, _, response_covariance, residual_covariance = self.__statistics()
+        return float(response_covariance[0, 0] / residual_covariance[0, 0]) if residual_covariance[0, 0] > 0 else np.inf
+
+    def summary(self) -> str:
+        if self.shots < 2:
+            return f"control variates: {self.shots} shot(s), not enough for an estimate"
+        plain_mean, _, response_covariance, _ = self.__statistics()
+        success, success_error = self.success_probability()
+        error, error_error = self.logical_error_probability()
+        rate, rate_error = self.conditional_error_rate()
+        return (
+            f"success probability = {success:.6g} +/- {success_error:.3g} "
+            f"(plain {plain_mean[0]:.6g} +/- {np.sqrt(response_covariance[0, 0] / self.shots):.3g}, "
+            f"variance reduced {self.variance_reduction():.3g}x); logical error probability = {error:.6g} +/- {error_error:.3g}; "
+            f"error rate of delivered pairs = {rate:.6g} +/- {rate_error:.3g} ({self.shots} shots)"
+        )
@@ -0,0 +1,234 @@
+#! usr/bin/python3
+
+"""Statistical differential testing of the simulation engines.
+
+The same protocol is implemented by several engines:
+    full_state      `protocol-steps.experiment_setup` on the full-state `rgs.py` (loss only, decoded as `tree_code_helper`)
+    sequential      `rgs_engine`, hop by hop
+    streaming       `rgs_engine` with the inner qubits decoded while they are emitted (`streaming_decoder`)
+    hop_parallel    `hop_parallel`, chains composed from independently simulated hops
+The decoder is not part of an engine: both engines decode with the same decoder module, so that only the engines are compared
+(the full-state engine only takes the decoders making the decisions of `tree_code_helper`).
+Two engines are run on the same parameter grid and, for every grid point,
+    - the success rates are compared with a chi-square test of the 2x2 table (1 degree of freedom),
+    - the correctness rates among the successful trials are compared the same way,
+    - the success rate of each engine is compared against `prob_rgs_trial` with an exact binomial test
+      and, without depolarizing errors, every successful trial must give the correct Bell pair (loss only).
+The p-values are Bonferroni corrected over all the tests of the grid and a significant divergence raises a RuntimeError.
+The stim simulator of the full-state engine is not seeded, so its runs are not reproducible (the tests stay valid).
+"""
+
+import contextlib
+import importlib.util
+import io
+import math
+import os
+import random
+from types import ModuleType
+
+import numpy as np
+
+import tree_code_helper
+from hop_parallel import hop_parallel_experiment_run
+from rgs_engine import rgs_trial_experiment_run
+from rgs_theoretical_model import prob_rgs_trial
+
+# decoders making the same decisions as the decoding of the full-state engine
+FULL_STATE_DECODERS = ["tree_code_helper", "lookup_tree_code_helper"]
+
+__protocol_steps = None
+
+
+def helper_load_protocol_steps():
+    """`protocol-steps.py` is a script (not importable by name), it is loaded once from the source file"""
+    global __protocol_steps
+    if __protocol_steps is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "protocol-steps.py")
+        spec = importlib.util.spec_from_file_location("protocol_steps", path)
+        __protocol_steps = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(__protocol_steps)
+    return __protocol_steps
+
+
+def run_full_state(
+    shots: int, number_of_hops: int, m: int, bv: list[int], loss: float, depo: float, decoder: ModuleType, seed: int
+) -> tuple[int, int]:
+    if depo > 0:
+        raise ValueError("the full-state engine does not simulate the channel depolarizing error")
+    if decoder.__name__ not in FULL_STATE_DECODERS:
+        raise ValueError(
+            f"the full-state engine decodes as tree_code_helper, {decoder.__name__} is not one of {FULL_STATE_DECODERS}"
+        )
+    protocol_steps = helper_load_protocol_steps()
+    protocol_steps.rng = np.random.default_rng(seed)
+    random.seed(seed)
+    success_count = 0
+    no_error_count = 0
+    for _ in range(shots):
+        is_successful, exp_xz, exp_zx, _, _ = protocol_steps.experiment_setup(number_of_hops, m, bv, loss)
+        success_count += is_successful
+        no_error_count += is_successful and exp_xz == 1 and exp_zx == 1
+    return success_count, no_error_count
+
+
+def run_sequential(
+    shots: int, number_of_hops: int, m: int, bv: list[int], loss: float, depo: float, decoder: ModuleType, seed: int
+) -> tuple[int, int]:
+    # the majority-vote decoder reports its random choices on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        return rgs_trial_experiment_run(shots, number_of_hops, m, bv, loss, depo, decoder, seed=seed, show_output=False)
+
+
+def run_streaming(
+    shots: int, number_of_hops: int, m: int, bv: list[int], loss: float, depo: float, decoder: ModuleType, seed: int
+) -> tuple[int, int]:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return rgs_trial_experiment_run(
+            shots, number_of_hops, m, bv, loss, depo, decoder, seed=seed, streaming=True, show_output=False
+        )
+
+
+def run_hop_parallel(
+    shots: int, number_of_hops: int, m: int, bv: list[int], loss: float, depo: float, decoder: ModuleType, seed: int
+) -> tuple[int, int]:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return hop_parallel_experiment_run(shots, number_of_hops, m, bv, loss, depo, decoder, seed=seed, show_output=False)
+
+
+ENGINES = {
+    "full_state": run_full_state,
+    "sequential": run_sequential,
+    "streaming": run_streaming,
+    "hop_parallel": run_hop_parallel,
+}
+
+
+def chi_square_test(k1: int, n1: int, k2: int, n2: int) -> float:
+    """p-value of the chi-square test (1 degree of freedom) of equal proportions k1/n1 and k2/n2"""
+    if n1 == 0 or n2 == 0:
+        return 1.0
+    pooled = (k1 + k2) / (n1 + n2)
+    if pooled == 0 or pooled == 1:
+        return 1.0
+    chi_square = (k1 / n1 - k2 / n2) ** 2 / (pooled * (1 - pooled) * (1 / n1 + 1 / n2))
+    return math.erfc(math.sqrt(chi_square / 2))
+
+
+def binomial_test(k: int, n: int, p: float) -> float:
+    """p-value of the exact two-sided binomial test of k successes out of n trials with success probability p"""
+    if n == 0:
+        return 1.0
+    if p == 0 or p == 1:
+        return 1.0 if k == n * p else 0.0
+    i = np.arange(n + 1)
+    log_pmf = np.array([math.lgamma(n + 1) - math.lgamma(j + 1) - math.lgamma(n - j + 1) for j in range(n + 1)])
+    log_pmf += i * math.log(p) + (n - i) * math.log(1 - p)
+    pmf = np.exp(log_pmf)
+    return min(1.0, float(np.sum(pmf[pmf <= pmf[k] * (1 + 1e-7)])))
+
+
+class DifferentialTestReport:
+    """Counts and p-values of a differential test; `rows` holds one dict per grid point"""
+
+    def __init__(self, engine_a: str, engine_b: str, decoder: str, shots: int, significance: float):
+        self.engine_a = engine_a
+        self.engine_b = engine_b
+        self.decoder = decoder
+        self.shots = shots
+        self.significance = significance
+        self.rows: list[dict] = []
+        self.num_tests = 0
+
+    def threshold(self) -> float:
+        """Bonferroni corrected significance level of a single test"""
+        return self.significance / max(self.num_tests, 1)
+
+    def divergences(self) -> list[tuple[dict, str, float]]:
+        """(grid point, test, p-value) of the significant tests"""
+        return [
+            (row, test, p_value) for row in self.rows for test, p_value in row["p_values"].items() if p_value < self.threshold()
+        ]
+
+    def passed(self) -> bool:
+        return len(self.divergences()) == 0
+
+    def summary(self) -> str:
+        lines = [
+            f"{self.engine_a} vs {self.engine_b} ({self.decoder}): {self.shots} shots per point, "
+            f"{self.num_tests} tests at level {self.threshold():.3g}"
+        ]
+        for row in self.rows:
+            a, b = row["counts"][self.engine_a], row["counts"][self.engine_b]
+            p_values = ", ".join(f"{test} {p_value:.3g}" for test, p_value in row["p_values"].items())
+            lines.append(
+                f"    ({row['number_of_hops']}, {row['m']}, {row['bv']}, {row['loss']}, {row['depo']}) "
+                f"theoretical {row['theoretical']:.4f}: "
+                f"{self.engine_a} {a[0]}/{a[1]}, {self.engine_b} {b[0]}/{b[1]} (successful/correct); p-values {p_values}"
+            )
+        divergences = self.divergences()
+        lines.append("no significant divergence" if len(divergences) == 0 else f"{len(divergences)} significant divergence(s)")
+        return "\n".join(lines)
+
+
+def differential_test(
+    engine_a: str,
+    engine_b: str,
+    grid: list[tuple[int, int, list[int], float, float]],
+    shots: int,
+    decoder: ModuleType = tree_code_helper,
+    seed: int | None = None,
+    significance: float = 0.01,
+    compare_theory: bool = True,
+    raise_on_divergence: bool = True,
+    show_output=True,
+) -> DifferentialTestReport:
+    """Run both engines with the same `decoder` on every grid point (number_of_hops, m, bv, loss, depo) and test for divergence,
+    see the module docstring
+    Raises RuntimeError if a divergence is significant and `raise_on_divergence` is set."""
+    for engine in [engine_a, engine_b]:
+        if engine not in ENGINES:
+            raise ValueError(f'engine "{engine}" is not one of {list(ENGINES)}')
+    if engine_a == engine_b:
+        raise ValueError("the two engines must be different")
+    report = DifferentialTestReport(engine_a, engine_b, decoder.__name__, shots, significance)
+    seeds = np.random.SeedSequence(seed).generate_state(2 * len(grid), dtype=np.uint32)
+
+    for i, (number_of_hops, m, bv, loss, depo) in enumerate(grid):
+        theoretical = prob_rgs_trial(m, bv, 1 - loss, number_of_hops)
+        (a_success, a_correct), (b_success, b_correct) = [
+            ENGINES[engine](shots, number_of_hops, m, bv, loss, depo, decoder, int(seeds[2 * i + j]))
+            for j, engine in enumerate([engine_a, engine_b])
+        ]
+        p_values = {
+            "success": chi_square_test(a_success, shots, b_success, shots),
+            "correctness": chi_square_test(a_correct, a_success, b_correct, b_success),
+        }
+        if compare_theory:
+            for engine, success, correct in [(engine_a, a_success, a_correct), (engine_b, b_success, b_correct)]:
+                p_values[f"{engine} success vs theory"] = binomial_test(success, shots, theoretical)
+                if depo == 0:
+                    p_values[f"{engine} correctness vs theory"] = binomial_test(correct, success, 1)
+        report.num_tests += len(p_values)
+        report.rows.append(
+            {
+                "number_of_hops": number_of_hops,
+                "m": m,
+                "bv": bv,
+                "loss": loss,
+                "depo": depo,
+                "theoretical": theoretical,
+                "counts": {engine_a: (a_success, a_correct), engine_b: (b_success, b_correct)},
+                "p_values": p_values,
+            }
+        )
+
+    if show_output:
+        print(report.summary())
+    if raise_on_divergence and not report.passed():
+        row, test, p_value = report.divergences()[0]
+        raise RuntimeError(
+            f"{engine_a} and {engine_b} ({decoder.__name__}) diverge at "
+            f"({row['number_of_hops']}, {row['m']}, {row['bv']}, {row['loss']}, {row['depo']}): "
+            f"{test} p-value {p_value:.3g} < {report.threshold():.3g}"
+        )
+    return report
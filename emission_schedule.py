@@ -0,0 +1,136 @@
+#! usr/bin/python3
+
+"""Compilation of the inner-qubit tree of an RGS arm into an explicit emission schedule.
+
+The recursive generation of `rgs_engine.generate_and_measure_inner_qubit` uses one emitter per tree level
+and emits the photons in postorder. The same tree can also be generated with several chains of emitters,
+each chain generating a share of the first-level subtrees in parallel:
+    emitter 0 is the root emitter (coupled to the outer emitter afterwards),
+    chain c uses the emitters 1 + c * (n - 1), ..., (c + 1) * (n - 1) for the levels 1, ..., n - 1 (n = len(bv)).
+A schedule is a list of operations with their time steps:
+    EMIT      emitter -> leaf photon (CX emitter->photon, H photon), the photon is measured right away
+    TRANSFER  the state of an emitter is transferred to a photon of an inner level (CX emitter->photon,
+              H and measurement of the emitter giving the side effect of the photon, reset of the emitter to |+>)
+    CZ        between the emitters of two neighbouring levels
+Every operation occupies its emitters for one time step and is scheduled as soon as its emitters are free.
+The photon of an operation is identified by its index in the postorder traversal of the tree (the outer photon excluded),
+so the measurement results can be stored exactly as with the recursive generation.
+
+Objectives of `compile_emission_schedule`:
+    min_emitters    fewest emitters (one chain, the recursive generation)
+    min_time        fewest time steps (as many chains as first-level subtrees)
+    min_live        fewest qubits live at once: entangled emitters plus photons emitted in the same time step
+"""
+
+from enum import Enum
+
+from lookup_tree_code_helper import subtree_size
+
+ScheduleOp = Enum("ScheduleOp", ["EMIT", "TRANSFER", "CZ"])
+OBJECTIVES = ["min_emitters", "min_time", "min_live"]
+
+
+class EmissionSchedule:
+    """Time-stepped operations generating the inner-qubit tree of one arm (see module docstring)"""
+
+    def __init__(self, bv: list[int], chains: int):
+        n = len(bv)
+        if n == 1 and chains != 1:
+            raise ValueError("a tree of depth 1 is emitted by the root emitter alone")
+        if not 1 <= chains <= bv[0]:
+            raise ValueError(f"number of chains {chains} is not between 1 and {bv[0]}")
+        self.bv = bv
+        self.chains = chains
+        self.num_emitters = 1 + chains * (n - 1)
+        self.num_photons = subtree_size(tuple(bv)) - 1
+
+        # level of every photon in postorder
+        self.node_levels: list[int] = []
+        # (time step, operation, emitters, photon index in postorder or None)
+        self.ops: list[tuple[int, ScheduleOp, tuple[int, ...], int | None]] = []
+
+        program: list[tuple[ScheduleOp, tuple[int, ...], int | None]] = []
+        first_level_size = subtree_size(tuple(bv[1:]))
+
+        def __emitter(chain: int, level: int) -> int:
+            return 0 if level == 0 else 1 + chain * (n - 1) + level - 1
+
+        def __recurse(chain: int, i: int, program: list):
+            # same recursion as the engine: one call generates one child (subtree) of the emitter of level i
+            if i == n - 1:
+                program.append((ScheduleOp.EMIT, (__emitter(chain, i),), len(self.node_levels)))
+                self.node_levels.append(i)
+                return
+            for _ in range(bv[i + 1]):
+                __recurse(chain, i + 1, program)
+            program.append((ScheduleOp.CZ, (__emitter(chain, i), __emitter(chain, i + 1)), None))
+            program.append((ScheduleOp.TRANSFER, (__emitter(chain, i + 1),), len(self.node_levels)))
+            self.node_levels.append(i)
+
+        # the first-level subtrees keep their postorder positions, chain c generates the subtrees j = c (mod chains)
+        chain_programs: list[list] = [[] for _ in range(chains)]
+        for j in range(bv[0]):
+            start = len(self.node_levels)
+            __recurse(j % chains, 0, chain_programs[j % chains])
+            if len(self.node_levels) - start != first_level_size:
+                raise RuntimeError("We should not encounter this at all!")
+        for chain_program in chain_programs:
+            program.extend(chain_program)
+
+        # as soon as possible scheduling on the emitters
+        ready = [0] * self.num_emitters
+        for index, (op, emitters, photon) in enumerate(program):
+            step = max(ready[e] for e in emitters)
+            for e in emitters:
+                ready[e] = step + 1
+            self.ops.append((step, op, emitters, photon))
+        self.ops.sort(key=lambda op: op[0])
+        self.num_time_steps = max(ready)
+        self.max_live_qubits = self.__max_live_qubits()
+
+    def __max_live_qubits(self) -> int:
+        live = [0] * (self.num_time_steps + 1)
+        first_use: dict[int, int] = {}
+        for step, op, emitters, photon in self.ops:
+            if photon is not None:
+                live[step] += 1
+            for e in emitters:
+                first_use.setdefault(e, step)
+            if op == ScheduleOp.TRANSFER:
+                # the emitter is reset to |+> and free until its next use
+                e = emitters[0]
+                for s in range(first_use.pop(e), step + 1):
+                    live[s] += 1
+        # the root emitter stays entangled until it is coupled to the outer emitter
+        for e, start in first_use.items():
+            for s in range(start, self.num_time_steps + 1):
+                live[s] += 1
+        return max(live)
+
+    def photon_order(self) -> list[int]:
+        """postorder indices of the photons in the order they are emitted"""
+        return [photon for _, _, _, photon in self.ops if photon is not None]
+
+    def rgs_generation_steps(self, m: int) -> int:
+        """time steps for the 2m arms of an RGS generated one after the other (one extra step per arm for the outer photon)"""
+        return 2 * m * (self.num_time_steps + 1)
+
+    def summary(self) -> str:
+        return (
+            f"bv = {self.bv}, {self.chains} chain(s): {self.num_emitters} emitters, {self.num_time_steps} time steps "
+            f"for {self.num_photons} photons, at most {self.max_live_qubits} live qubits"
+        )
+
+
+def compile_emission_schedule(bv: list[int], objective: str = "min_emitters") -> EmissionSchedule:
+    """compile the best schedule for the objective among the schedules with 1 to bv[0] chains"""
+    if objective not in OBJECTIVES:
+        raise ValueError(f'objective "{objective}" is not one of {OBJECTIVES}')
+    chain_counts = [1] if len(bv) == 1 else range(1, bv[0] + 1)
+    candidates = [EmissionSchedule(bv, chains) for chains in chain_counts]
+    keys = {
+        "min_emitters": lambda s: (s.num_emitters, s.num_time_steps),
+        "min_time": lambda s: (s.num_time_steps, s.num_emitters),
+        "min_live": lambda s: (s.max_live_qubits, s.num_time_steps),
+    }
+    return min(candidates, key=keys[objective])
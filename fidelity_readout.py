@@ -0,0 +1,130 @@
+#! usr/bin/python3
+
+"""End-of-trial readout of the Alice-Bob Bell pair.
+
+The target state is the two-qubit graph state with stabilizers XZ and ZX (and their product YY),
+so its fidelity is F = (1 + <XZ> + <ZX> + <YY>) / 4.
+A residual Pauli on the pair (taken on Alice's qubit) flips
+    Z: XZ only,   X: ZX only,   Y: both XZ and ZX,
+while an expectation value of 0 means that the two qubits do not hold a Bell pair at all (other error).
+Only these correlators are peeked per shot and accumulated in streaming estimators;
+the reduced two-qubit state is only reconstructed on request.
+"""
+
+import itertools
+
+import numpy as np
+import stim
+
+__PAULI_MATRICES = {
+    "I": np.eye(2, dtype=complex),
+    "X": np.array([[0, 1], [1, 0]], dtype=complex),
+    "Y": np.array([[0, -1j], [1j, 0]], dtype=complex),
+    "Z": np.array([[1, 0], [0, -1]], dtype=complex),
+}
+
+
+def two_qubit_pauli_string(alice: int, bob: int, alice_pauli: str, bob_pauli: str) -> stim.PauliString:
+    """Pauli string acting only on the two given qubits"""
+    pauli_string = stim.PauliString(max(alice, bob) + 1)
+    pauli_string[alice] = alice_pauli
+    pauli_string[bob] = bob_pauli
+    return pauli_string
+
+
+def peek_bell_correlators(t: stim.TableauSimulator, alice: int = 0, bob: int = 1) -> tuple[int, int, int]:
+    """return the expectation values of (XZ, ZX, YY) on Alice and Bob without disturbing the state"""
+    exp_xz = t.peek_observable_expectation(two_qubit_pauli_string(alice, bob, "X", "Z"))
+    exp_zx = t.peek_observable_expectation(two_qubit_pauli_string(alice, bob, "Z", "X"))
+    if exp_xz != 0 and exp_zx != 0:
+        # YY is the product of the two stabilizers, no need to peek it
+        return exp_xz, exp_zx, exp_xz * exp_zx
+    exp_yy = t.peek_observable_expectation(two_qubit_pauli_string(alice, bob, "Y", "Y"))
+    return exp_xz, exp_zx, exp_yy
+
+
+def reduced_two_qubit_state(t: stim.TableauSimulator, alice: int = 0, bob: int = 1) -> np.ndarray:
+    """return the 4x4 density matrix of (Alice, Bob) reconstructed from the 16 two-qubit Pauli expectation values"""
+    rho = np.zeros((4, 4), dtype=complex)
+    for alice_pauli, bob_pauli in itertools.product("IXYZ", repeat=2):
+        if alice_pauli == bob_pauli == "I":
+            expectation = 1
+        else:
+            expectation = t.peek_observable_expectation(two_qubit_pauli_string(alice, bob, alice_pauli, bob_pauli))
+        if expectation != 0:
+            rho += expectation * np.kron(__PAULI_MATRICES[alice_pauli], __PAULI_MATRICES[bob_pauli])
+    return rho / 4
+
+
+class BellStateReadout:
+    """Streaming estimators of the fidelity and of the per-Pauli error rates of the distributed Bell pairs.
+    Only successful trials are recorded."""
+
+    ERROR_TYPES = ["I", "X", "Y", "Z", "other"]
+
+    def __init__(self, alice: int = 0, bob: int = 1):
+        self.alice = alice
+        self.bob = bob
+        self.shots = 0
+        self.fidelity_sum = 0.0
+        self.fidelity_squared_sum = 0.0
+        self.correlator_sums = np.zeros(3)  # (XZ, ZX, YY)
+        self.error_counts = dict.fromkeys(self.ERROR_TYPES, 0)
+
+    def record(self, t: stim.TableauSimulator) -> tuple[int, int, int]:
+        """peek and accumulate the correlators of a successful trial; returns (XZ, ZX, YY)"""
+        correlators = peek_bell_correlators(t, self.alice, self.bob)
+        self.accumulate(*correlators)
+        return correlators
+
+    def accumulate(self, exp_xz: int, exp_zx: int, exp_yy: int):
+        fidelity = (1 + exp_xz + exp_zx + exp_yy) / 4
+        self.shots += 1
+        self.fidelity_sum += fidelity
+        self.fidelity_squared_sum += fidelity * fidelity
+        self.correlator_sums += (exp_xz, exp_zx, exp_yy)
+
+        if exp_xz == 0 or exp_zx == 0:
+            self.error_counts["other"] += 1
+        elif exp_xz == 1 and exp_zx == 1:
+            self.error_counts["I"] += 1
+        elif exp_xz == 1:
+            self.error_counts["X"] += 1
+        elif exp_zx == 1:
+            self.error_counts["Z"] += 1
+        else:
+            self.error_counts["Y"] += 1
+
+    def merge(self, other: "BellStateReadout"):
+        """combine the estimators of another readout (e.g., from another worker process) into this one"""
+        self.shots += other.shots
+        self.fidelity_sum += other.fidelity_sum
+        self.fidelity_squared_sum += other.fidelity_squared_sum
+        self.correlator_sums += other.correlator_sums
+        for error_type in self.ERROR_TYPES:
+            self.error_counts[error_type] += other.error_counts[error_type]
+
+    def fidelity(self) -> float:
+        return self.fidelity_sum / self.shots if self.shots > 0 else np.nan
+
+    def fidelity_standard_error(self) -> float:
+        if self.shots < 2:
+            return np.nan
+        mean = self.fidelity()
+        variance = (self.fidelity_squared_sum - self.shots * mean * mean) / (self.shots - 1)
+        return np.sqrt(max(variance, 0) / self.shots)
+
+    def correlators(self) -> np.ndarray:
+        """mean expectation values of (XZ, ZX, YY)"""
+        return self.correlator_sums / self.shots if self.shots > 0 else np.full(3, np.nan)
+
+    def error_rates(self) -> dict[str, float]:
+        """fraction of the recorded Bell pairs with each residual Pauli (on Alice's qubit) or with other errors"""
+        return {error_type: (count / self.shots if self.shots > 0 else np.nan) for error_type, count in self.error_counts.items()}
+
+    def summary(self) -> str:
+        rates = self.error_rates()
+        return (
+            f"fidelity = {self.fidelity():.6f} +/- {self.fidelity_standard_error():.6f} ({self.shots} pairs); "
+            f"X: {rates['X']:.6f}, Y: {rates['Y']:.6f}, Z: {rates['Z']:.6f}, other: {rates['other']:.6f}"
+        )
@@ -0,0 +1,279 @@
+#! usr/bin/python3
+
+"""Hop-parallel decomposition of the RGS protocol.
+
+The entanglement swap joining two neighbouring hops only contributes classical parity bits to the Pauli frame corrections,
+so a chain trial can be composed from hops that were simulated independently:
+    - the trial succeeds only if every hop succeeds,
+    - the correction parities sent to Alice and Bob are the XOR of the per-hop parities,
+    - the residual error of a hop is a Pauli flipping XZ and/or ZX of its Bell pair and the flips compose by multiplying
+      the per-hop expectation values (a hop which is not a Bell pair up to Pauli makes the final pair unentangled as well),
+    - the noise of the swap itself (gate noise and measurement flips of the two memories, see `sample_swap_flips`) only
+      flips its two measurement results, so it is sampled classically per junction and flips XZ and/or ZX of the chain.
+Every hop is simulated as a 1-hop chain of `rgs_engine` so that hops can be run in separate processes,
+and the per-hop samples are cached so that they can be reused across chain lengths.
+"""
+
+import importlib
+import multiprocessing as mp
+from multiprocessing.pool import Pool
+from types import ModuleType
+
+import numpy as np
+import stim
+
+import tree_code_helper
+from fidelity_readout import peek_bell_correlators
+from noise_model import NoiseModel
+from rgs_config import RgsConfig
+from rgs_engine import rgs_protocol_trial
+from rgs_theoretical_model import prob_rgs_trial
+
+HOP_OUTCOME_DTYPE = np.dtype(
+    [
+        ("success", np.bool_),
+        ("exp_xz", np.int8),
+        ("exp_zx", np.int8),
+        ("left_parity", np.bool_),
+        ("right_parity", np.bool_),
+        ("lost_photons", np.int32),
+    ]
+)
+
+
+def simulate_hop(conf: RgsConfig, decoder: ModuleType = tree_code_helper) -> tuple[bool, int, int, bool, bool, int]:
+    """Simulate a single hop with its own Bell pair between `conf.alice` and `conf.bob` (`conf` must be a 1-hop config).
+    Returns: (success, expectation of XZ, expectation of ZX, parity sent to the left, parity sent to the right, lost photons)
+    The expectation values are taken after the hop's own Pauli frame correction, so (1, 1) is an error-free hop."""
+    lost_photons_before = conf.lost_photons
+    is_successful, _ = rgs_protocol_trial(conf, decoder)
+    lost_photons = conf.lost_photons - lost_photons_before
+    if not is_successful:
+        return False, 0, 0, False, False, lost_photons
+
+    exp_xz, exp_zx, _ = peek_bell_correlators(conf.t, conf.alice, conf.bob)
+    left_parity, right_parity = conf.end_node_parities
+    return True, exp_xz, exp_zx, left_parity, right_parity, lost_photons
+
+
+def sample_hop_outcomes(
+    num_samples: int,
+    m: int,
+    bv: list[int],
+    photon_loss_probability: float,
+    channel_depolarizing_error_probability: float = 0,
+    decoder_name: str = "tree_code_helper",
+    seed: int | np.random.SeedSequence | None = None,
+    noise_model: NoiseModel | None = None,
+) -> np.ndarray:
+    """Simulate `num_samples` independent hops; the arguments are picklable so this can be used as a worker function.
+    Returns: structured array with `HOP_OUTCOME_DTYPE`"""
+    decoder = importlib.import_module(decoder_name)
+    rng = np.random.default_rng(seed)
+    tab_sim = stim.TableauSimulator(seed=int(rng.integers(2**63)))
+    conf = RgsConfig(
+        1, m, bv, photon_loss_probability, channel_depolarizing_error_probability, tab_sim, rng, noise_model=noise_model
+    )
+
+    outcomes = np.zeros(num_samples, dtype=HOP_OUTCOME_DTYPE)
+    for i in range(num_samples):
+        outcomes[i] = simulate_hop(conf, decoder)
+    return outcomes
+
+
+def sample_hop_outcomes_parallel(
+    num_samples: int,
+    m: int,
+    bv: list[int],
+    photon_loss_probability: float,
+    channel_depolarizing_error_probability: float = 0,
+    decoder_name: str = "tree_code_helper",
+    seed: int | np.random.SeedSequence | None = None,
+    num_processes: int = 1,
+    noise_model: NoiseModel | None = None,
+    pool: Pool | None = None,
+) -> np.ndarray:
+    """Same as `sample_hop_outcomes` but the hops are split over `num_processes` worker processes
+    (of `pool` if given, otherwise of a pool started for this call)"""
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    if num_processes <= 1 or num_samples < num_processes:
+        return sample_hop_outcomes(
+            num_samples,
+            m,
+            bv,
+            photon_loss_probability,
+            channel_depolarizing_error_probability,
+            decoder_name,
+            seed_sequence,
+            noise_model,
+        )
+
+    chunks = [num_samples // num_processes + (1 if i < num_samples % num_processes else 0) for i in range(num_processes)]
+    params = [
+        (chunk, m, bv, photon_loss_probability, channel_depolarizing_error_probability, decoder_name, child_seed, noise_model)
+        for chunk, child_seed in zip(chunks, seed_sequence.spawn(num_processes))
+    ]
+    if pool is not None:
+        return np.concatenate(pool.starmap(sample_hop_outcomes, params))
+    with mp.Pool(processes=num_processes) as pool:
+        results = pool.starmap(sample_hop_outcomes, params)
+    return np.concatenate(results)
+
+
+def sample_swap_flips(
+    shots: int, number_of_hops: int, noise_model: NoiseModel | None, rng: np.random.Generator
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sample the noise of the `number_of_hops - 1` entanglement swaps of `shots` chain trials as in `rgs_protocol_trial`:
+    CZ between the two memories (two-qubit gate noise), H on both (single-qubit gate noise) and their measurement
+    (emitter measurement flips). A flipped result of the memory of the left hop flips ZX of the chain and a flipped result
+    of the memory of the right hop flips XZ; the end-node parities are the same as without the flip.
+    Returns: (flips of XZ, flips of ZX) of every trial"""
+    if noise_model is None or number_of_hops < 2:
+        return np.zeros(shots, dtype=bool), np.zeros(shots, dtype=bool)
+    junctions = (shots, number_of_hops - 1)
+    # 12 of the 15 two-qubit Paulis flip the results (left, right) as 01, 10 or 11 with the same probability
+    gate_flip = rng.random(junctions) < noise_model.two_qubit_gate_depolarizing * 12 / 15
+    gate_flip_kind = rng.integers(1, 4, junctions)
+    flips = []
+    for i in range(2):
+        flip = gate_flip & ((gate_flip_kind >> i) & 1 == 1)
+        # a single-qubit depolarizing error flips the Z measurement with X or Y
+        flip ^= rng.random(junctions) < noise_model.single_qubit_gate_depolarizing * 2 / 3
+        flip ^= rng.random(junctions) < noise_model.emitter_measurement_flip
+        flips.append(np.bitwise_xor.reduce(flip, axis=1))
+    flip_zx, flip_xz = flips
+    return flip_xz, flip_zx
+
+
+def compose_chain_outcomes(
+    hop_outcomes: np.ndarray,
+    number_of_hops: int,
+    noise_model: NoiseModel | None = None,
+    rng: np.random.Generator | None = None,
+) -> dict[str, np.ndarray]:
+    """Compose chain trials from consecutive groups of `number_of_hops` independent hop outcomes,
+    with the swap noise of `noise_model` sampled from `rng`.
+    Returns: dictionary of per-trial arrays (success, exp_xz, exp_zx, left_parity, right_parity, correct)"""
+    shots = len(hop_outcomes) // number_of_hops
+    hops = hop_outcomes[: shots * number_of_hops].reshape(shots, number_of_hops)
+
+    success = np.all(hops["success"], axis=1)
+    exp_xz = np.prod(hops["exp_xz"], axis=1, dtype=np.int8)
+    exp_zx = np.prod(hops["exp_zx"], axis=1, dtype=np.int8)
+    flip_xz, flip_zx = sample_swap_flips(shots, number_of_hops, noise_model, np.random.default_rng(rng))
+    exp_xz = np.where(flip_xz, -exp_xz, exp_xz)
+    exp_zx = np.where(flip_zx, -exp_zx, exp_zx)
+    left_parity = np.bitwise_xor.reduce(hops["left_parity"], axis=1)
+    right_parity = np.bitwise_xor.reduce(hops["right_parity"], axis=1)
+    return {
+        "success": success,
+        "exp_xz": np.where(success, exp_xz, 0),
+        "exp_zx": np.where(success, exp_zx, 0),
+        "left_parity": left_parity & success,
+        "right_parity": right_parity & success,
+        "correct": success & (exp_xz == 1) & (exp_zx == 1),
+    }
+
+
+class HopOutcomeCache:
+    """Cache of single-hop samples keyed by the hop parameters, shared by all chain lengths.
+
+    A chain of `n` hops with `shots` trials consumes `n * shots` samples; samples are extended on demand.
+    The chains composed for different lengths reuse the same samples, so their estimates are individually unbiased
+    but correlated with each other. Successive batches of the same chain take the samples after the ones already used
+    (`offset`). A long-lived `pool` of `num_processes` workers can be given so that the extensions do not start new ones."""
+
+    def __init__(self, num_processes: int = 1, seed: int | None = None, pool: Pool | None = None):
+        self.num_processes = num_processes
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.pool = pool
+        self.outcomes: dict[tuple, np.ndarray] = {}
+
+    @staticmethod
+    def key(
+        m: int,
+        bv: list[int],
+        photon_loss_probability: float,
+        channel_depolarizing_error_probability: float,
+        decoder_name: str,
+        noise_model: NoiseModel | None = None,
+    ) -> tuple:
+        noise = tuple(noise_model.to_dict().values()) if noise_model is not None else None
+        return m, tuple(bv), float(photon_loss_probability), float(channel_depolarizing_error_probability), decoder_name, noise
+
+    def get(
+        self,
+        num_samples: int,
+        m: int,
+        bv: list[int],
+        photon_loss_probability: float,
+        channel_depolarizing_error_probability: float = 0,
+        decoder_name: str = "tree_code_helper",
+        noise_model: NoiseModel | None = None,
+        offset: int = 0,
+    ) -> np.ndarray:
+        """return the `num_samples` cached hop outcomes starting at `offset`, simulating the missing ones"""
+        key = self.key(m, bv, photon_loss_probability, channel_depolarizing_error_probability, decoder_name, noise_model)
+        cached = self.outcomes.get(key, np.zeros(0, dtype=HOP_OUTCOME_DTYPE))
+        end = offset + num_samples
+        if len(cached) < end:
+            new_outcomes = sample_hop_outcomes_parallel(
+                end - len(cached),
+                m,
+                bv,
+                photon_loss_probability,
+                channel_depolarizing_error_probability,
+                decoder_name,
+                self.seed_sequence.spawn(1)[0],
+                self.num_processes,
+                noise_model,
+                self.pool,
+            )
+            cached = np.concatenate([cached, new_outcomes])
+            self.outcomes[key] = cached
+        return cached[offset:end]
+
+
+def hop_parallel_experiment_run(
+    shots: int,
+    number_of_hops: int,
+    m: int,
+    bv: list[int],
+    photon_loss_probability: float,
+    channel_depolarizing_error_probability: float = 0,
+    decoder: ModuleType = tree_code_helper,
+    num_processes: int = 1,
+    cache: HopOutcomeCache | None = None,
+    seed: int | None = None,
+    noise_model: NoiseModel | None = None,
+    sample_offset: int = 0,
+    show_output=True,
+) -> tuple[int, int]:
+    """Hop-parallel counterpart of `rgs_engine.rgs_trial_experiment_run`
+    The trials are composed from the hop samples of `cache` starting at `sample_offset` (see `HopOutcomeCache`).
+    Returns: (number of successful trials, number of successful trials with the correct Bell state)"""
+    if cache is None:
+        cache = HopOutcomeCache(num_processes, seed)
+    hop_outcomes = cache.get(
+        shots * number_of_hops,
+        m,
+        bv,
+        photon_loss_probability,
+        channel_depolarizing_error_probability,
+        decoder.__name__,
+        noise_model,
+        sample_offset,
+    )
+    trials = compose_chain_outcomes(hop_outcomes, number_of_hops, noise_model, np.random.default_rng(seed))
+
+    success_count = int(np.sum(trials["success"]))
+    no_error_count = int(np.sum(trials["correct"]))
+    if show_output:
+        print(f"RGS protocol trials (hop-parallel) with params ({number_of_hops}, {m}, {bv}, {photon_loss_probability})")
+        loss = photon_loss_probability if noise_model is None else noise_model.effective_loss_probability(photon_loss_probability)
+        theoretical = prob_rgs_trial(m, bv, 1 - loss, number_of_hops)
+        print(f"        theoretical prob ({theoretical:03f}) succeeded with {success_count / shots}({success_count}/{shots})")
+        if success_count > 0:
+            error_count = success_count - no_error_count
+            print(f"        error probability: {error_count / success_count} ({error_count}/{success_count})")
+    return success_count, no_error_count
@@ -0,0 +1,165 @@
+#! usr/bin/python3
+
+"""Importance-sampled estimation of rare logical errors.
+
+With depolarizing probabilities around 1e-5 a logical error of the distributed Bell pair is so rare that plain Monte Carlo
+needs billions of shots to observe a handful of them.
+Instead, photon depolarizing errors (and optionally losses) are drawn at larger biased probabilities and
+every trial carries the likelihood ratio w = P_nominal(trial) / P_biased(trial) of all the sampled events.
+The weighted means of the success and error indicators are unbiased estimates under the nominal probabilities:
+    P(success)          = E[w s]
+    P(success, error)   = E[w e]
+    P(error | success)  = E[w e] / E[w s]   (ratio estimator, delta-method variance)
+The estimates can be compared against the error formulas of the theoretical model.
+"""
+
+from types import ModuleType
+
+import numpy as np
+import stim
+
+import majority_vote_tree_code_helper
+from absa_policy import ArmSelectionPolicy
+from lookup_tree_code_helper import subtree_size
+from rgs_config import RgsConfig
+from rgs_engine import rgs_protocol_trial
+
+
+def photons_per_trial(number_of_hops: int, m: int, bv: list[int]) -> int:
+    """number of photons emitted in a trial that reaches the last hop (outer photons included)"""
+    return 2 * number_of_hops * m * subtree_size(tuple(bv))
+
+
+def default_biased_error_probability(number_of_hops: int, m: int, bv: list[int], depolarizing_error_probability: float) -> float:
+    """bias such that a trial has about one photon error on average (never below the nominal probability)"""
+    if depolarizing_error_probability == 0:
+        return 0
+    return max(depolarizing_error_probability, min(0.5, 1 / photons_per_trial(number_of_hops, m, bv)))
+
+
+class ImportanceSamplingEstimate:
+    """Streaming weighted estimators of the success and logical error probabilities"""
+
+    def __init__(self):
+        self.shots = 0
+        self.success_count = 0  # raw (unweighted) counts under the biased probabilities
+        self.error_count = 0
+        self.weight_sum = 0.0
+        self.weight_squared_sum = 0.0
+        self.success_weight_sum = 0.0
+        self.success_weight_squared_sum = 0.0
+        self.error_weight_sum = 0.0
+        self.error_weight_squared_sum = 0.0
+
+    def record(self, log_likelihood_ratio: float, is_successful: bool, is_correct: bool | None):
+        weight = float(np.exp(log_likelihood_ratio))
+        self.shots += 1
+        self.weight_sum += weight
+        self.weight_squared_sum += weight * weight
+        if is_successful:
+            self.success_count += 1
+            self.success_weight_sum += weight
+            self.success_weight_squared_sum += weight * weight
+            if not is_correct:
+                self.error_count += 1
+                self.error_weight_sum += weight
+                self.error_weight_squared_sum += weight * weight
+
+    def merge(self, other: "ImportanceSamplingEstimate"):
+        """combine the estimators of another run (e.g., from another worker process) into this one"""
+        for name in vars(self):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def __mean_and_standard_error(self, total: float, squared_total: float) -> tuple[float, float]:
+        if self.shots == 0:
+            return np.nan, np.nan
+        mean = total / self.shots
+        if self.shots < 2:
+            return mean, np.nan
+        variance = (squared_total - self.shots * mean * mean) / (self.shots - 1)
+        return mean, float(np.sqrt(max(variance, 0) / self.shots))
+
+    def success_probability(self) -> tuple[float, float]:
+        """(estimate, standard error) of the probability of a successful trial"""
+        return self.__mean_and_standard_error(self.success_weight_sum, self.success_weight_squared_sum)
+
+    def logical_error_probability(self) -> tuple[float, float]:
+        """(estimate, standard error) of the probability of a successful trial delivering a wrong Bell pair"""
+        return self.__mean_and_standard_error(self.error_weight_sum, self.error_weight_squared_sum)
+
+    def conditional_error_rate(self) -> tuple[float, float]:
+        """(estimate, standard error) of the logical error rate of the delivered Bell pairs"""
+        if self.success_weight_sum == 0:
+            return np.nan, np.nan
+        rate = self.error_weight_sum / self.success_weight_sum
+        # w (e - rate * s) has mean zero by construction, and e, s are indicators with e <= s
+        no_error_weight_squared_sum = self.success_weight_squared_sum - self.error_weight_squared_sum
+        variance_sum = self.error_weight_squared_sum * (1 - rate) ** 2 + no_error_weight_squared_sum * rate**2
+        return rate, float(np.sqrt(variance_sum) / self.success_weight_sum)
+
+    def effective_sample_size(self) -> float:
+        return self.weight_sum**2 / self.weight_squared_sum if self.weight_squared_sum > 0 else 0.0
+
+    def summary(self) -> str:
+        success, success_error = self.success_probability()
+        error, error_error = self.logical_error_probability()
+        rate, rate_error = self.conditional_error_rate()
+        return (
+            f"success probability = {success:.6g} +/- {success_error:.3g}; "
+            f"logical error probability = {error:.6g} +/- {error_error:.3g}; "
+            f"error rate of delivered pairs = {rate:.6g} +/- {rate_error:.3g} "
+            f"({self.error_count} biased errors in {self.shots} shots, effective sample size {self.effective_sample_size():.1f})"
+        )
+
+
+def importance_sampled_experiment_run(
+    shots: int,
+    number_of_hops: int,
+    m: int,
+    bv: list[int],
+    photon_loss_probability: float,
+    channel_depolarizing_error_probability: float,
+    biased_loss_probability: float | None = None,
+    biased_error_probability: float | None = None,
+    decoder: ModuleType = majority_vote_tree_code_helper,
+    seed: int | None = None,
+    policy: ArmSelectionPolicy = ArmSelectionPolicy.FIRST_SUCCESS,
+    estimate: ImportanceSamplingEstimate | None = None,
+    show_output=True,
+) -> ImportanceSamplingEstimate:
+    """Run `shots` trials with biased photon error (and loss) probabilities and return the weighted estimates
+    (accumulated into `estimate` if given). The biased error probability defaults to `default_biased_error_probability`,
+    losses are not biased unless `biased_loss_probability` is given."""
+    if biased_error_probability is None:
+        biased_error_probability = default_biased_error_probability(number_of_hops, m, bv, channel_depolarizing_error_probability)
+    for name, nominal, biased in [
+        ("loss", photon_loss_probability, biased_loss_probability),
+        ("error", channel_depolarizing_error_probability, biased_error_probability),
+    ]:
+        if biased is None:
+            continue
+        if not 0 <= biased < 1:
+            raise ValueError(f"biased {name} probability {biased} is not in [0, 1)")
+        if biased == 0 and nominal > 0:
+            raise ValueError(f"biased {name} probability cannot be 0 when the nominal probability is {nominal}")
+
+    rng = np.random.default_rng(seed)
+    tab_sim = stim.TableauSimulator(seed=int(rng.integers(2**63)))
+    conf = RgsConfig(number_of_hops, m, bv, photon_loss_probability, channel_depolarizing_error_probability, tab_sim, rng)
+    conf.biased_loss_probability = biased_loss_probability
+    conf.biased_error_probability = biased_error_probability
+
+    if estimate is None:
+        estimate = ImportanceSamplingEstimate()
+    for _ in range(shots):
+        is_successful, is_correct = rgs_protocol_trial(conf, decoder, policy=policy)
+        estimate.record(conf.log_likelihood_ratio, is_successful, is_correct)
+
+    if show_output:
+        print(
+            "importance-sampled RGS protocol trials with params "
+            f"({number_of_hops}, {m}, {bv}, {photon_loss_probability}, {channel_depolarizing_error_probability})"
+        )
+        print(f"        biased loss probability {biased_loss_probability}, biased error probability {biased_error_probability}")
+        print(f"    {estimate.summary()}")
+    return estimate
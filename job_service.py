@@ -0,0 +1,380 @@
+#! /usr/bin/python3
+
+"""Local simulation job service shared by several notebooks.
+
+A single asyncio server (on a Unix socket or on localhost) owns one process pool and accepts RGS simulation jobs
+    {"number_of_hops": 5, "m": 4, "bv": [4, 2], "loss_probability": 0.1, "depolarizing_error_probability": 0,
+     "shots": 100000, "decoder": "tree_code_helper"}
+Jobs with the same parameters are deduplicated: submitting one again returns the job already in flight
+(raising its shot target if more shots are asked for).
+Jobs are split into batches which are handed to the pool round-robin across the active jobs, so a large job
+does not starve the small ones, and the statistics are updated (and streamed to watchers) after every batch.
+
+The protocol is one JSON object per line in both directions:
+    {"op": "submit", "job": {...}}      -> {"job_id": ..., "deduplicated": bool}
+    {"op": "status", "job_id": ...}     -> statistics of the job
+    {"op": "watch", "job_id": ...}      -> statistics after every batch until the job is done
+    {"op": "cancel", "job_id": ...}     -> statistics of the cancelled job
+    {"op": "jobs"}                      -> {"jobs": [statistics of all jobs]}
+Errors are answered with {"error": message}. `JobServiceClient` wraps the protocol for notebooks.
+The state of a job is "running", "done", "cancelled" (asked for by a client) or "failed" (a batch raised an exception,
+given as "failure" in the statistics); a failed job can be submitted again.
+
+    python job_service.py --address /tmp/rgs-jobs.sock --num-processes 8
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+JOB_PARAMETERS = ["number_of_hops", "m", "bv", "loss_probability", "depolarizing_error_probability", "decoder"]
+DECODERS = ["tree_code_helper", "majority_vote_tree_code_helper", "lookup_tree_code_helper"]
+DEFAULT_JOB = {"depolarizing_error_probability": 0, "decoder": "tree_code_helper"}
+DEFAULT_ADDRESS = "/tmp/rgs-jobs.sock"
+
+
+def run_job_batch(parameters: dict, shots: int, seed: int) -> tuple[int, int]:
+    """worker entry point: run one batch of trials of a job"""
+    import importlib
+
+    from rgs_engine import rgs_trial_experiment_run
+
+    return rgs_trial_experiment_run(
+        shots,
+        parameters["number_of_hops"],
+        parameters["m"],
+        parameters["bv"],
+        parameters["loss_probability"],
+        parameters["depolarizing_error_probability"],
+        decoder=importlib.import_module(parameters["decoder"]),
+        seed=seed,
+        show_output=False,
+    )
+
+
+def canonical_job(job: dict) -> tuple[dict, int]:
+    """validate a submitted job; returns (parameters identifying the job, shot target)"""
+    job = {**DEFAULT_JOB, **job}
+    missing = [name for name in JOB_PARAMETERS + ["shots"] if name not in job]
+    if len(missing) > 0:
+        raise ValueError(f"job is missing the parameter(s) {missing}")
+    if job["decoder"] not in DECODERS:
+        raise ValueError(f'decoder "{job["decoder"]}" is not one of {DECODERS}')
+    parameters = {
+        "number_of_hops": int(job["number_of_hops"]),
+        "m": int(job["m"]),
+        "bv": [int(b) for b in job["bv"]],
+        "loss_probability": float(job["loss_probability"]),
+        "depolarizing_error_probability": float(job["depolarizing_error_probability"]),
+        "decoder": job["decoder"],
+    }
+    return parameters, int(job["shots"])
+
+
+def job_id_of(parameters: dict) -> str:
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class Job:
+    def __init__(self, job_id: str, parameters: dict, shots: int, seed: int | None):
+        self.job_id = job_id
+        self.parameters = parameters
+        self.target_shots = shots
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.done_shots = 0
+        self.in_flight_shots = 0
+        self.success_count = 0
+        self.no_error_count = 0
+        self.cancelled = False
+        self.failure: str | None = None
+        self.watchers: list[asyncio.Queue] = []
+
+    def is_stopped(self) -> bool:
+        """cancelled or failed, no more batches are handed out"""
+        return self.cancelled or self.failure is not None
+
+    def remaining_shots(self) -> int:
+        return 0 if self.is_stopped() else max(0, self.target_shots - self.done_shots - self.in_flight_shots)
+
+    def is_done(self) -> bool:
+        return self.in_flight_shots == 0 and (self.is_stopped() or self.done_shots >= self.target_shots)
+
+    def statistics(self) -> dict:
+        shots, successes = self.done_shots, self.success_count
+        success_probability = successes / shots if shots > 0 else None
+        return {
+            "job_id": self.job_id,
+            **self.parameters,
+            "target_shots": self.target_shots,
+            "shots": shots,
+            "success_count": successes,
+            "no_error_count": self.no_error_count,
+            "success_probability": success_probability,
+            "success_probability_standard_error": (
+                float(np.sqrt(success_probability * (1 - success_probability) / shots))
+                if success_probability is not None
+                else None
+            ),
+            "error_probability": (successes - self.no_error_count) / successes if successes > 0 else None,
+            "state": self.state(),
+            "failure": self.failure,
+        }
+
+    def state(self) -> str:
+        if self.failure is not None:
+            return "failed"
+        if self.cancelled:
+            return "cancelled"
+        return "done" if self.is_done() else "running"
+
+    def publish(self):
+        statistics = self.statistics()
+        for queue in self.watchers:
+            queue.put_nowait(statistics)
+
+
+class JobService:
+    """Deduplicating round-robin scheduler of job batches onto a shared process pool"""
+
+    def __init__(self, num_processes: int = 1, batch_shots: int = 1000, seed: int | None = None):
+        self.num_processes = num_processes
+        self.batch_shots = batch_shots
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.pool = ProcessPoolExecutor(num_processes)
+        self.jobs: dict[str, Job] = {}
+        self.round_robin: list[str] = []  # active jobs in scheduling order
+        self.in_flight_batches = 0
+        self.wakeup = asyncio.Event()
+
+    def submit(self, job: dict) -> tuple[Job, bool]:
+        parameters, shots = canonical_job(job)
+        job_id = job_id_of(parameters)
+        existing = self.jobs.get(job_id)
+        if existing is not None and not existing.is_stopped():
+            if shots > existing.target_shots:
+                existing.target_shots = shots
+                if job_id not in self.round_robin:
+                    self.round_robin.append(job_id)
+                self.wakeup.set()
+            return existing, True
+
+        seed = int(self.seed_sequence.spawn(1)[0].generate_state(1, dtype="uint64")[0])
+        self.jobs[job_id] = Job(job_id, parameters, shots, seed)
+        self.round_robin.append(job_id)
+        self.wakeup.set()
+        return self.jobs[job_id], False
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.jobs[job_id]
+        job.cancelled = True
+        if job_id in self.round_robin:
+            self.round_robin.remove(job_id)
+        job.publish()
+        return job
+
+    def __next_job(self) -> Job | None:
+        """the next job in round-robin order that still has shots to hand out"""
+        for _ in range(len(self.round_robin)):
+            job_id = self.round_robin.pop(0)
+            job = self.jobs[job_id]
+            if job.remaining_shots() > 0:
+                self.round_robin.append(job_id)
+                return job
+            if not job.is_done():
+                # no more batches to hand out, but some are still running
+                self.round_robin.append(job_id)
+        return None
+
+    async def __run_batch(self, job: Job, shots: int):
+        loop = asyncio.get_running_loop()
+        seed = int(job.seed_sequence.spawn(1)[0].generate_state(1, dtype="uint64")[0])
+        try:
+            success_count, no_error_count = await loop.run_in_executor(self.pool, run_job_batch, job.parameters, shots, seed)
+            job.done_shots += shots
+            job.success_count += success_count
+            job.no_error_count += no_error_count
+        except Exception as e:
+            print(f"job {job.job_id} batch failed: {e!r}", file=sys.stderr, flush=True)
+            job.failure = repr(e)
+        finally:
+            job.in_flight_shots -= shots
+            self.in_flight_batches -= 1
+            if job.is_done() and job.job_id in self.round_robin:
+                self.round_robin.remove(job.job_id)
+            job.publish()
+            self.wakeup.set()
+
+    async def schedule(self):
+        """keep the pool busy with one batch per process"""
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.in_flight_batches < self.num_processes:
+                job = self.__next_job()
+                if job is None:
+                    break
+                shots = min(self.batch_shots, job.remaining_shots())
+                job.in_flight_shots += shots
+                self.in_flight_batches += 1
+                asyncio.create_task(self.__run_batch(job, shots))
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def __send(message: dict):
+            writer.write((json.dumps(message) + "\n").encode())
+            await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    op = request.get("op")
+                    if op == "submit":
+                        job, deduplicated = self.submit(request["job"])
+                        await __send({"job_id": job.job_id, "deduplicated": deduplicated})
+                    elif op == "status":
+                        await __send(self.jobs[request["job_id"]].statistics())
+                    elif op == "cancel":
+                        await __send(self.cancel(request["job_id"]).statistics())
+                    elif op == "jobs":
+                        await __send({"jobs": [job.statistics() for job in self.jobs.values()]})
+                    elif op == "watch":
+                        job = self.jobs[request["job_id"]]
+                        queue: asyncio.Queue = asyncio.Queue()
+                        job.watchers.append(queue)
+                        try:
+                            statistics = job.statistics()
+                            await __send(statistics)
+                            while statistics["state"] == "running":
+                                statistics = await queue.get()
+                                await __send(statistics)
+                        finally:
+                            job.watchers.remove(queue)
+                    else:
+                        raise ValueError(f'unknown op "{op}"')
+                except KeyError as e:
+                    await __send({"error": f"unknown job or missing field {e}"})
+                except (ValueError, TypeError) as e:
+                    await __send({"error": str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+def parse_address(address: str) -> tuple[str, int] | str:
+    """"host:port" for TCP, anything else is a Unix socket path"""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+async def serve(address: str = DEFAULT_ADDRESS, num_processes: int = 1, batch_shots: int = 1000, seed: int | None = None):
+    service = JobService(num_processes, batch_shots, seed)
+    parsed = parse_address(address)
+    if isinstance(parsed, tuple):
+        server = await asyncio.start_server(service.handle_client, *parsed)
+    else:
+        if os.path.exists(parsed):
+            # stale socket of a previous service
+            os.unlink(parsed)
+        server = await asyncio.start_unix_server(service.handle_client, parsed)
+    print(f"RGS job service listening on {address} with {num_processes} process(es)", flush=True)
+    try:
+        async with server:
+            await asyncio.gather(server.serve_forever(), service.schedule())
+    finally:
+        service.shutdown()
+
+
+class JobServiceClient:
+    """Blocking client of the job service, e.g., for notebooks"""
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, timeout: float | None = None):
+        parsed = parse_address(address)
+        if isinstance(parsed, tuple):
+            self.socket = socket.create_connection(parsed, timeout=timeout)
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(parsed)
+        self.file = self.socket.makefile("rw")
+
+    def __request(self, request: dict) -> dict:
+        self.file.write(json.dumps(request) + "\n")
+        self.file.flush()
+        return self.__receive()
+
+    def __receive(self) -> dict:
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("the job service closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def submit(self, **job) -> str:
+        """submit a job (see the module docstring for the parameters) and return its id"""
+        return self.__request({"op": "submit", "job": job})["job_id"]
+
+    def status(self, job_id: str) -> dict:
+        return self.__request({"op": "status", "job_id": job_id})
+
+    def cancel(self, job_id: str) -> dict:
+        return self.__request({"op": "cancel", "job_id": job_id})
+
+    def jobs(self) -> list[dict]:
+        return self.__request({"op": "jobs"})["jobs"]
+
+    def watch(self, job_id: str):
+        """yield the statistics of the job after every batch until it is done"""
+        statistics = self.__request({"op": "watch", "job_id": job_id})
+        yield statistics
+        while statistics["state"] == "running":
+            statistics = self.__receive()
+            yield statistics
+
+    def wait(self, job_id: str) -> dict:
+        """block until the job is done and return its final statistics"""
+        for statistics in self.watch(job_id):
+            pass
+        return statistics
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="rgs-job-service", description="Serve RGS simulation jobs from a shared process pool.")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help=f'Unix socket path or "host:port" (default {DEFAULT_ADDRESS})')
+    parser.add_argument("--num-processes", type=int, default=1, help="worker processes of the shared pool")
+    parser.add_argument("--batch-shots", type=int, default=1000, help="shots per batch handed to a worker")
+    parser.add_argument("--seed", type=int, help="seed of the service")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.address, args.num_processes, args.batch_shots, args.seed))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#! usr/bin/python3
+
+"""Table-driven decoding of the tree code (same decisions as `tree_code_helper`).
+
+Whether a subtree can provide a (direct or indirect) Z result, and which physical results enter the parity,
+only depends on which photons of the subtree were lost.
+For small subtrees every loss pattern fits in an integer bitmask (bit i <-> i-th node of the subtree in postorder,
+i.e., the order in which the photons are emitted), so we precompute for each loss bitmask whether the subtree is decodable
+and the bitmask of the nodes used for the parity.
+Decoding then becomes table lookups plus the parity (XOR) of the measured eigenvalues selected by the parity bitmask.
+Subtrees too large to be tabulated are composed from the tables of their children.
+The engine builds the bitmasks of the first level subtrees while the photons are emitted (`Node.loss_masks`, `Node.eigen_masks`),
+so the decoding does not have to walk the trees again (`decode_logical_z_from_masks`, `decode_logical_x_from_masks`).
+
+The tables only depend on the branching parameters below the root of the subtree; they are built lazily
+and kept in a least-recently-used cache bounded by the total number of table entries.
+"""
+
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from rgs_config import Node
+
+# subtrees with at most this many nodes are tabulated (a table has 2 ** size entries)
+MAX_TABLE_BITS = 16
+# bound on the total number of entries of all cached tables
+MAX_CACHED_TABLE_ENTRIES = 1 << 22
+
+__tables: OrderedDict[tuple[str, tuple[int, ...]], tuple[list[bool], list[int]]] = OrderedDict()
+__cached_entries = 0
+
+
+@lru_cache(maxsize=None)
+def subtree_size(below: tuple[int, ...]) -> int:
+    """number of nodes of a subtree whose root has the branching parameters `below` underneath it"""
+    size = 1
+    for b in reversed(below):
+        size = 1 + b * size
+    return size
+
+
+def branching_below(u: Node) -> tuple[int, ...]:
+    """branching parameters underneath `u` (trees are regular, so following the first child is enough)"""
+    below = []
+    while len(u.children) > 0:
+        below.append(len(u.children))
+        u = u.children[0]
+    return tuple(below)
+
+
+def subtree_masks(u: Node) -> tuple[int, int]:
+    """return (loss bitmask, eigenvalue bitmask) of the subtree rooted at `u` in postorder"""
+    loss_mask = 0
+    eigen_mask = 0
+    for bit, v in enumerate(u.get_postorder_traversal()):
+        if v.is_lost:
+            loss_mask |= 1 << bit
+        elif v.eigenvalue:
+            eigen_mask |= 1 << bit
+    return loss_mask, eigen_mask
+
+
+def __child_loss_mask(root: Node, j: int) -> int:
+    """loss bitmask of the j-th first level subtree of `root`, the one stored when the photons were emitted if any"""
+    if root.loss_masks is not None:
+        return root.loss_masks[j]
+    return subtree_masks(root.children[j])[0]
+
+
+def __build_table(kind: str, below: tuple[int, ...]) -> tuple[np.ndarray, np.ndarray]:
+    """vectorized construction over all loss bitmasks of the subtree
+    kind "z": the subtree root gives a Z result (direct, or indirect through a child measured in X)
+    kind "x": the subtree root is measured in X and all its children give Z results"""
+    n = subtree_size(below)
+    masks = np.arange(1 << n, dtype=np.uint64)
+    root_bit = np.uint64(1 << (n - 1))
+    root_present = (masks & root_bit) == 0
+
+    if len(below) == 0:
+        return root_present, np.full(1 << n, root_bit, dtype=np.uint64)
+
+    child_size = subtree_size(below[1:])
+    child_kind = "z" if kind == "x" else "x"
+    child_decodable, child_parity = (np.array(table) for table in get_table(child_kind, below[1:]))
+    child_parity = child_parity.astype(np.uint64)
+    child_mask = np.uint64((1 << child_size) - 1)
+    offsets = [np.uint64(j * child_size) for j in range(below[0])]
+
+    if kind == "x":
+        decodable = root_present.copy()
+        parity = np.full(1 << n, root_bit, dtype=np.uint64)
+        for offset in offsets:
+            sub = (masks >> offset) & child_mask
+            decodable &= child_decodable[sub]
+            parity |= child_parity[sub] << offset
+        parity[~decodable] = 0
+        return decodable, parity
+
+    # kind == "z": direct result if available, otherwise the first child providing an indirect result
+    decodable = root_present.copy()
+    parity = np.where(root_present, root_bit, np.uint64(0))
+    for offset in offsets:
+        sub = (masks >> offset) & child_mask
+        use_child = (~decodable) & child_decodable[sub]
+        parity = np.where(use_child, child_parity[sub] << offset, parity)
+        decodable |= use_child
+    return decodable, parity
+
+
+def get_table(kind: str, below: tuple[int, ...]) -> tuple[list[bool], list[int]]:
+    """return (decodable, parity bitmask) tables indexed by loss bitmask, building and caching them if needed"""
+    global __cached_entries
+    key = (kind, below)
+    if key in __tables:
+        __tables.move_to_end(key)
+        return __tables[key]
+
+    if subtree_size(below) > MAX_TABLE_BITS:
+        raise ValueError(f"subtree with branching parameters {list(below)} is too large to be tabulated")
+    decodable, parity = __build_table(kind, below)
+    table = (decodable.tolist(), parity.tolist())
+
+    __tables[key] = table
+    __cached_entries += len(decodable)
+    while __cached_entries > MAX_CACHED_TABLE_ENTRIES and len(__tables) > 1:
+        _, (evicted, _) = __tables.popitem(last=False)
+        __cached_entries -= len(evicted)
+    return table
+
+
+def clear_tables():
+    global __cached_entries
+    __tables.clear()
+    __cached_entries = 0
+
+
+def lookup(kind: str, below: tuple[int, ...], loss_mask: int) -> tuple[bool, int]:
+    """return (decodable, parity bitmask) of a subtree given its loss bitmask (see `get_table` for `kind`)"""
+    n = subtree_size(below)
+    if n <= MAX_TABLE_BITS:
+        decodable, parity = get_table(kind, below)
+        return decodable[loss_mask], parity[loss_mask]
+
+    # compose from the children when the subtree is too large to be tabulated
+    root_bit = 1 << (n - 1)
+    root_present = not (loss_mask & root_bit)
+    child_size = subtree_size(below[1:])
+    child_mask = (1 << child_size) - 1
+    child_kind = "z" if kind == "x" else "x"
+    if kind == "x":
+        if not root_present:
+            return False, 0
+        parity = root_bit
+        for j in range(below[0]):
+            child_decodable, child_parity = lookup(child_kind, below[1:], (loss_mask >> (j * child_size)) & child_mask)
+            if not child_decodable:
+                return False, 0
+            parity |= child_parity << (j * child_size)
+        return True, parity
+
+    if root_present:
+        return True, root_bit
+    for j in range(below[0]):
+        child_decodable, child_parity = lookup(child_kind, below[1:], (loss_mask >> (j * child_size)) & child_mask)
+        if child_decodable:
+            return True, child_parity << (j * child_size)
+    return False, 0
+
+
+def __parity(eigen_mask: int, parity_mask: int) -> bool:
+    return bool((eigen_mask & parity_mask).bit_count() & 1)
+
+
+def __decode_from_masks(kind: str, below: tuple[int, ...], loss_masks: list[int], eigen_masks: list[int]) -> bool | None:
+    if subtree_size(below) <= MAX_TABLE_BITS:
+        # fast path, fetch the table once and index it directly
+        decodable_table, parity_table = get_table(kind, below)
+        results = zip(map(decodable_table.__getitem__, loss_masks), map(parity_table.__getitem__, loss_masks), eigen_masks)
+    else:
+        results = ((*lookup(kind, below, loss_mask), eigen_mask) for loss_mask, eigen_mask in zip(loss_masks, eigen_masks))
+
+    if kind == "x":
+        # the first first-level node with a successful X measurement
+        for decodable, parity_mask, eigen_mask in results:
+            if decodable:
+                return __parity(eigen_mask, parity_mask)
+        return None
+
+    # the parity of the Z results of all first-level nodes
+    weight = 0
+    for decodable, parity_mask, eigen_mask in results:
+        if not decodable:
+            return None
+        weight += (eigen_mask & parity_mask).bit_count()
+    return bool(weight & 1)
+
+
+def decode_logical_z_from_masks(below: tuple[int, ...], loss_masks: list[int], eigen_masks: list[int]) -> bool | None:
+    """logical Z from the (loss, eigenvalue) bitmasks of the first level subtrees;
+    `below` is the branching parameters underneath a first level node, i.e., bv[1:]"""
+    return __decode_from_masks("z", below, loss_masks, eigen_masks)
+
+
+def decode_logical_x_from_masks(below: tuple[int, ...], loss_masks: list[int], eigen_masks: list[int]) -> bool | None:
+    """logical X from the (loss, eigenvalue) bitmasks of the first level subtrees;
+    `below` is the branching parameters underneath a first level node, i.e., bv[1:]"""
+    return __decode_from_masks("x", below, loss_masks, eigen_masks)
+
+
+def is_decodable_z(root: Node) -> bool:
+    """whether the logical Z measurement of the tree can be decoded, given only the loss pattern"""
+    if len(root.children) == 0:
+        raise RuntimeError("We should not encounter this at all!")
+    below = branching_below(root)[1:]
+    return all((not u.is_lost) or lookup("z", below, __child_loss_mask(root, j))[0] for j, u in enumerate(root.children))
+
+
+def is_decodable_x(root: Node) -> bool:
+    """whether the logical X measurement of the tree can be decoded, given only the loss pattern"""
+    below = branching_below(root)[1:]
+    return any((not u.is_lost) and lookup("x", below, __child_loss_mask(root, j))[0] for j, u in enumerate(root.children))
+
+
+def parity_weight_z(root: Node) -> int | None:
+    """number of physical results entering the parity of the logical Z measurement, None if it cannot be decoded"""
+    if len(root.children) == 0:
+        raise RuntimeError("We should not encounter this at all!")
+    below = branching_below(root)[1:]
+    weight = 0
+    for j, u in enumerate(root.children):
+        if not u.is_lost:
+            weight += 1
+            continue
+        decodable, parity_mask = lookup("z", below, __child_loss_mask(root, j))
+        if not decodable:
+            return None
+        weight += parity_mask.bit_count()
+    return weight
+
+
+def parity_weight_x(root: Node) -> int | None:
+    """number of physical results entering the parity of the logical X measurement, None if it cannot be decoded"""
+    below = branching_below(root)[1:]
+    for j, u in enumerate(root.children):
+        if u.is_lost:
+            continue
+        decodable, parity_mask = lookup("x", below, __child_loss_mask(root, j))
+        if decodable:
+            return parity_mask.bit_count()
+    return None
+
+
+def decode_tree_logical_z(root: Node) -> bool | None:
+    """find the XOR (parity) of the first level nodes
+    the eigenvalues are read from the tree since they may have changed since the emission, see `decode_logical_z_from_masks`"""
+    if len(root.children) == 0:
+        raise RuntimeError("We should not encounter this at all!")
+    below = branching_below(root)[1:]
+    logical_z = False
+    for u in root.children:
+        if not u.is_lost:
+            # direct result, no need to look at the subtree
+            logical_z ^= u.eigenvalue  # type: ignore
+            continue
+        loss_mask, eigen_mask = subtree_masks(u)
+        decodable, parity_mask = lookup("z", below, loss_mask)
+        if not decodable:
+            return None
+        logical_z ^= __parity(eigen_mask, parity_mask)
+    return logical_z
+
+
+def decode_tree_logical_x(root: Node) -> bool | None:
+    """find successful X in the first level and return the parity of it with all its children's Z results
+    i.e., the parity of the X_i Z_children_of_i of any first level node i"""
+    below = branching_below(root)[1:]
+    for u in root.children:
+        if u.is_lost:
+            continue
+        loss_mask, eigen_mask = subtree_masks(u)
+        decodable, parity_mask = lookup("x", below, loss_mask)
+        if decodable:
+            return __parity(eigen_mask, parity_mask)
+    return None
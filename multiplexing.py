@@ -0,0 +1,112 @@
+#! usr/bin/python3
+
+"""Multiplexed links: k RGS attempts per hop in every time slot.
+
+Each hop of the chain runs k independent RGS attempts per slot and keeps one successful hop Bell pair:
+    first   the first successful attempt (in the order the attempts were made)
+    best    the successful attempt with the fewest lost photons (the loss pattern is heralded at the ABSA)
+A slot delivers a Bell pair if every hop has at least one successful attempt,
+and the chain is composed from the kept hops as in `hop_parallel.compose_chain_outcomes` (with the same swap noise).
+The attempts are single-hop samples from a `HopOutcomeCache`; the slot/hop/attempt array is drawn once for the largest k
+and the attempts of smaller k are its first columns, so all values of k reuse the same samples.
+"""
+
+from types import ModuleType
+
+import numpy as np
+
+import tree_code_helper
+from hop_parallel import HopOutcomeCache, sample_swap_flips
+from noise_model import NoiseModel
+from rgs_theoretical_model import prob_rgs_trial
+
+SELECTIONS = ["first", "best"]
+
+
+def select_multiplexed_attempts(attempts: np.ndarray, selection: str = "first") -> np.ndarray:
+    """`attempts` has shape (slots, hops, k); returns the kept attempt of every hop, shape (slots, hops)
+    (the first attempt if none succeeded, so the hop fails)"""
+    if selection not in SELECTIONS:
+        raise ValueError(f'selection "{selection}" is not one of {SELECTIONS}')
+    if selection == "first":
+        index = np.argmax(attempts["success"], axis=2)
+    else:
+        lost_photons = np.where(attempts["success"], attempts["lost_photons"], np.iinfo(np.int32).max)
+        index = np.argmin(lost_photons, axis=2)
+    return np.take_along_axis(attempts, index[..., np.newaxis], axis=2)[..., 0]
+
+
+def multiplexed_experiment_run(
+    slots: int,
+    number_of_hops: int,
+    m: int,
+    bv: list[int],
+    photon_loss_probability: float,
+    channel_depolarizing_error_probability: float = 0,
+    k_values: list[int] | None = None,
+    selection: str = "first",
+    decoder: ModuleType = tree_code_helper,
+    num_processes: int = 1,
+    cache: HopOutcomeCache | None = None,
+    seed: int | None = None,
+    noise_model: NoiseModel | None = None,
+    slot_duration: float | None = None,
+    show_output=True,
+) -> dict[int, dict[str, float]]:
+    """Simulate `slots` time slots of a multiplexed chain for every k in `k_values` (1, 2, 4 and 8 if None)
+    Returns: {k: {"success_probability", "conditional_error_probability" (among the successful slots),
+    "success_probability_per_attempt", "rate" (pairs per second if `slot_duration` is given, per slot otherwise),
+    "rate_per_rgs" (the same divided by the k RGSs used per hop)}}"""
+    if cache is None:
+        cache = HopOutcomeCache(num_processes, seed)
+    if k_values is None:
+        k_values = [1, 2, 4, 8]
+    k_max = max(k_values)
+    hop_outcomes = cache.get(
+        slots * number_of_hops * k_max,
+        m,
+        bv,
+        photon_loss_probability,
+        channel_depolarizing_error_probability,
+        decoder.__name__,
+        noise_model,
+    )
+    attempts = hop_outcomes.reshape(slots, number_of_hops, k_max)
+    # the swaps do not depend on the kept attempts, so all values of k share their noise
+    flip_xz, flip_zx = sample_swap_flips(slots, number_of_hops, noise_model, np.random.default_rng(seed))
+
+    results = {}
+    for k in sorted(k_values):
+        kept = select_multiplexed_attempts(attempts[:, :, :k], selection)
+        success = np.all(kept["success"], axis=1)
+        exp_xz = np.where(flip_xz, -1, 1) * np.prod(kept["exp_xz"], axis=1)
+        exp_zx = np.where(flip_zx, -1, 1) * np.prod(kept["exp_zx"], axis=1)
+        correct = success & (exp_xz == 1) & (exp_zx == 1)
+        success_count = int(np.sum(success))
+        error_count = success_count - int(np.sum(correct))
+        success_probability = success_count / slots
+        rate = success_probability / slot_duration if slot_duration is not None else success_probability
+        results[k] = {
+            "success_probability": success_probability,
+            "conditional_error_probability": error_count / success_count if success_count > 0 else np.nan,
+            "success_probability_per_attempt": float(np.mean(attempts[:, :, :k]["success"])),
+            "rate": rate,
+            "rate_per_rgs": rate / k,
+        }
+
+    if show_output:
+        loss = photon_loss_probability if noise_model is None else noise_model.effective_loss_probability(photon_loss_probability)
+        p_hop = prob_rgs_trial(m, bv, 1 - loss, 1)
+        unit = "pairs/s" if slot_duration is not None else "pairs/slot"
+        print(
+            f"multiplexed RGS protocol ({selection}) with params ({number_of_hops}, {m}, {bv}, {photon_loss_probability}) "
+            f"over {slots} slots"
+        )
+        for k, result in results.items():
+            theoretical = (1 - (1 - p_hop) ** k) ** number_of_hops
+            print(
+                f"    k = {k:<3} success {result['success_probability']:.6f} (theoretical {theoretical:.6f}), "
+                f"conditional error {result['conditional_error_probability']:.6f}, "
+                f"rate {result['rate']:.6g} {unit}, per RGS {result['rate_per_rgs']:.6g}"
+            )
+    return results
@@ -0,0 +1,261 @@
+#! usr/bin/python3
+
+"""Repeater networks: many end-user pairs routed over a graph of RGS links.
+
+A network is a graph of nodes joined by fiber links; every link is one hop of the RGS protocol with the ABSA in the middle,
+so the photons of a link of length L travel L / 2 and are lost with probability 1 - exp(-L / 2 / attenuation length).
+The requests (pairs of end users) are routed over the shortest paths (fiber length, or -log of the hop success probability
+for the most reliable path) and the network is simulated in time slots:
+    - every link draws one hop outcome per slot, from a `HopOutcomeCache` shared by all the links with the same parameters,
+      and the outcome is reused by all the paths through the link (hop composition as in `hop_parallel`, with the swap
+      noise sampled for every path);
+    - a link delivers one Bell pair per slot, so a request is served only if all the links of its path succeed and none of
+      them has been used by a request served before it in the slot (contention):
+          fixed         the requests are served in the given order every slot
+          round_robin   the order is rotated every slot
+          none          no contention, every path uses the link outcomes (the links are assumed to have enough capacity)
+Per-pair and aggregate throughputs are reported in Bell pairs per slot, or per second if the slot duration is given.
+"""
+
+import heapq
+from types import ModuleType
+
+import numpy as np
+
+import tree_code_helper
+from hop_parallel import HopOutcomeCache, sample_swap_flips
+from noise_model import NoiseModel
+from rgs_theoretical_model import photon_arrival_probability_from_km_distance, prob_rgs_trial
+
+CONTENTIONS = ["fixed", "round_robin", "none"]
+ROUTING_WEIGHTS = ["length", "reliability"]
+
+
+class NetworkTopology:
+    """Graph of repeater nodes joined by fiber links (lengths in km) for RGS protocol parameters (m, bv)"""
+
+    def __init__(self, m: int, bv: list[int], loss_db_per_km: float = 0.2):
+        self.m = m
+        self.bv = bv
+        self.loss_db_per_km = loss_db_per_km
+        self.nodes: list[str] = []
+        # (a, b) with a < b -> link index, and the links as (a, b, length)
+        self.link_index: dict[tuple[str, str], int] = {}
+        self.links: list[tuple[str, str, float]] = []
+        self.adjacency: dict[str, list[tuple[str, int]]] = {}
+
+    def add_node(self, name: str):
+        if name not in self.adjacency:
+            self.nodes.append(name)
+            self.adjacency[name] = []
+
+    def add_link(self, a: str, b: str, length_km: float):
+        if a == b:
+            raise ValueError(f"link from {a} to itself")
+        if length_km < 0:
+            raise ValueError(f"negative length of the link {a} - {b}")
+        key = (min(a, b), max(a, b))
+        if key in self.link_index:
+            raise ValueError(f"link {a} - {b} already exists")
+        self.add_node(a)
+        self.add_node(b)
+        self.link_index[key] = len(self.links)
+        self.adjacency[a].append((b, len(self.links)))
+        self.adjacency[b].append((a, len(self.links)))
+        self.links.append((a, b, length_km))
+
+    @classmethod
+    def from_edges(
+        cls, edges: list[tuple[str, str, float]], m: int, bv: list[int], loss_db_per_km: float = 0.2
+    ) -> "NetworkTopology":
+        topology = cls(m, bv, loss_db_per_km)
+        for a, b, length_km in edges:
+            topology.add_link(a, b, length_km)
+        return topology
+
+    def link_loss_probability(self, link: int) -> float:
+        """loss probability of the photons of a link, from a node to the ABSA in the middle of the link"""
+        return 1 - photon_arrival_probability_from_km_distance(self.links[link][2] / 2, self.loss_db_per_km)
+
+    def link_success_probability(self, link: int, noise_model: NoiseModel | None = None) -> float:
+        """theoretical success probability of the hop of a link (loss only, and the detector efficiency of `noise_model`)"""
+        loss = self.link_loss_probability(link)
+        if noise_model is not None:
+            loss = noise_model.effective_loss_probability(loss)
+        return prob_rgs_trial(self.m, self.bv, 1 - loss, 1)
+
+    def shortest_path(self, source: str, target: str, weight: str = "length") -> list[int]:
+        """links of the shortest path from `source` to `target` (Dijkstra), by fiber length or by reliability (-log success)"""
+        if weight not in ROUTING_WEIGHTS:
+            raise ValueError(f'routing weight "{weight}" is not one of {ROUTING_WEIGHTS}')
+        for node in [source, target]:
+            if node not in self.adjacency:
+                raise ValueError(f"unknown node {node}")
+        if source == target:
+            raise ValueError(f"request from {source} to itself")
+
+        def __weight(link: int) -> float:
+            if weight == "length":
+                return self.links[link][2]
+            success = self.link_success_probability(link)
+            return -np.log(success) if success > 0 else np.inf
+
+        distances = {source: 0.0}
+        previous: dict[str, tuple[str, int]] = {}
+        queue = [(0.0, source)]
+        done = set()
+        while len(queue) > 0:
+            distance, u = heapq.heappop(queue)
+            if u in done:
+                continue
+            if u == target:
+                break
+            done.add(u)
+            for v, link in self.adjacency[u]:
+                candidate = distance + __weight(link)
+                if candidate < distances.get(v, np.inf):
+                    distances[v] = candidate
+                    previous[v] = (u, link)
+                    heapq.heappush(queue, (candidate, v))
+        if target not in previous:
+            raise ValueError(f"no path from {source} to {target}")
+
+        path = []
+        u = target
+        while u != source:
+            u, link = previous[u]
+            path.append(link)
+        path.reverse()
+        return path
+
+
+class NetworkResult:
+    """Served Bell pairs per request of a network simulation"""
+
+    def __init__(self, requests: list[tuple[str, str]], paths: list[list[int]], slots: int, slot_duration: float | None):
+        self.requests = requests
+        self.paths = paths
+        self.slots = slots
+        self.slot_duration = slot_duration
+        self.success_counts = np.zeros(len(requests), dtype=np.int64)
+        self.correct_counts = np.zeros(len(requests), dtype=np.int64)
+        # slots in which the whole path succeeded but a link was used by another request
+        self.blocked_counts = np.zeros(len(requests), dtype=np.int64)
+        self.theoretical_success_probabilities = np.zeros(len(requests))
+
+    def __rate(self, counts) -> np.ndarray:
+        rate = np.asarray(counts) / self.slots
+        return rate / self.slot_duration if self.slot_duration is not None else rate
+
+    def throughput(self) -> np.ndarray:
+        """Bell pairs per slot (per second if the slot duration is given) of every request"""
+        return self.__rate(self.success_counts)
+
+    def correct_throughput(self) -> np.ndarray:
+        return self.__rate(self.correct_counts)
+
+    def aggregate_throughput(self) -> float:
+        return float(self.__rate(np.sum(self.success_counts)))
+
+    def summary(self) -> str:
+        unit = "pairs/s" if self.slot_duration is not None else "pairs/slot"
+        lines = []
+        for i, (source, target) in enumerate(self.requests):
+            lines.append(
+                f"    {source} - {target} ({len(self.paths[i])} links): {self.throughput()[i]:.6g} {unit} "
+                f"({self.correct_throughput()[i]:.6g} correct), success {self.success_counts[i] / self.slots:.6f} "
+                f"(without contention, theoretical {self.theoretical_success_probabilities[i]:.6f}), "
+                f"blocked {self.blocked_counts[i] / self.slots:.6f}"
+            )
+        lines.append(
+            f"    aggregate: {self.aggregate_throughput():.6g} {unit} over {len(self.requests)} requests and {self.slots} slots"
+        )
+        return "\n".join(lines)
+
+
+def simulate_network(
+    topology: NetworkTopology,
+    requests: list[tuple[str, str]],
+    slots: int,
+    channel_depolarizing_error_probability: float = 0,
+    contention: str = "round_robin",
+    routing_weight: str = "length",
+    decoder: ModuleType = tree_code_helper,
+    num_processes: int = 1,
+    cache: HopOutcomeCache | None = None,
+    seed: int | None = None,
+    noise_model: NoiseModel | None = None,
+    slot_duration: float | None = None,
+    show_output=True,
+) -> NetworkResult:
+    """Route the `requests` (pairs of end users) over the topology and simulate `slots` time slots, see the module docstring"""
+    if contention not in CONTENTIONS:
+        raise ValueError(f'contention "{contention}" is not one of {CONTENTIONS}')
+    if cache is None:
+        cache = HopOutcomeCache(num_processes, seed)
+    paths = [topology.shortest_path(source, target, routing_weight) for source, target in requests]
+    result = NetworkResult(requests, paths, slots, slot_duration)
+
+    # one outcome per slot for every link on a path; the links with the same loss share the cache entry
+    used_links = sorted({link for path in paths for link in path})
+    links_by_loss: dict[float, list[int]] = {}
+    for link in used_links:
+        links_by_loss.setdefault(topology.link_loss_probability(link), []).append(link)
+    link_success: dict[int, np.ndarray] = {}
+    link_exp_xz: dict[int, np.ndarray] = {}
+    link_exp_zx: dict[int, np.ndarray] = {}
+    for loss, links in links_by_loss.items():
+        hop_outcomes = cache.get(
+            slots * len(links),
+            topology.m,
+            topology.bv,
+            loss,
+            channel_depolarizing_error_probability,
+            decoder.__name__,
+            noise_model,
+        ).reshape(len(links), slots)
+        for link, outcomes in zip(links, hop_outcomes):
+            link_success[link] = outcomes["success"]
+            link_exp_xz[link] = outcomes["exp_xz"]
+            link_exp_zx[link] = outcomes["exp_zx"]
+
+    path_success = np.array([np.all([link_success[link] for link in path], axis=0) for path in paths]).reshape(len(paths), slots)
+    path_correct = np.zeros((len(paths), slots), dtype=bool)
+    swap_rng = np.random.default_rng(seed)
+    for i, path in enumerate(paths):
+        flip_xz, flip_zx = sample_swap_flips(slots, len(path), noise_model, swap_rng)
+        exp_xz = np.where(flip_xz, -1, 1) * np.prod([link_exp_xz[link] for link in path], axis=0)
+        exp_zx = np.where(flip_zx, -1, 1) * np.prod([link_exp_zx[link] for link in path], axis=0)
+        path_correct[i] = path_success[i] & (exp_xz == 1) & (exp_zx == 1)
+
+    served = np.zeros((len(paths), slots), dtype=bool)
+    if contention == "none":
+        served = path_success
+    else:
+        # requests served one after the other; a served request uses the Bell pairs of the links of its path
+        rotations = len(paths) if contention == "round_robin" else 1
+        slot_rotation = np.arange(slots) % rotations
+        for rotation in range(rotations):
+            in_rotation = slot_rotation == rotation
+            used = {link: np.zeros(slots, dtype=bool) for link in used_links}
+            for k in range(len(paths)):
+                i = (k + rotation) % len(paths)
+                is_free = ~np.any([used[link] for link in paths[i]], axis=0)
+                served[i] |= in_rotation & path_success[i] & is_free
+                for link in paths[i]:
+                    used[link] |= in_rotation & served[i]
+
+    result.success_counts = np.sum(served, axis=1)
+    result.correct_counts = np.sum(served & path_correct, axis=1)
+    result.blocked_counts = np.sum(path_success & ~served, axis=1)
+    result.theoretical_success_probabilities = np.array(
+        [np.prod([topology.link_success_probability(link, noise_model) for link in path]) for path in paths]
+    )
+
+    if show_output:
+        print(
+            f"RGS network with {len(topology.nodes)} nodes, {len(topology.links)} links "
+            f"and {len(requests)} requests ({contention} contention)"
+        )
+        print(result.summary())
+    return result
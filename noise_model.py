@@ -0,0 +1,119 @@
+#! usr/bin/python3
+
+"""Declarative circuit-level noise model.
+
+Besides the loss and the depolarizing channel of the photons, the quantum emitters and the detectors are noisy:
+    single_qubit_gate_depolarizing  depolarizing after every single-qubit gate on an emitter
+    two_qubit_gate_depolarizing     two-qubit depolarizing after every CZ between emitters (or an emitter and a memory)
+    emission_depolarizing           two-qubit depolarizing on (emitter, photon) after every photon emission (CX)
+    emitter_measurement_flip        probability that an emitter (or memory) measurement result is flipped
+    photon_measurement_flip         probability that a photon measurement result is flipped
+    photon_depolarizing             depolarizing channel of the photons (composed with the channel of the engine)
+    detector_efficiency             probability that an arrived photon is detected, a missed photon counts as lost
+The `apply_*` methods take target lists and issue a single stim noise-channel call per list (nothing if the noise is off),
+so the engines inject the noise wherever they already act on several qubits at once.
+
+The engines do not prepare the trees with the same circuit, so the gate and emission noise do not act at the same places:
+    rgs_engine  the photons are emitted one by one by the emitters: `emission_depolarizing` on every (emitter, photon) pair,
+                inner photons included, and `two_qubit_gate_depolarizing` on the CZs between the emitters
+    rgs.py      the trees are prepared as graph states of the photons: `emission_depolarizing` on the outer photon only and
+                `two_qubit_gate_depolarizing` on the CZ of every tree edge (between photons)
+The photon channel, the measurement flips and the detector efficiency are the same in both, so the engines agree when only
+those are on, while the same gate and emission noise gives different physical noise on the inner qubits.
+The entanglement swaps between the hops (CZ and H on two memories, then their measurement) only see the gate noise and the
+emitter measurement flips, which flip the swap results; `hop_parallel` (and `multiplexing`, `network_topology`) do not
+simulate the swaps and sample these flips classically instead (`hop_parallel.sample_swap_flips`).
+"""
+
+
+def compose_depolarizing(p1: float, p2: float) -> float:
+    """probability of the single-qubit depolarizing channel equivalent to two channels applied one after the other"""
+    return p1 + p2 - 4 * p1 * p2 / 3
+
+
+class NoiseModel:
+    PARAMETERS = [
+        "single_qubit_gate_depolarizing",
+        "two_qubit_gate_depolarizing",
+        "emission_depolarizing",
+        "emitter_measurement_flip",
+        "photon_measurement_flip",
+        "photon_depolarizing",
+        "detector_efficiency",
+    ]
+
+    def __init__(
+        self,
+        single_qubit_gate_depolarizing: float = 0,
+        two_qubit_gate_depolarizing: float = 0,
+        emission_depolarizing: float = 0,
+        emitter_measurement_flip: float = 0,
+        photon_measurement_flip: float = 0,
+        photon_depolarizing: float = 0,
+        detector_efficiency: float = 1,
+    ):
+        self.single_qubit_gate_depolarizing = single_qubit_gate_depolarizing
+        self.two_qubit_gate_depolarizing = two_qubit_gate_depolarizing
+        self.emission_depolarizing = emission_depolarizing
+        self.emitter_measurement_flip = emitter_measurement_flip
+        self.photon_measurement_flip = photon_measurement_flip
+        self.photon_depolarizing = photon_depolarizing
+        self.detector_efficiency = detector_efficiency
+        for name in self.PARAMETERS:
+            if not 0 <= getattr(self, name) <= 1:
+                raise ValueError(f"{name} = {getattr(self, name)} is not a probability")
+
+    @classmethod
+    def from_dict(cls, parameters: dict) -> "NoiseModel":
+        unknown = [name for name in parameters if name not in cls.PARAMETERS]
+        if len(unknown) > 0:
+            raise ValueError(f"unknown noise parameter(s) {unknown}")
+        return cls(**parameters)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.PARAMETERS}
+
+    def is_noiseless(self) -> bool:
+        noiseless = all(getattr(self, name) == 0 for name in self.PARAMETERS if name != "detector_efficiency")
+        return noiseless and self.detector_efficiency == 1
+
+    def effective_loss_probability(self, loss_probability: float) -> float:
+        """probability that a photon is not detected, lost in the fiber or missed by the detector"""
+        return 1 - (1 - loss_probability) * self.detector_efficiency
+
+    def apply_single_qubit_gate_noise(self, t, *targets: int):
+        if self.single_qubit_gate_depolarizing > 0:
+            t.depolarize1(*targets, p=self.single_qubit_gate_depolarizing)
+
+    def apply_two_qubit_gate_noise(self, t, *pairs: int):
+        """`pairs` is the flattened list of the pairs of qubits the gates acted on"""
+        if self.two_qubit_gate_depolarizing > 0:
+            t.depolarize2(*pairs, p=self.two_qubit_gate_depolarizing)
+
+    def apply_emission_noise(self, t, *pairs: int):
+        """`pairs` is the flattened list of (emitter, photon) pairs"""
+        if self.emission_depolarizing > 0:
+            t.depolarize2(*pairs, p=self.emission_depolarizing)
+
+    def apply_emitter_measurement_noise(self, t, *targets: int):
+        """to be called right before the Z-basis measurement of the targets"""
+        if self.emitter_measurement_flip > 0:
+            t.x_error(*targets, p=self.emitter_measurement_flip)
+
+    def apply_photon_measurement_noise(self, t, *targets: int):
+        """to be called right before the Z-basis measurement of the targets"""
+        if self.photon_measurement_flip > 0:
+            t.x_error(*targets, p=self.photon_measurement_flip)
+
+    def apply_deferred_photon_measurement_noise(self, t, *targets: int):
+        """measurement flips of photons measured later in the X or Z basis with only single-qubit gates in between;
+        a Y error anticommutes with both bases, so it flips the result whichever basis is chosen"""
+        if self.photon_measurement_flip > 0:
+            t.y_error(*targets, p=self.photon_measurement_flip)
+
+    def apply_photon_channel_noise(self, t, *targets: int):
+        if self.photon_depolarizing > 0:
+            t.depolarize1(*targets, p=self.photon_depolarizing)
+
+    def __repr__(self) -> str:
+        return f"NoiseModel({', '.join(f'{name}={getattr(self, name)}' for name in self.PARAMETERS)})"
@@ -5,18 +5,30 @@ import random
 import numpy as np
 import stim
 
+from absa_policy import ArmSelectionPolicy, select_bsm_arm
+from fidelity_readout import BellStateReadout, peek_bell_correlators, reduced_two_qubit_state
 from node_qubit import Node, Pauli
+from noise_model import NoiseModel
+from rgs import RGS, HalfRGS
 from test_helper import verify_vertex_stabilizer
-from tree_code_helper import decode_tree_logical_x, decode_tree_logical_z
+from tree_code_helper import decode_tree_logical_x, decode_tree_logical_z, tree_code_physical_measure
 
 
-def measurements_at_absa(t: stim.TableauSimulator, m: int, left_halfs: list[Node], right_halfs: list[Node]) -> int:
-    """measurement of all qubits in the RGS (step 1) and return the index of the arm that has a successful BSM"""
+def measurements_at_absa(
+    t: stim.TableauSimulator,
+    m: int,
+    left_halfs: list[Node],
+    right_halfs: list[Node],
+    policy: ArmSelectionPolicy = ArmSelectionPolicy.FIRST_SUCCESS,
+    noise_model: NoiseModel | None = None,
+) -> int:
+    """measurement of all qubits in the RGS (step 1) and return the index of the arm that has a successful BSM
+    the arm is chosen among the successful BSMs according to `policy`"""
     if m != len(left_halfs) or m != len(right_halfs):
         ValueError(f"number of arms {m} does not equal the input length of list of two halves {len(left_halfs)}, {len(right_halfs)}")
 
     # BSM part (outer qubit measurements)
-    success_arm_index = -1
+    bsm_successes = [False] * m
     for i in range(m):
         unode = left_halfs[i]
         vnode = right_halfs[i]
@@ -28,13 +40,15 @@ def measurements_at_absa(t: stim.TableauSimulator, m: int, left_halfs: list[Node
         v = vnode.qubit_index
         t.cz(u, v)
         t.h(u, v)
+        if noise_model is not None:
+            noise_model.apply_photon_measurement_noise(t, u, v)
         unode.measurement_result = unode.eigenvalue = t.measure(u)
         vnode.measurement_result = vnode.eigenvalue = t.measure(v)
         unode.measurement_basis = vnode.measurement_basis = Pauli.X
 
         # simulating linear optics; consider +1/-1 and -1/+1 to be the two case ABSAs can distinguish
-        if success_arm_index == -1 and (unode.measurement_result != vnode.measurement_result):
-            success_arm_index = i
+        bsm_successes[i] = unode.measurement_result != vnode.measurement_result
+    success_arm_index = select_bsm_arm(policy, bsm_successes, left_halfs, right_halfs)
 
     # inner qubits measurements
     for i in range(m):
@@ -95,9 +109,18 @@ def experiment_setup(
     loss_probability: float = 0,
     # photon_error_probability: float = 0,
     # emitter_error_probability: float = 0,
-) -> tuple[bool, int, int]:
+    readout: BellStateReadout | None = None,
+    return_reduced_state: bool = False,
+    policy: ArmSelectionPolicy = ArmSelectionPolicy.FIRST_SUCCESS,
+    noise_model: NoiseModel | None = None,
+) -> tuple[bool, int | None, int | None, np.ndarray | None, tuple[bool, bool] | None]:
     """One run of the biclique RGS protocol
-    Return: success-or-failure of the trial (bool), expectation value of ZX, expectation value of XZ at the end between Alice and Bob"""
+    Only the Alice-Bob correlators are read out at the end (and accumulated into `readout` if given);
+    the reduced two-qubit state of Alice and Bob is reconstructed only when `return_reduced_state` is set.
+    `policy` decides which arm is kept at an ABSA when several BSMs succeed.
+    The emitters, photons and detectors are noisy according to `noise_model` if given.
+    Return: success-or-failure of the trial (bool), expectation value of XZ, expectation value of ZX at the end
+    between Alice and Bob, reduced state of Alice and Bob (or None), total parity applied at the end nodes"""
     global total_photons, lost_photons
     # Ancilla qubits we require (total 4)
     #   temporary anchor for tree encoding: 1 (ancilla[0])
@@ -128,15 +151,15 @@ def experiment_setup(
     # RGS creation
     t = stim.TableauSimulator()
     for rgs in rgss:
-        rgs.initialize_quantum_state(t, anchor_left, anchor_right, outer_emitter, root_id)
-    half_alice.initialize_quantum_state(t, outer_emitter, root_id)
-    half_bob.initialize_quantum_state(t, outer_emitter, root_id)
+        rgs.initialize_quantum_state(t, anchor_left, anchor_right, outer_emitter, root_id, noise_model)
+    half_alice.initialize_quantum_state(t, outer_emitter, root_id, noise_model)
+    half_bob.initialize_quantum_state(t, outer_emitter, root_id, noise_model)
 
     # process photon loss
     for rgs in rgss:
-        rgs.process_photon_loss(t, loss_probability, rng)
-    half_alice.process_photon_loss(t, loss_probability, rng)
-    half_bob.process_photon_loss(t, loss_probability, rng)
+        rgs.process_photon_loss(t, loss_probability, rng, noise_model)
+    half_alice.process_photon_loss(t, loss_probability, rng, noise_model)
+    half_bob.process_photon_loss(t, loss_probability, rng, noise_model)
 
     # Debugging, check how many photon got lost
     for rgs in rgss:
@@ -153,16 +176,16 @@ def experiment_setup(
     # (Protocol step 1) ABSA measurements
     success_bsm_indices = [-1] * number_of_hops  # number of ABSAs in the repeater chain
     for i in range(len(rgss) - 1):
-        success_bsm_indices[i + 1] = measurements_at_absa(t, m, rgss[i].right_arms, rgss[i + 1].left_arms)
+        success_bsm_indices[i + 1] = measurements_at_absa(t, m, rgss[i].right_arms, rgss[i + 1].left_arms, policy, noise_model)
         rgss[i].successful_right_arm_index = rgss[i + 1].successful_left_arm_index = success_bsm_indices[i + 1]
     if len(rgss) > 0:
-        success_bsm_indices[0] = measurements_at_absa(t, m, half_alice.arms, rgss[0].left_arms)
-        success_bsm_indices[-1] = measurements_at_absa(t, m, rgss[-1].right_arms, half_bob.arms)
+        success_bsm_indices[0] = measurements_at_absa(t, m, half_alice.arms, rgss[0].left_arms, policy, noise_model)
+        success_bsm_indices[-1] = measurements_at_absa(t, m, rgss[-1].right_arms, half_bob.arms, policy, noise_model)
         rgss[0].successful_left_arm_index = half_alice.successful_arm_index = success_bsm_indices[0]
         rgss[-1].successful_right_arm_index = half_bob.successful_arm_index = success_bsm_indices[-1]
     else:
         # special case for 1 hop (no RGSS source nodes)
-        success_bsm_indices[0] = measurements_at_absa(t, m, half_alice.arms, half_bob.arms)
+        success_bsm_indices[0] = measurements_at_absa(t, m, half_alice.arms, half_bob.arms, policy, noise_model)
         half_alice.successful_arm_index = half_bob.successful_arm_index = success_bsm_indices[0]
 
     # print(success_bsm_indices)
@@ -213,4 +236,10 @@ def experiment_setup(
     if total_parity[1]:
         t.z(bob)
 
-    return True, t.peek_observable_expectation(stim.PauliString("XZ")), t.peek_observable_expectation(stim.PauliString("ZX")), t.canonical_stabilizers(), total_parity
\ No newline at end of file
+    if readout is not None:
+        exp_xz, exp_zx, _ = readout.record(t)
+    else:
+        exp_xz, exp_zx, _ = peek_bell_correlators(t, alice, bob)
+    reduced_state = reduced_two_qubit_state(t, alice, bob) if return_reduced_state else None
+
+    return True, exp_xz, exp_zx, reduced_state, total_parity
\ No newline at end of file
@@ -0,0 +1,136 @@
+#! usr/bin/python3
+
+"""Seeded regression checks of the equivalences between the code paths of the engine.
+
+Every check runs the same seeded trials through two code paths and requires exactly the same outcomes (not only the same
+statistics), trial by trial:
+    streaming       decoding the inner qubits while they are emitted (`streaming_decoder`) vs decoding the stored trees
+    lookup          `lookup_tree_code_helper` (bitmasks built at emission) vs `tree_code_helper`, also with emission schedules
+    prescreen       classical pre-screening vs simulating the trials with all hops presampled the same way (`presample_all_hops`),
+                    including the BSM arms and the lost photons recorded by `trial_recorder`
+Each trial gets its own seed for the stim simulator and the random generator, so a failing trial can be re-run on its own.
+Run `python regression_checks.py`; a mismatch raises a RuntimeError naming the check, the grid point and the trial seed.
+"""
+
+import sys
+
+import numpy as np
+import stim
+
+import lookup_tree_code_helper
+import tree_code_helper
+from absa_policy import ArmSelectionPolicy
+from emission_schedule import EmissionSchedule, compile_emission_schedule
+from rgs_config import RgsConfig
+from rgs_engine import rgs_protocol_trial
+
+# (number_of_hops, m, bv, loss, depo), small enough to run in seconds
+CHECK_GRID = [
+    (1, 3, [2, 2], 0.1, 0),
+    (2, 2, [3, 2], 0.2, 0.02),
+    (3, 3, [2, 2, 2], 0.15, 0),
+]
+
+
+def helper_trial_config(
+    point: tuple, trial_seed: int, streaming: bool = False, emission_schedule: EmissionSchedule | None = None
+) -> RgsConfig:
+    number_of_hops, m, bv, loss, depo = point
+    conf = RgsConfig(
+        number_of_hops,
+        m,
+        bv,
+        loss,
+        depo,
+        stim.TableauSimulator(seed=trial_seed),
+        np.random.default_rng(trial_seed),
+        num_emitters=emission_schedule.num_emitters if emission_schedule is not None else None,
+        streaming=streaming,
+    )
+    conf.emission_schedule = emission_schedule
+    return conf
+
+
+def helper_compare_trials(check: str, run_a, run_b, grid: list[tuple], shots: int, seed: int, show_output=True) -> int:
+    """run `shots` seeded trials of every grid point with both `run_a` and `run_b` (functions of the grid point and the trial
+    seed returning the outcome of the trial) and raise a RuntimeError at the first different outcome
+    Returns: the number of trials compared"""
+    for i, point in enumerate(grid):
+        trial_seeds = np.random.SeedSequence([seed, i]).generate_state(shots, dtype=np.uint64)
+        for trial_seed in map(int, trial_seeds):
+            outcome_a, outcome_b = run_a(point, trial_seed), run_b(point, trial_seed)
+            if outcome_a != outcome_b:
+                raise RuntimeError(f"{check}: trial {trial_seed} of {point} gives {outcome_a} and {outcome_b}")
+        if show_output:
+            print(f"    {check} {point}: {shots} trials identical")
+    return len(grid) * shots
+
+
+def check_streaming_decoding(grid: list[tuple] = CHECK_GRID, shots: int = 200, seed: int = 0, show_output=True) -> int:
+    """streaming and tree decoding give the same trials, with the decisions of `tree_code_helper` (also the lookup decoder);
+    the logical results are compared for the successful trials (a failed trial stops before all of them are known)"""
+
+    def __run(decoder, streaming: bool):
+        def __trial(point: tuple, trial_seed: int):
+            conf = helper_trial_config(point, trial_seed, streaming)
+            is_successful, is_correct = rgs_protocol_trial(conf, decoder)
+            return is_successful, is_correct, conf.logical_results if is_successful else None
+
+        return __trial
+
+    compared = 0
+    for decoder in [tree_code_helper, lookup_tree_code_helper]:
+        check = f"streaming ({decoder.__name__})"
+        compared += helper_compare_trials(check, __run(decoder, False), __run(decoder, True), grid, shots, seed, show_output)
+    return compared
+
+
+def check_lookup_decoder(grid: list[tuple] = CHECK_GRID, shots: int = 200, seed: int = 0, show_output=True) -> int:
+    """the lookup decoder, decoding from the bitmasks built at emission, gives the same trials and logical results as
+    `tree_code_helper`, with the recursive generation of the inner qubits and with a compiled emission schedule"""
+
+    def __run(decoder, with_schedule: bool):
+        def __trial(point: tuple, trial_seed: int):
+            emission_schedule = compile_emission_schedule(point[2]) if with_schedule else None
+            conf = helper_trial_config(point, trial_seed, emission_schedule=emission_schedule)
+            is_successful, is_correct = rgs_protocol_trial(conf, decoder)
+            return is_successful, is_correct, conf.logical_results
+
+        return __trial
+
+    compared = 0
+    for with_schedule in [False, True]:
+        check = "lookup" + (" (emission schedule)" if with_schedule else "")
+        run_a, run_b = __run(tree_code_helper, with_schedule), __run(lookup_tree_code_helper, with_schedule)
+        compared += helper_compare_trials(check, run_a, run_b, grid, shots, seed, show_output)
+    return compared
+
+
+def check_prescreening(grid: list[tuple] = CHECK_GRID, shots: int = 200, seed: int = 0, show_output=True) -> int:
+    """the pre-screening only skips the simulation of the failing trials: the hops are presampled in the same order as with
+    `presample_all_hops`, so both give the same trials, BSM arms and lost photons per hop (up to the first failed BSM)"""
+
+    def __run(policy: ArmSelectionPolicy, prescreen: bool):
+        def __trial(point: tuple, trial_seed: int):
+            conf = helper_trial_config(point, trial_seed)
+            is_successful, is_correct = rgs_protocol_trial(conf, tree_code_helper, None, policy, not prescreen, prescreen)
+            return is_successful, is_correct, conf.succeeded_bsm_arm_indices, conf.lost_photons_per_hop
+
+        return __trial
+
+    compared = 0
+    for policy in [ArmSelectionPolicy.FIRST_SUCCESS, ArmSelectionPolicy.MAX_DECODABILITY]:
+        check = f"prescreen ({policy.name})"
+        compared += helper_compare_trials(check, __run(policy, False), __run(policy, True), grid, shots, seed, show_output)
+    return compared
+
+
+def main() -> int:
+    check_streaming_decoding()
+    check_lookup_decoder()
+    check_prescreening()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+#! usr/bin/python3
+
+"""Response surface of the success and error rates over the parameter space.
+
+Simulated points (shots, successful trials, successful trials with the correct Bell pair), e.g., the JSON lines written by
+`rgs_sweep`, are stored per configuration (number_of_hops, m, bv) on a grid of (loss, depolarizing) probabilities.
+A query at any (loss, depolarizing) is answered from the stored points:
+    simulated       the point itself, with its Wilson confidence interval
+    interpolated    bilinear interpolation inside a cell of the grid (or linear along a grid line);
+                    the success probability is interpolated relative to `prob_rgs_trial`, which carries most of the loss
+                    dependence, and the binomial variances of the corners are propagated through the weights
+    theoretical     `prob_rgs_trial` where there is no data (the error rate is 0 without depolarizing, unknown otherwise);
+                    nothing was simulated, so the intervals are None (unknown) rather than claiming certainty
+Only the statistical uncertainty of the simulated points is quantified, not the interpolation error.
+The queries are remembered so that `refinement_suggestions` can rank the stored points by how much more shots would
+reduce the variance of the answers, and list the queried configurations without data.
+"""
+
+import bisect
+import json
+import math
+
+from rgs_theoretical_model import prob_rgs_trial
+
+# z-score of the 95% confidence intervals
+CONFIDENCE_Z = 1.959963984540054
+
+
+def wilson_interval(k: int, n: int, z: float = CONFIDENCE_Z) -> tuple[float, float]:
+    """Wilson score interval of a binomial proportion k/n"""
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half_width = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def helper_binomial_variance(k: int, n: int, z: float = CONFIDENCE_Z) -> float:
+    """variance of the proportion k/n, with the Wilson center as the proportion so that it does not vanish at 0 or n"""
+    if n == 0:
+        return 0.25
+    p = (k + z * z / 2) / (n + z * z)
+    return p * (1 - p) / n
+
+
+class SurfaceEstimate:
+    """Answer of a response-surface query (the error rate is among the successful trials, None if unknown;
+    the intervals are None if the uncertainty is unknown)"""
+
+    def __init__(
+        self,
+        source: str,
+        success_probability: float,
+        success_interval: tuple[float, float] | None,
+        error_probability: float | None,
+        error_interval: tuple[float, float] | None,
+    ):
+        self.source = source
+        self.success_probability = success_probability
+        self.success_interval = success_interval
+        self.error_probability = error_probability
+        self.error_interval = error_interval
+
+    def __repr__(self) -> str:
+        success_interval = "(interval unknown)" if self.success_interval is None else self.success_interval
+        error_interval = "(interval unknown)" if self.error_interval is None else self.error_interval
+        error = "unknown" if self.error_probability is None else f"{self.error_probability:.6g} {error_interval}"
+        return f"SurfaceEstimate({self.source}: success {self.success_probability:.6g} {success_interval}, error {error})"
+
+
+class ResponseSurface:
+    """Simulated points per configuration (number_of_hops, m, bv) on a (loss, depolarizing) grid, see the module docstring"""
+
+    def __init__(self, z: float = CONFIDENCE_Z):
+        self.z = z
+        # configuration -> {(loss, depo): [shots, success_count, no_error_count]}
+        self.points: dict[tuple[int, int, tuple[int, ...]], dict[tuple[float, float], list[int]]] = {}
+        # configuration -> (sorted losses, sorted depolarizing probabilities), rebuilt after new points
+        self.__axes: dict[tuple[int, int, tuple[int, ...]], tuple[list[float], list[float]]] = {}
+        # query statistics: (configuration, grid point) -> sum of the squared interpolation weights of the queries
+        self.query_weights: dict[tuple[tuple[int, int, tuple[int, ...]], tuple[float, float]], float] = {}
+        # queried configurations and points answered by the theoretical model -> number of queries
+        self.missing_queries: dict[tuple[int, int, tuple[int, ...], float, float], int] = {}
+
+    def add_point(
+        self,
+        number_of_hops: int,
+        m: int,
+        bv: list[int],
+        loss: float,
+        depo: float,
+        shots: int,
+        success_count: int,
+        no_error_count: int,
+    ):
+        """add simulated counts, merged with the counts already stored at the same point"""
+        if not 0 <= no_error_count <= success_count <= shots:
+            raise ValueError(f"inconsistent counts: {no_error_count} correct of {success_count} successful in {shots} shots")
+        configuration = (number_of_hops, m, tuple(bv))
+        counts = self.points.setdefault(configuration, {}).setdefault((loss, depo), [0, 0, 0])
+        counts[0] += shots
+        counts[1] += success_count
+        counts[2] += no_error_count
+        self.__axes.pop(configuration, None)
+
+    def add_result(self, result: dict):
+        """add one result of `rgs_sweep` (one line of its output file)"""
+        self.add_point(
+            result["number_of_hops"],
+            result["m"],
+            result["bv"],
+            result["loss_probability"],
+            result["depolarizing_error_probability"],
+            result["shots"],
+            result["success_count"],
+            result["no_error_count"],
+        )
+
+    def load_jsonl(self, path: str, decoder: str | None = None) -> int:
+        """add the results of a JSON lines file of `rgs_sweep` (only those of `decoder` if given)
+        returns the number of results added"""
+        added = 0
+        with open(path) as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                result = json.loads(line)
+                if decoder is not None and result.get("decoder") != decoder:
+                    continue
+                self.add_result(result)
+                added += 1
+        return added
+
+    def __get_axes(self, configuration) -> tuple[list[float], list[float]]:
+        axes = self.__axes.get(configuration)
+        if axes is None:
+            grid = self.points[configuration]
+            axes = self.__axes[configuration] = sorted({loss for loss, _ in grid}), sorted({depo for _, depo in grid})
+        return axes
+
+    def __interpolation_weights(self, configuration, loss: float, depo: float) -> list[tuple[tuple[float, float], float]] | None:
+        """grid points and bilinear weights around (loss, depo), None if a needed grid point is missing or outside the grid"""
+        grid = self.points[configuration]
+        losses, depos = self.__get_axes(configuration)
+        brackets = []
+        for axis, value in [(losses, loss), (depos, depo)]:
+            i = bisect.bisect_left(axis, value)
+            if i < len(axis) and axis[i] == value:
+                brackets.append([(axis[i], 1.0)])
+            elif i == 0 or i == len(axis):
+                return None
+            else:
+                fraction = (value - axis[i - 1]) / (axis[i] - axis[i - 1])
+                brackets.append([(axis[i - 1], 1 - fraction), (axis[i], fraction)])
+        weights = [
+            ((point_loss, point_depo), loss_weight * depo_weight)
+            for point_loss, loss_weight in brackets[0]
+            for point_depo, depo_weight in brackets[1]
+            if loss_weight * depo_weight > 0
+        ]
+        if any(point not in grid for point, _ in weights):
+            return None
+        return weights
+
+    def query(self, number_of_hops: int, m: int, bv: list[int], loss: float, depo: float) -> SurfaceEstimate:
+        configuration = (number_of_hops, m, tuple(bv))
+        theoretical = prob_rgs_trial(m, bv, 1 - loss, number_of_hops)
+        weights = self.__interpolation_weights(configuration, loss, depo) if configuration in self.points else None
+        if weights is None:
+            key = (number_of_hops, m, tuple(bv), loss, depo)
+            self.missing_queries[key] = self.missing_queries.get(key, 0) + 1
+            return SurfaceEstimate("theoretical", theoretical, None, 0.0 if depo == 0 else None, None)
+
+        grid = self.points[configuration]
+        for point, w in weights:
+            self.query_weights[(configuration, point)] = self.query_weights.get((configuration, point), 0.0) + w * w
+        if len(weights) == 1:
+            shots, success_count, no_error_count = grid[weights[0][0]]
+            error_count = success_count - no_error_count
+            return SurfaceEstimate(
+                "simulated",
+                success_count / shots,
+                wilson_interval(success_count, shots, self.z),
+                error_count / success_count if success_count > 0 else None,
+                wilson_interval(error_count, success_count, self.z) if success_count > 0 else None,
+            )
+
+        # success probability relative to the theoretical model, falling back to plain interpolation if the model vanishes
+        success, success_variance = 0.0, 0.0
+        error, error_variance, error_known = 0.0, 0.0, True
+        for (point_loss, point_depo), w in weights:
+            shots, success_count, no_error_count = grid[(point_loss, point_depo)]
+            point_theoretical = prob_rgs_trial(m, bv, 1 - point_loss, number_of_hops)
+            scale = theoretical / point_theoretical if point_theoretical > 0 and theoretical > 0 else 1.0
+            success += w * scale * success_count / shots
+            success_variance += (w * scale) ** 2 * helper_binomial_variance(success_count, shots, self.z)
+            if success_count == 0:
+                error_known = False
+                continue
+            error += w * (success_count - no_error_count) / success_count
+            error_variance += w * w * helper_binomial_variance(success_count - no_error_count, success_count, self.z)
+
+        half_width = self.z * math.sqrt(success_variance)
+        success = min(1.0, max(0.0, success))
+        error_half_width = self.z * math.sqrt(error_variance)
+        return SurfaceEstimate(
+            "interpolated",
+            success,
+            (max(0.0, success - half_width), min(1.0, success + half_width)),
+            error if error_known else None,
+            (max(0.0, error - error_half_width), min(1.0, error + error_half_width)) if error_known else None,
+        )
+
+    def refinement_suggestions(self, count: int = 5, additional_shots: int | None = None) -> list[dict]:
+        """The stored points where `additional_shots` more shots (as many as already simulated if None) would most reduce
+        the variance of the success probabilities of the queries so far, followed by the most queried points without data
+        (at most `count` of each)"""
+        suggestions = []
+        for (configuration, point), squared_weight in self.query_weights.items():
+            shots, success_count, _ = self.points[configuration][point]
+            extra = shots if additional_shots is None else additional_shots
+            reduction = squared_weight * helper_binomial_variance(success_count, shots, self.z) * extra / (shots + extra)
+            number_of_hops, m, bv = configuration
+            suggestions.append(
+                {
+                    "number_of_hops": number_of_hops,
+                    "m": m,
+                    "bv": list(bv),
+                    "loss_probability": point[0],
+                    "depolarizing_error_probability": point[1],
+                    "shots": shots,
+                    "additional_shots": extra,
+                    "variance_reduction": reduction,
+                }
+            )
+        suggestions.sort(key=lambda suggestion: suggestion["variance_reduction"], reverse=True)
+        missing_suggestions = []
+        missing_queries = sorted(self.missing_queries.items(), key=lambda item: item[1], reverse=True)
+        for (number_of_hops, m, bv, loss, depo), queries in missing_queries:
+            configuration = (number_of_hops, m, bv)
+            if configuration in self.points and self.__interpolation_weights(configuration, loss, depo) is not None:
+                # covered by points added since
+                continue
+            missing_suggestions.append(
+                {
+                    "number_of_hops": number_of_hops,
+                    "m": m,
+                    "bv": list(bv),
+                    "loss_probability": loss,
+                    "depolarizing_error_probability": depo,
+                    "shots": 0,
+                    "queries": queries,
+                }
+            )
+        return suggestions[:count] + missing_suggestions[:count]
@@ -6,6 +6,7 @@ import numpy as np
 import stim
 
 from node_qubit import Node, Pauli
+from noise_model import NoiseModel
 from test_helper import verify_vertex_stabilizer
 from tree_code_helper import decode_tree_logical_x, decode_tree_logical_z
 
@@ -28,27 +29,40 @@ def helper_assign_qubit_indices(root: Node, bv: list[int], starting_index: int)
     return cur_index
 
 
-def helper_initialize_rgs_arm(t: stim.TableauSimulator, root: Node, anchor: int, outer_emitter: int, root_ancilla: int) -> bool:
+def helper_initialize_rgs_arm(
+    t: stim.TableauSimulator,
+    root: Node,
+    anchor: int,
+    outer_emitter: int,
+    root_ancilla: int,
+    noise_model: NoiseModel | None = None,
+) -> bool:
     # return whether the anchor should be flipped or not (side effects to the anchor)
+    noise = noise_model if noise_model is not None else NoiseModel()
+    # the stabilizers can only be verified without noise
+    verify = noise.is_noiseless()
+
     # generate outer qubit
     t.reset(outer_emitter, root_ancilla)
     t.h(root.qubit_index, outer_emitter)
     t.cz(root.qubit_index, outer_emitter)
+    noise.apply_emission_noise(t, outer_emitter, root.qubit_index)
 
-    # generate inner qubit tree
+    # generate inner qubit tree, one batched call per level for the gates and their noise
     t.h(root_ancilla)
     queue = root.children  # nodes in the first level
-    for u in queue:
-        t.h(u.qubit_index)
-        t.cz(root_ancilla, u.qubit_index)
+    pairs = [q for u in queue for q in (root_ancilla, u.qubit_index)]
+    t.h(*[u.qubit_index for u in queue])
+    t.cz(*pairs)
+    noise.apply_two_qubit_gate_noise(t, *pairs)
     # assuming that the anchor is already has Hadamard applied
     while len(queue) > 0:
-        temp_queue = []
-        for u in queue:
-            for v in u.children:
-                t.h(v.qubit_index)
-                t.cz(u.qubit_index, v.qubit_index)
-                temp_queue.append(v)
+        temp_queue = [v for u in queue for v in u.children]
+        if len(temp_queue) > 0:
+            pairs = [q for u in queue for v in u.children for q in (u.qubit_index, v.qubit_index)]
+            t.h(*[v.qubit_index for v in temp_queue])
+            t.cz(*pairs)
+            noise.apply_two_qubit_gate_noise(t, *pairs)
         queue = temp_queue
 
     # add random side effects to nodes in the tree except the leaves
@@ -65,12 +79,16 @@ def helper_initialize_rgs_arm(t: stim.TableauSimulator, root: Node, anchor: int,
         queue = temp_queue
 
     # verify anchor stabilizer
-    verify_vertex_stabilizer(t, root_ancilla, [u.qubit_index for u in root.children], 1)
+    if verify:
+        verify_vertex_stabilizer(t, root_ancilla, [u.qubit_index for u in root.children], 1)
 
     # join inner and outer qubits
     t.cz(anchor, outer_emitter)
     t.cz(root_ancilla, outer_emitter)
+    noise.apply_two_qubit_gate_noise(t, anchor, outer_emitter, root_ancilla, outer_emitter)
     t.h(outer_emitter, root_ancilla)
+    noise.apply_single_qubit_gate_noise(t, outer_emitter, root_ancilla)
+    noise.apply_emitter_measurement_noise(t, outer_emitter, root_ancilla)
     meas_outer = t.measure(outer_emitter)
     meas_root = t.measure(root_ancilla)
     if meas_outer:
@@ -83,15 +101,25 @@ def helper_initialize_rgs_arm(t: stim.TableauSimulator, root: Node, anchor: int,
         root.has_z = not root.has_z
 
     assert meas_root == root.has_z
-    verify_vertex_stabilizer(t, root.qubit_index, [u.qubit_index for u in root.children], -1 if root.has_z else 1)
+    if verify:
+        verify_vertex_stabilizer(t, root.qubit_index, [u.qubit_index for u in root.children], -1 if root.has_z else 1)
 
     return meas_root
 
 
-def helper_process_photon_loss(t: stim.TableauSimulator, root: Node, loss_probability: float, rng: np.random.Generator):
+def helper_process_photon_loss(
+    t: stim.TableauSimulator, root: Node, loss_probability: float, rng: np.random.Generator, noise_model: NoiseModel | None = None
+):
     """traverse the tree and apply loss probability to all qubits
     If a qubit is lost, randomly select Pauli X, Y, or Z to apply followed by a measurement in the Z basis.
+    With a noise model, the channel and the measurement flips of all photons of the tree are applied in one batched call each
+    (the flips of the outer photon are applied at the BSM), and the detector efficiency adds to the loss.
     """
+    if noise_model is not None:
+        photons = [u.qubit_index for u in root.get_postorder_traversal()]
+        noise_model.apply_photon_channel_noise(t, *photons)
+        noise_model.apply_deferred_photon_measurement_noise(t, *photons[:-1])
+        loss_probability = noise_model.effective_loss_probability(loss_probability)
     queue = [root]
     while len(queue) > 0:
         temp_queue = []
@@ -140,24 +168,31 @@ class HalfRGS:
             cur_index = helper_assign_qubit_indices(root, self.bv, cur_index)
         return cur_index
 
-    def initialize_quantum_state(self, t: stim.TableauSimulator, outer_emitter: int, root_ancilla: int):
+    def initialize_quantum_state(
+        self, t: stim.TableauSimulator, outer_emitter: int, root_ancilla: int, noise_model: NoiseModel | None = None
+    ):
         anchor_has_z = False
         t.h(self.anchor)
         for root in self.arms:
-            anchor_has_z = anchor_has_z ^ helper_initialize_rgs_arm(t, root, self.anchor, outer_emitter, root_ancilla)
+            anchor_has_z = anchor_has_z ^ helper_initialize_rgs_arm(
+                t, root, self.anchor, outer_emitter, root_ancilla, noise_model
+            )
         if anchor_has_z:
             t.z(self.anchor)
-        first_level_qubits = []
-        for root in self.arms:
-            first_level_qubits.extend([u.qubit_index for u in root.children])
-        verify_vertex_stabilizer(t, self.anchor, first_level_qubits, 1)
+        if noise_model is None or noise_model.is_noiseless():
+            first_level_qubits = []
+            for root in self.arms:
+                first_level_qubits.extend([u.qubit_index for u in root.children])
+            verify_vertex_stabilizer(t, self.anchor, first_level_qubits, 1)
 
     def get_bsm_arm(self) -> Node:
         return self.arms[self.successful_arm_index]
 
-    def process_photon_loss(self, t: stim.TableauSimulator, loss_probability: float, rng: np.random.default_rng):
+    def process_photon_loss(
+        self, t: stim.TableauSimulator, loss_probability: float, rng: np.random.default_rng, noise_model: NoiseModel | None = None
+    ):
         for root in self.arms:
-            helper_process_photon_loss(t, root, loss_probability, rng)
+            helper_process_photon_loss(t, root, loss_probability, rng, noise_model)
 
     def update_measurement_with_side_effects(self):
         """using the side effect stored in .has_z to update .eigenvalues"""
@@ -222,7 +257,15 @@ class RGS:
             cur_index = helper_assign_qubit_indices(root, self.bv, cur_index)
         return cur_index
 
-    def initialize_quantum_state(self, t: stim.TableauSimulator, anchor_left: int, anchor_right: int, outer_emitter: int, root_ancilla: int):
+    def initialize_quantum_state(
+        self,
+        t: stim.TableauSimulator,
+        anchor_left: int,
+        anchor_right: int,
+        outer_emitter: int,
+        root_ancilla: int,
+        noise_model: NoiseModel | None = None,
+    ):
         # make sure the qubits are properly initialized
         t.reset(anchor_left, anchor_right)
 
@@ -230,7 +273,9 @@ class RGS:
         anchor_has_z = False
         t.h(anchor_left)
         for root in self.left_arms:
-            anchor_has_z = anchor_has_z ^ helper_initialize_rgs_arm(t, root, anchor_left, outer_emitter, root_ancilla)
+            anchor_has_z = anchor_has_z ^ helper_initialize_rgs_arm(
+                t, root, anchor_left, outer_emitter, root_ancilla, noise_model
+            )
         if anchor_has_z:
             # we fix the anchor as should be done by the RGSS during the generation process
             t.z(anchor_left)
@@ -239,13 +284,20 @@ class RGS:
         anchor_has_z = False
         t.h(anchor_right)
         for root in self.right_arms:
-            anchor_has_z = anchor_has_z ^ helper_initialize_rgs_arm(t, root, anchor_right, outer_emitter, root_ancilla)
+            anchor_has_z = anchor_has_z ^ helper_initialize_rgs_arm(
+                t, root, anchor_right, outer_emitter, root_ancilla, noise_model
+            )
         if anchor_has_z:
             t.z(anchor_right)
 
         # join the two halves
         t.cz(anchor_left, anchor_right)
+        if noise_model is not None:
+            noise_model.apply_two_qubit_gate_noise(t, anchor_left, anchor_right)
         t.h(anchor_left, anchor_right)
+        if noise_model is not None:
+            noise_model.apply_single_qubit_gate_noise(t, anchor_left, anchor_right)
+            noise_model.apply_emitter_measurement_noise(t, anchor_left, anchor_right)
         meas_left = t.measure(anchor_left)
         meas_right = t.measure(anchor_right)
 
@@ -259,11 +311,13 @@ class RGS:
                 for u in root.children:
                     u.has_z = not u.has_z
 
-    def process_photon_loss(self, t: stim.TableauSimulator, loss_probability: float, rng: np.random.default_rng):
+    def process_photon_loss(
+        self, t: stim.TableauSimulator, loss_probability: float, rng: np.random.default_rng, noise_model: NoiseModel | None = None
+    ):
         for root in self.left_arms:
-            helper_process_photon_loss(t, root, loss_probability, rng)
+            helper_process_photon_loss(t, root, loss_probability, rng, noise_model)
         for root in self.right_arms:
-            helper_process_photon_loss(t, root, loss_probability, rng)
+            helper_process_photon_loss(t, root, loss_probability, rng, noise_model)
 
     def update_measurements_with_side_effect(self):
         for u in [*self.left_arms, *self.right_arms]:
@@ -6,6 +6,8 @@ from typing import Self
 import numpy as np
 import stim
 
+from noise_model import NoiseModel, compose_depolarizing
+
 Pauli = Enum("Pauli", ["I", "X", "Y", "Z"])
 
 
@@ -21,6 +23,11 @@ class Node:
         self.children: list[Self] = []
         self.is_lost = False  # denote whether the qubit is lost in the fiber
         self.has_z = False  # denote whether the qubit has Z side effect from the emission process
+        # (roots only) loss and eigenvalue bitmasks of the first level subtrees in postorder, see `lookup_tree_code_helper`;
+        # built when the photons are emitted (or the losses presampled), None otherwise
+        # the eigenvalues include the side effects known at emission but not the later ones of the first level
+        self.loss_masks: list[int] | None = None
+        self.eigen_masks: list[int] | None = None
 
     def get_postorder_traversal(self) -> list[Self]:
         ret: list[Self] = []
@@ -39,6 +46,8 @@ class Node:
         self.measurement_basis = None
         self.is_lost = False
         self.has_z = False
+        self.loss_masks = None
+        self.eigen_masks = None
 
         for u in self.children:
             u.reset()
@@ -54,14 +63,24 @@ class RgsConfig:
         loss_probability: float,
         depolarizing_error_probability: float,
         tab_sim: stim.TableauSimulator,
+        rng: np.random.Generator | None = None,
+        num_emitters: int | None = None,
+        noise_model: NoiseModel | None = None,
+        streaming: bool = False,
     ):
-        self.rng = np.random.default_rng()
+        self.rng = rng if rng is not None else np.random.default_rng()
         self.t = tab_sim
 
         self.m = m
         self.bv = bv
         self.loss_probability = loss_probability
         self.error_probability = depolarizing_error_probability
+        # circuit-level noise of the emitters and detectors; the detector efficiency and the photon channel of the model
+        # are folded into the loss and depolarizing probabilities of the photons
+        self.noise_model = noise_model if noise_model is not None else NoiseModel()
+        if noise_model is not None:
+            self.loss_probability = noise_model.effective_loss_probability(loss_probability)
+            self.error_probability = compose_depolarizing(depolarizing_error_probability, noise_model.photon_depolarizing)
         self.number_of_hops = number_of_hops
 
         # default
@@ -74,7 +93,14 @@ class RgsConfig:
         self.photon = 6
         self.photon_left = 6
         self.photon_right = 7
-        self.emitters = [8 + i for i in range(len(bv))]
+        # one emitter per tree level unless an emission schedule needs more
+        self.emitters = [8 + i for i in range(num_emitters if num_emitters is not None else len(bv))]
+        # compiled `emission_schedule.EmissionSchedule` generating the inner qubits, None for the recursive generation
+        self.emission_schedule = None
+        # streaming generation and decoding of the inner qubits (`rgs_engine.generate_and_decode_inner_qubit`):
+        # the measurement trees only keep their roots (the outer photons) and the first-level Z side effects known
+        # after the emission of an inner qubit are accumulated in `first_level_side_effects` instead
+        self.streaming = streaming
 
         # data structures for data
         # measurement tree stored outer qubits and inner qubits
@@ -82,7 +108,20 @@ class RgsConfig:
         self.inner_emitter_measurements: list[list[bool]] = [[False for _ in range(m)] for _ in range(2 * number_of_hops)]
         self.outer_emitter_measurements: list[list[bool]] = [[False for _ in range(m)] for _ in range(2 * number_of_hops)]
         self.logical_results: list[list[None | bool]] = [[None for _ in range(m)] for _ in range(2 * number_of_hops)]
+        self.first_level_side_effects: list[list[bool]] = [[False for _ in range(m)] for _ in range(2 * number_of_hops)]
         self.succeeded_bsm_arm_indices = [-1 for _ in range(number_of_hops)]
+        self.end_node_parities = (False, False)  # combined parities sent to Alice and Bob for the Pauli frame correction
+        self.lost_photons_per_hop = [0 for _ in range(number_of_hops)]
+        # loss pattern of the outer photons and BSM outcomes sampled classically ahead of the quantum simulation of a hop
+        # (None if the hop is not presampled); the loss pattern of the inner photons is stored in the measurement trees
+        self.presampled_outer_losses: list[list[tuple[bool, bool]] | None] = [None for _ in range(number_of_hops)]
+        self.presampled_bsm_coins: list[list[bool] | None] = [None for _ in range(number_of_hops)]
+
+        # importance sampling: photon loss and depolarizing errors are drawn with these probabilities instead (None if unbiased)
+        # and the log-likelihood ratio of the trial w.r.t. the nominal probabilities is accumulated in `log_likelihood_ratio`
+        self.biased_loss_probability: float | None = None
+        self.biased_error_probability: float | None = None
+        self.log_likelihood_ratio = 0.0
 
         # adding trackers
         self.outer_emitters_results: list[list[bool]] = [[False for _ in range(m)] for _ in range(2 * number_of_hops)]
@@ -98,26 +137,33 @@ class RgsConfig:
         # debugging circuit
         self.circuit = stim.Circuit()
 
-        # initialization of measurement trees
-        for arms in self.measurement_trees:
-            for root in arms:
-                queue = [root]
-                for bi in bv:
-                    temp_queue = []
-                    for u in queue:
-                        for _ in range(bi):
-                            v = Node()
-                            u.children.append(v)
-                            temp_queue.append(v)
-                    queue = temp_queue
+        # initialization of measurement trees (only the roots when streaming)
+        if not streaming:
+            for arms in self.measurement_trees:
+                for root in arms:
+                    queue = [root]
+                    for bi in bv:
+                        temp_queue = []
+                        for u in queue:
+                            for _ in range(bi):
+                                v = Node()
+                                u.children.append(v)
+                                temp_queue.append(v)
+                        queue = temp_queue
 
     def reset(self):
         self.t.reset(*range(self.emitters[-1] + 1))
         self.t.h(0, 1, 2, 3, 4, 5, *self.emitters)
         self.logical_results = [[None for _ in range(self.m)] for _ in range(2 * self.number_of_hops)]
+        self.first_level_side_effects = [[False for _ in range(self.m)] for _ in range(2 * self.number_of_hops)]
         self.inner_emitter_measurements = [[False for _ in range(self.m)] for _ in range(2 * self.number_of_hops)]
         self.outer_emitter_measurements = [[False for _ in range(self.m)] for _ in range(2 * self.number_of_hops)]
         self.succeeded_bsm_arm_indices = [-1 for _ in range(self.number_of_hops)]
+        self.end_node_parities = (False, False)
+        self.lost_photons_per_hop = [0 for _ in range(self.number_of_hops)]
+        self.presampled_outer_losses = [None for _ in range(self.number_of_hops)]
+        self.presampled_bsm_coins = [None for _ in range(self.number_of_hops)]
+        self.log_likelihood_ratio = 0.0
 
         for arms in self.measurement_trees:
             for root in arms:
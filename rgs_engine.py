@@ -0,0 +1,833 @@
+#! usr/bin/python3
+
+"""Optimized hop-by-hop RGS protocol engine.
+
+This is the engine developed in `optimize-simulation-rgs-protocol-simulation.ipynb` and
+`noisy-rgs-protocol-simulation.ipynb`, collected in a module so that it can be imported by scripts and worker processes.
+Only the qubits required at a time are kept in the tableau: two memories for the Bell pair built so far,
+two anchors for the hop being generated, two outer emitters, the inner-qubit emitters and at most two photons.
+"""
+
+from types import ModuleType
+
+import numpy as np
+import stim
+
+import lookup_tree_code_helper
+import tree_code_helper
+from absa_policy import ArmSelectionPolicy, select_bsm_arm
+from control_variates import ControlVariateEstimate
+from emission_schedule import EmissionSchedule, ScheduleOp
+from fidelity_readout import BellStateReadout, peek_bell_correlators
+from noise_model import NoiseModel
+from rgs_config import Node, Pauli, RgsConfig
+from rgs_theoretical_model import prob_rgs_trial
+from streaming_decoder import STREAMING_DECODERS, StreamingTreeDecoder
+from trial_recorder import TrialRecorder
+
+# decoders whose decodability only depends on the loss pattern in the same way as `lookup_tree_code_helper.is_decodable_x/z`,
+# so that the classical pre-screening keeps exactly the trials they can decode
+PRESCREEN_DECODERS = ["tree_code_helper", "lookup_tree_code_helper", "majority_vote_tree_code_helper"]
+
+
+def helper_log_likelihood_ratio(nominal_probability: float, biased_probability: float, count: int) -> float:
+    """log of (nominal / biased) ** count, the importance weight of `count` events drawn with the biased probability"""
+    if count == 0:
+        return 0.0
+    if nominal_probability == 0:
+        return -np.inf
+    return count * (np.log(nominal_probability) - np.log(biased_probability))
+
+
+def helper_sample_photon_losses(conf: RgsConfig, size: int) -> np.ndarray:
+    """sample the loss of `size` photons
+    with a biased loss probability (importance sampling) the likelihood ratio of the sample is added to the trial weight"""
+    if conf.biased_loss_probability is None:
+        return conf.rng.random(size) < conf.loss_probability
+    p, q = conf.loss_probability, conf.biased_loss_probability
+    losses = conf.rng.random(size) < q
+    lost = int(np.count_nonzero(losses))
+    conf.log_likelihood_ratio += helper_log_likelihood_ratio(p, q, lost) + helper_log_likelihood_ratio(1 - p, 1 - q, size - lost)
+    return losses
+
+
+def helper_apply_biased_channel_error(conf: RgsConfig, photon: int):
+    """depolarizing channel with the error drawn explicitly at the biased probability,
+    adding its likelihood ratio to the trial weight"""
+    p, q = conf.error_probability, conf.biased_error_probability
+    if conf.rng.random() < q:  # type: ignore
+        [conf.t.x, conf.t.y, conf.t.z][conf.rng.integers(3)](photon)
+        conf.log_likelihood_ratio += helper_log_likelihood_ratio(p, q, 1)  # type: ignore
+    else:
+        conf.log_likelihood_ratio += helper_log_likelihood_ratio(1 - p, 1 - q, 1)  # type: ignore
+
+
+def helper_apply_photon_loss_and_channel_error(conf: RgsConfig, photon: int, is_lost: bool | None = None) -> bool:
+    """returns a bool indicating whether or not the qubit is lost
+    the loss is sampled here unless it was presampled and given as `is_lost`"""
+    conf.total_photons += 1
+
+    # apply depolarizing channel
+    if conf.biased_error_probability is not None:
+        helper_apply_biased_channel_error(conf, photon)
+    elif conf.error_probability > 0:
+        conf.t.depolarize1(photon, p=conf.error_probability)
+
+    if is_lost is None:
+        if conf.biased_loss_probability is None:
+            is_lost = conf.rng.random() < conf.loss_probability
+        else:
+            is_lost = bool(helper_sample_photon_losses(conf, 1)[0])
+    if not is_lost:
+        return False
+    conf.lost_photons += 1
+    conf.t.x_error(photon, p=0.5)
+    conf.t.z_error(photon, p=0.5)
+    return True
+
+
+def helper_update_eigenvalue_with_side_effect(conf: RgsConfig):
+
+    def __update_eigenvalue_with_side_effect_recurse(root: Node):
+        if (not root.is_lost) and (root.measurement_basis == Pauli.X) and (root.has_z):
+            root.eigenvalue = not root.eigenvalue
+        for v in root.children:
+            __update_eigenvalue_with_side_effect_recurse(v)
+
+    for meas_tree in conf.measurement_trees:
+        for root in meas_tree:
+            __update_eigenvalue_with_side_effect_recurse(root)
+
+
+def helper_propagate_bsm_side_effect(conf: RgsConfig, hop_index: int):
+    """toggle the 1st level results of each tree with the BSM result of the outer qubit of the other tree (step 2)"""
+    left_tree_root = conf.measurement_trees[2 * hop_index][conf.succeeded_bsm_arm_indices[hop_index]]
+    right_tree_root = conf.measurement_trees[2 * hop_index + 1][conf.succeeded_bsm_arm_indices[hop_index]]
+    if left_tree_root.eigenvalue:
+        for u in right_tree_root.children:
+            if u.is_lost:
+                continue
+            u.eigenvalue = not u.eigenvalue
+    if right_tree_root.eigenvalue:
+        for u in left_tree_root.children:
+            if u.is_lost:
+                continue
+            u.eigenvalue = not u.eigenvalue
+
+
+def helper_decode_from_masks(conf: RgsConfig, tree_index: int, arm: int, below: tuple[int, ...]) -> bool | None:
+    """decode an inner qubit with `lookup_tree_code_helper` from the bitmasks built at emission;
+    the first-level side effects known later flip the logical X result of the BSM arm, see `helper_apply_streamed_side_effects`"""
+    root = conf.measurement_trees[tree_index][arm]
+    if conf.succeeded_bsm_arm_indices[tree_index // 2] != arm:
+        return lookup_tree_code_helper.decode_logical_z_from_masks(below, root.loss_masks, root.eigen_masks)  # type: ignore
+    logical_x = lookup_tree_code_helper.decode_logical_x_from_masks(below, root.loss_masks, root.eigen_masks)  # type: ignore
+    if logical_x is None:
+        return None
+    # the other tree of the hop is tree_index ^ 1
+    other_root = conf.measurement_trees[tree_index ^ 1][arm]
+    return logical_x ^ conf.first_level_side_effects[tree_index][arm] ^ bool(other_root.eigenvalue)
+
+
+def helper_decode_logical_result(conf: RgsConfig, decoder: ModuleType = tree_code_helper) -> bool:
+    """decode logical qubit from all measurements (all info stored in config)
+    and returns a boolean indicating whether all inner qubits can be decoded or not"""
+    below = tuple(conf.bv[1:])
+    for i, meas_tree in enumerate(conf.measurement_trees):
+        for arm, root in enumerate(meas_tree):
+            if decoder is lookup_tree_code_helper and root.eigen_masks is not None:
+                conf.logical_results[i][arm] = helper_decode_from_masks(conf, i, arm, below)
+            elif conf.succeeded_bsm_arm_indices[i // 2] == arm:
+                conf.logical_results[i][arm] = decoder.decode_tree_logical_x(root)
+            else:
+                conf.logical_results[i][arm] = decoder.decode_tree_logical_z(root)
+    return all([m is not None for arms in conf.logical_results for m in arms])
+
+
+def helper_apply_streamed_side_effects(conf: RgsConfig) -> bool:
+    """streaming counterpart of steps 2 and decoding: the inner qubits are already decoded, and the first-level side effects
+    (Z side effects and BSM results of the other tree) flip the logical X results of the BSM arms
+    returns a boolean indicating whether all inner qubits could be decoded or not"""
+    for hop_index in range(conf.number_of_hops):
+        bsm_arm = conf.succeeded_bsm_arm_indices[hop_index]
+        for tree_index, other_index in [(2 * hop_index, 2 * hop_index + 1), (2 * hop_index + 1, 2 * hop_index)]:
+            logical_x = conf.logical_results[tree_index][bsm_arm]
+            if logical_x is None:
+                continue
+            logical_x ^= conf.first_level_side_effects[tree_index][bsm_arm]
+            logical_x ^= bool(conf.measurement_trees[other_index][bsm_arm].eigenvalue)
+            conf.logical_results[tree_index][bsm_arm] = logical_x
+    return all([m is not None for arms in conf.logical_results for m in arms])
+
+
+def helper_compute_parity_for_end_nodes(conf: RgsConfig, hop_index: int) -> tuple[bool, bool]:
+    """apply the parity at the ABSA of the hop (step 3)
+    return tuple of parity to be sent to the left and right end nodes respectively"""
+    left_logicals = conf.logical_results[2 * hop_index]
+    right_logicals = conf.logical_results[2 * hop_index + 1]
+    bsm_arm = conf.succeeded_bsm_arm_indices[hop_index]
+
+    lp, rp = False, False
+    for i in range(conf.m):
+        if i == bsm_arm:
+            continue
+        lp ^= left_logicals[i]  # type: ignore
+        rp ^= right_logicals[i]  # type: ignore
+    lp ^= right_logicals[bsm_arm]  # type: ignore
+    rp ^= left_logicals[bsm_arm]  # type: ignore
+    return lp, rp
+
+
+def helper_presample_hop(conf: RgsConfig, hop_index: int):
+    """sample the loss pattern of every photon of the hop and the outcomes of the BSMs ahead of the quantum simulation
+    a BSM of two arrived photons succeeds with probability 1/2 independently of everything else,
+    so it can be sampled classically"""
+    outer_losses = []
+    bsm_coins = []
+    for arm in range(conf.m):
+        left_lost, right_lost = helper_sample_photon_losses(conf, 2)
+        outer_losses.append((bool(left_lost), bool(right_lost)))
+        bsm_coins.append(bool(conf.rng.random() < 0.5))
+        for root in (conf.measurement_trees[2 * hop_index][arm], conf.measurement_trees[2 * hop_index + 1][arm]):
+            # the last entry of the postorder traversal is the outer photon
+            inner_nodes = root.get_postorder_traversal()[:-1]
+            for u, is_lost in zip(inner_nodes, helper_sample_photon_losses(conf, len(inner_nodes))):
+                u.is_lost = bool(is_lost)
+            helper_store_decoding_masks(conf, root, inner_nodes, with_eigenvalues=False)
+    conf.presampled_outer_losses[hop_index] = outer_losses
+    conf.presampled_bsm_coins[hop_index] = bsm_coins
+
+
+def helper_store_decoding_masks(conf: RgsConfig, root: Node, inner_nodes: list[Node], with_eigenvalues: bool = True):
+    """store the loss (and eigenvalue) bitmasks of the first level subtrees of `root` for `lookup_tree_code_helper`,
+    `inner_nodes` being the inner photons in postorder; the eigenvalues include the side effects known at emission"""
+    size = lookup_tree_code_helper.subtree_size(tuple(conf.bv[1:]))
+    loss_masks = [0] * conf.bv[0]
+    eigen_masks = [0] * conf.bv[0]
+    for i, u in enumerate(inner_nodes):
+        j, bit = divmod(i, size)
+        if u.is_lost:
+            loss_masks[j] |= 1 << bit
+        elif with_eigenvalues and u.measurement_result ^ (u.has_z and u.measurement_basis == Pauli.X):
+            eigen_masks[j] |= 1 << bit
+    root.loss_masks = loss_masks
+    root.eigen_masks = eigen_masks if with_eigenvalues else None
+
+
+def emit_inner_qubit_photons(conf: RgsConfig, logical_basis: Pauli, presampled_losses: list[bool] | None = None):
+    """Generate and measure the photons of an inner logical qubit, yielding one record per photon in postorder (emission order):
+    (level, is_lost, measurement basis, measurement result, side effect), the level counted from 0 for the first level.
+    Nothing is stored, so the memory only grows with the depth of the tree.
+    `presampled_losses` gives the loss pattern in postorder instead of sampling it."""
+    # specifying the basis (i.e., X or Z) will be measured in the odd level while even will be the other basis (i.e., Z or X)
+    # this is opposite of what we wrote in the paper since we count the level of the tree from 0 (in the paper we count from 1)
+    even_basis = logical_basis
+    if even_basis == Pauli.X:
+        odd_basis = Pauli.Z
+    else:
+        odd_basis = Pauli.X
+    n = len(conf.bv)
+
+    # short hand
+    t = conf.t
+    photon = conf.photon
+    emitters = conf.emitters
+    noise = conf.noise_model
+    emitted = 0
+
+    def __measure_photon(basis: Pauli) -> tuple[bool, Pauli | None, bool | None]:
+        nonlocal emitted
+        presampled_loss = None if presampled_losses is None else presampled_losses[emitted]
+        is_lost = helper_apply_photon_loss_and_channel_error(conf, photon, presampled_loss)
+        emitted += 1
+        if is_lost:
+            return True, None, None
+        if basis == Pauli.X:
+            t.h(photon)
+        noise.apply_photon_measurement_noise(t, photon)
+        return False, basis, t.measure(photon)
+
+    def __recurse_generate_and_measure(i):
+        # one call generates one child (subtree) of emitter i-th
+        # from having (j, b_{i+1}, b{i+2}, ..., b_{n-1}) to (j + 1, b_{i+1}, b{i+2}, ..., b_{n-1})
+        # initially, j is 0 for the first call
+        # we assume that the emitters are always in the |+> state,
+        # so we need to reinitialize it every time we perform measurements on an emitter.
+        basis = odd_basis if i % 2 == 1 else even_basis
+        if i == n - 1:
+            # generation part: G_{n-1}
+            t.reset(photon)
+            t.cx(emitters[i], photon)
+            noise.apply_emission_noise(t, emitters[i], photon)
+            t.h(photon)  # to fix up the H side effect
+
+            # measurement part
+            yield i, *__measure_photon(basis), False
+        else:
+            # generation part: G_k
+            for _ in range(conf.bv[i + 1]):
+                # G_{i+1} ^ (b_{i+1}); this is anchored at emitter[i+1]
+                yield from __recurse_generate_and_measure(i + 1)
+            t.cz(emitters[i], emitters[i + 1])
+            noise.apply_two_qubit_gate_noise(t, emitters[i], emitters[i + 1])
+            t.reset(photon)
+            t.cx(emitters[i + 1], photon)
+            noise.apply_emission_noise(t, emitters[i + 1], photon)
+            t.h(emitters[i + 1])
+            noise.apply_single_qubit_gate_noise(t, emitters[i + 1])
+            noise.apply_emitter_measurement_noise(t, emitters[i + 1])
+            side_effect = t.measure(emitters[i + 1])
+            t.reset_x(emitters[i + 1])  # reinitialize emitter q_{i+1}
+
+            # measure the newly created photon at level k
+            yield i, *__measure_photon(basis), side_effect
+
+    for _ in range(conf.bv[0]):
+        yield from __recurse_generate_and_measure(0)
+
+
+def helper_prescreen_hop(conf: RgsConfig, hop_index: int, policy: ArmSelectionPolicy = ArmSelectionPolicy.FIRST_SUCCESS) -> bool:
+    """presample the hop (unless it already is) and check classically whether it can succeed:
+    some BSM succeeds, the kept arm can be decoded in X on both sides and all the other arms in Z
+    the selected arm and the number of lost photons of the hop are stored as the simulation of the hop would"""
+    if conf.presampled_outer_losses[hop_index] is None:
+        helper_presample_hop(conf, hop_index)
+    outer_losses: list[tuple[bool, bool]] = conf.presampled_outer_losses[hop_index]  # type: ignore
+    bsm_coins: list[bool] = conf.presampled_bsm_coins[hop_index]  # type: ignore
+    bsm_successes = [not left_lost and not right_lost and coin for (left_lost, right_lost), coin in zip(outer_losses, bsm_coins)]
+    left_roots, right_roots = conf.measurement_trees[2 * hop_index], conf.measurement_trees[2 * hop_index + 1]
+    bsm_arm = select_bsm_arm(policy, bsm_successes, left_roots, right_roots)
+    conf.succeeded_bsm_arm_indices[hop_index] = bsm_arm
+    inner_losses = sum(mask.bit_count() for root in left_roots + right_roots for mask in root.loss_masks)  # type: ignore
+    conf.lost_photons_per_hop[hop_index] = sum(left_lost + right_lost for left_lost, right_lost in outer_losses) + inner_losses
+    if bsm_arm == -1:
+        return False
+    for arm, (left_root, right_root) in enumerate(zip(left_roots, right_roots)):
+        is_decodable = lookup_tree_code_helper.is_decodable_x if arm == bsm_arm else lookup_tree_code_helper.is_decodable_z
+        if not is_decodable(left_root) or not is_decodable(right_root):
+            return False
+    return True
+
+
+def generate_and_measure_inner_qubit(conf: RgsConfig, logical_basis: Pauli, root: Node, presampled: bool = False):
+    """Generate and measure an inner logical qubit, which comprises of lots of physical qubits.
+    If `presampled`, the loss pattern already stored in the tree is used instead of sampling it."""
+    if conf.emission_schedule is not None:
+        run_emission_schedule(conf, conf.emission_schedule, logical_basis, root, presampled)
+        return
+
+    # the photons are emitted in postorder, so the i-th photon is the node at postorder_nodes[i]
+    # we don't need the last entry since it is the outer photon
+    postorder_nodes = root.get_postorder_traversal()[:-1]
+    presampled_losses = [u.is_lost for u in postorder_nodes] if presampled else None
+    records = emit_inner_qubit_photons(conf, logical_basis, presampled_losses)
+    # the bitmasks of the first level subtrees are built on the way, see `helper_store_decoding_masks`
+    size = lookup_tree_code_helper.subtree_size(tuple(conf.bv[1:]))
+    loss_masks = [0] * conf.bv[0]
+    eigen_masks = [0] * conf.bv[0]
+    for i, (u, (_, is_lost, basis, result, side_effect)) in enumerate(zip(postorder_nodes, records)):
+        u.has_z = side_effect
+        u.measurement_result = u.eigenvalue = result
+        u.measurement_basis = basis
+        u.is_lost = is_lost
+        if is_lost:
+            loss_masks[i // size] |= 1 << (i % size)
+        elif result ^ (side_effect and basis == Pauli.X):
+            eigen_masks[i // size] |= 1 << (i % size)
+    root.loss_masks = loss_masks
+    root.eigen_masks = eigen_masks
+
+
+def generate_and_decode_inner_qubit(conf: RgsConfig, logical_basis: Pauli, decoder: ModuleType = tree_code_helper) -> bool | None:
+    """Streaming counterpart of `generate_and_measure_inner_qubit` followed by the decoding of the inner qubit:
+    the photon records are folded into the logical result as they are emitted and no measurement tree is kept.
+    The side effects of the first level which are only known later are not applied (see `streaming_decoder`)."""
+    if decoder.__name__ not in STREAMING_DECODERS:
+        raise ValueError(f"decoder {decoder.__name__} has no streaming counterpart, use one of {list(STREAMING_DECODERS)}")
+    fold = StreamingTreeDecoder(len(conf.bv), STREAMING_DECODERS[decoder.__name__])
+    for level, is_lost, basis, result, side_effect in emit_inner_qubit_photons(conf, logical_basis):
+        fold.consume(level, is_lost, None if is_lost else result ^ (side_effect and basis == Pauli.X))
+    return fold.logical_x() if logical_basis == Pauli.X else fold.logical_z()
+
+
+def run_emission_schedule(
+    conf: RgsConfig, schedule: EmissionSchedule, logical_basis: Pauli, root: Node, presampled: bool = False
+):
+    """Generate and measure an inner logical qubit by running a compiled emission schedule
+    (same results as `generate_and_measure_inner_qubit`, the schedule decides the emitters and the emission order)"""
+    t = conf.t
+    photon = conf.photon
+    emitters = conf.emitters
+    if len(emitters) < schedule.num_emitters:
+        raise ValueError(f"the schedule needs {schedule.num_emitters} emitters but the configuration has {len(emitters)}")
+    other_basis = Pauli.Z if logical_basis == Pauli.X else Pauli.X
+    noise = conf.noise_model
+
+    postorder_nodes = root.get_postorder_traversal()
+    side_effects = [False] * schedule.num_photons
+    for _, op, schedule_emitters, i in schedule.ops:
+        if op == ScheduleOp.CZ:
+            t.cz(emitters[schedule_emitters[0]], emitters[schedule_emitters[1]])
+            noise.apply_two_qubit_gate_noise(t, emitters[schedule_emitters[0]], emitters[schedule_emitters[1]])
+            continue
+
+        emitter = emitters[schedule_emitters[0]]
+        t.reset(photon)
+        t.cx(emitter, photon)
+        noise.apply_emission_noise(t, emitter, photon)
+        if op == ScheduleOp.EMIT:
+            t.h(photon)  # to fix up the H side effect
+        else:
+            t.h(emitter)
+            noise.apply_single_qubit_gate_noise(t, emitter)
+            noise.apply_emitter_measurement_noise(t, emitter)
+            side_effects[i] = t.measure(emitter)  # type: ignore
+            t.reset_x(emitter)
+
+        u = postorder_nodes[i]  # type: ignore
+        if helper_apply_photon_loss_and_channel_error(conf, photon, u.is_lost if presampled else None):
+            u.is_lost = True
+            u.measurement_basis = u.measurement_result = u.eigenvalue = None
+        else:
+            basis = other_basis if schedule.node_levels[i] % 2 == 1 else logical_basis  # type: ignore
+            if basis == Pauli.X:
+                t.h(photon)
+            u.is_lost = False
+            u.measurement_basis = basis
+            noise.apply_photon_measurement_noise(t, photon)
+            u.measurement_result = u.eigenvalue = t.measure(photon)
+
+    for i, u in enumerate(postorder_nodes[:-1]):
+        u.has_z = side_effects[i]
+    helper_store_decoding_masks(conf, root, postorder_nodes[:-1])
+
+
+def rgs_protocol_helper_one_hop(
+    conf: RgsConfig,
+    left_anchor: int,
+    right_anchor: int,
+    hop_index: int,
+    policy: ArmSelectionPolicy = ArmSelectionPolicy.FIRST_SUCCESS,
+    decoder: ModuleType = tree_code_helper,
+) -> bool:
+    """This function process one hop of the RGS trial
+    with the two qubit anchors are provided via `left_anchor` and `right_anchor`.
+    Returns whether the BSM of outer qubits are successful or not, so the simulation can stop early
+
+    With the first-success policy, the arm to keep is decided as soon as its BSM succeeds.
+    Other policies need the BSM outcomes and loss patterns of all arms before the inner qubits are measured,
+    so the hop is presampled classically and the quantum simulation is conditioned on the presampled outcomes.
+    When streaming, the inner qubits are decoded with `decoder` as they are generated."""
+    t = conf.t
+    left_outer_emitter = conf.outer_emitter_left
+    right_outer_emitter = conf.outer_emitter_right
+    left_photon = conf.photon_left
+    right_photon = conf.photon_right
+    emitters = conf.emitters
+    noise = conf.noise_model
+    lost_photons_before = conf.lost_photons
+
+    if policy != ArmSelectionPolicy.FIRST_SUCCESS and conf.presampled_outer_losses[hop_index] is None:
+        helper_presample_hop(conf, hop_index)
+    outer_losses = conf.presampled_outer_losses[hop_index]
+    bsm_coins = conf.presampled_bsm_coins[hop_index]
+    presampled = outer_losses is not None
+    if presampled:
+        bsm_successes = [
+            not left_lost and not right_lost and coin
+            for (left_lost, right_lost), coin in zip(outer_losses, bsm_coins)  # type: ignore
+        ]
+        conf.succeeded_bsm_arm_indices[hop_index] = select_bsm_arm(
+            policy, bsm_successes, conf.measurement_trees[2 * hop_index], conf.measurement_trees[2 * hop_index + 1]
+        )
+
+    for arm in range(conf.m):
+        # generate outer qubits for both sides
+        t.reset(left_photon, right_photon)
+        t.cx(left_outer_emitter, left_photon, right_outer_emitter, right_photon)
+        noise.apply_emission_noise(t, left_outer_emitter, left_photon, right_outer_emitter, right_photon)
+        t.h(left_photon, right_photon)  # we perform H to fix up into the graph states
+
+        # BSM part
+        left_loss, right_loss = outer_losses[arm] if presampled else (None, None)  # type: ignore
+        left_is_lost = helper_apply_photon_loss_and_channel_error(conf, left_photon, left_loss)
+        right_is_lost = helper_apply_photon_loss_and_channel_error(conf, right_photon, right_loss)
+
+        # reference to measurement record
+        left_root = conf.measurement_trees[2 * hop_index][arm]
+        right_root = conf.measurement_trees[2 * hop_index + 1][arm]
+
+        # 3 cases that can happen for BSM:
+        #   (1) one or both photon lost
+        #   (2) BSM succeeded (50% linear optics) -- results are different (+1/-1 or -1/+1)
+        #   (3) BSM failed -- results are the same (+1+1 or -1-1)
+        if left_is_lost or right_is_lost:
+            bsm_is_successful = False
+        else:
+            # BSM when both photons arrive
+            t.cz(left_photon, right_photon)
+            t.h(left_photon, right_photon)
+            noise.apply_photon_measurement_noise(t, left_photon, right_photon)
+            left_result = t.measure(left_photon)
+            if presampled:
+                # force the presampled outcome; the result of the right photon is uniformly random given the left one
+                if t.peek_z(right_photon) != 0:
+                    raise RuntimeError("the BSM outcome is deterministic and cannot be presampled")
+                right_result = left_result ^ bsm_coins[arm]  # type: ignore
+                t.postselect_z(right_photon, desired_value=right_result)
+            else:
+                right_result = t.measure(right_photon)
+            bsm_is_successful = left_result != right_result
+
+        if bsm_is_successful:
+            left_root.is_lost = right_root.is_lost = False
+            left_root.measurement_basis = right_root.measurement_basis = Pauli.X
+            left_root.eigenvalue = left_root.measurement_result = left_result
+            right_root.eigenvalue = right_root.measurement_result = right_result
+        else:
+            # we store the result for fail BSM as if they are lost
+            left_root.is_lost = right_root.is_lost = True
+            left_root.measurement_basis = right_root.measurement_basis = None
+            left_root.eigenvalue = left_root.measurement_result = None
+            right_root.eigenvalue = right_root.measurement_result = None
+
+        # choose pair to keep if we haven't got one yet
+        if presampled:
+            inner_qubit_measurement_basis = Pauli.X if conf.succeeded_bsm_arm_indices[hop_index] == arm else Pauli.Z
+        elif conf.succeeded_bsm_arm_indices[hop_index] == -1 and bsm_is_successful:
+            conf.succeeded_bsm_arm_indices[hop_index] = arm
+            inner_qubit_measurement_basis = Pauli.X
+        else:
+            inner_qubit_measurement_basis = Pauli.Z
+
+        # inner qubit: left
+        if conf.streaming:
+            logical_result = generate_and_decode_inner_qubit(conf, inner_qubit_measurement_basis, decoder)
+            conf.logical_results[2 * hop_index][arm] = logical_result
+        else:
+            generate_and_measure_inner_qubit(conf, inner_qubit_measurement_basis, left_root, presampled)
+        t.cz(left_anchor, left_outer_emitter)
+        noise.apply_two_qubit_gate_noise(t, left_anchor, left_outer_emitter)
+        t.cz(left_outer_emitter, emitters[0])
+        noise.apply_two_qubit_gate_noise(t, left_outer_emitter, emitters[0])
+        t.h(left_outer_emitter, emitters[0])
+        noise.apply_single_qubit_gate_noise(t, left_outer_emitter, emitters[0])
+        noise.apply_emitter_measurement_noise(t, left_outer_emitter, emitters[0])
+        outer_emitter_meas, inner_emitter_meas = t.measure(left_outer_emitter), t.measure(emitters[0])
+        t.reset_x(left_outer_emitter, emitters[0])
+
+        if inner_emitter_meas:
+            t.z(left_anchor)
+            left_root.has_z = not left_root.has_z
+        if outer_emitter_meas:
+            conf.first_level_side_effects[2 * hop_index][arm] = not conf.first_level_side_effects[2 * hop_index][arm]
+            for u in left_root.children:
+                u.has_z = not u.has_z
+
+        # inner qubit: right
+        if conf.streaming:
+            logical_result = generate_and_decode_inner_qubit(conf, inner_qubit_measurement_basis, decoder)
+            conf.logical_results[2 * hop_index + 1][arm] = logical_result
+        else:
+            generate_and_measure_inner_qubit(conf, inner_qubit_measurement_basis, right_root, presampled)
+        t.cz(right_anchor, right_outer_emitter)
+        noise.apply_two_qubit_gate_noise(t, right_anchor, right_outer_emitter)
+        t.cz(right_outer_emitter, emitters[0])
+        noise.apply_two_qubit_gate_noise(t, right_outer_emitter, emitters[0])
+        t.h(right_outer_emitter, emitters[0])
+        noise.apply_single_qubit_gate_noise(t, right_outer_emitter, emitters[0])
+        noise.apply_emitter_measurement_noise(t, right_outer_emitter, emitters[0])
+        outer_emitter_meas, inner_emitter_meas = t.measure(right_outer_emitter), t.measure(emitters[0])
+        t.reset_x(right_outer_emitter, emitters[0])
+
+        if inner_emitter_meas:
+            t.z(right_anchor)
+            right_root.has_z = not right_root.has_z
+        if outer_emitter_meas:
+            conf.first_level_side_effects[2 * hop_index + 1][arm] = not conf.first_level_side_effects[2 * hop_index + 1][arm]
+            for u in right_root.children:
+                u.has_z = not u.has_z
+
+    conf.lost_photons_per_hop[hop_index] = conf.lost_photons - lost_photons_before
+    return conf.succeeded_bsm_arm_indices[hop_index] != -1
+
+
+def rgs_protocol_trial(
+    conf: RgsConfig,
+    decoder: ModuleType = tree_code_helper,
+    readout: BellStateReadout | None = None,
+    policy: ArmSelectionPolicy = ArmSelectionPolicy.FIRST_SUCCESS,
+    presample_all_hops: bool = False,
+    prescreen: bool = False,
+) -> tuple[bool, bool | None]:
+    """This function accepts all the parameters specifying a single Bell pair distribution trial via the RGS protocol.
+    `decoder` is the module used to decode the inner qubits, i.e., `tree_code_helper` for the loss-only simulation
+    or `majority_vote_tree_code_helper` when depolarizing errors are present.
+    The Alice-Bob correlators of successful trials are accumulated into `readout` if given.
+    `policy` decides which arm is kept at an ABSA when several BSMs succeed.
+    With `presample_all_hops`, the loss patterns and BSM outcomes of all hops are sampled before the quantum simulation,
+    so they are known even for the hops after a failed one (see `control_variates`).
+    With `prescreen`, the hops are presampled one after the other and checked classically first (`helper_prescreen_hop`),
+    so a failing trial returns before any quantum simulation and only the surviving trials are simulated with stim.
+    As without pre-screening, the hops are processed until a BSM fails, so that the failures are recorded the same way
+    (see `trial_recorder`); the decoder must be one of `PRESCREEN_DECODERS`.
+
+    Returns:
+        - bool: denoting success of the trial
+        - bool: denoting the correct Bell state (XZ and ZX stabilizers) or None if the trial fails"""
+
+    needs_trees = policy != ArmSelectionPolicy.FIRST_SUCCESS or conf.emission_schedule is not None
+    if conf.streaming and (needs_trees or presample_all_hops or prescreen):
+        raise ValueError("streaming decoding needs the first-success policy and the recursive generation of the inner qubits")
+    if prescreen and decoder.__name__ not in PRESCREEN_DECODERS:
+        raise ValueError(f"the pre-screening cannot predict the decoding of {decoder.__name__}, use one of {PRESCREEN_DECODERS}")
+    conf.reset()
+    if presample_all_hops:
+        for hop_index in range(conf.number_of_hops):
+            helper_presample_hop(conf, hop_index)
+    if prescreen:
+        is_decodable = True
+        for hop_index in range(conf.number_of_hops):
+            is_decodable &= helper_prescreen_hop(conf, hop_index, policy)
+            if conf.succeeded_bsm_arm_indices[hop_index] == -1:
+                return False, None
+        if not is_decodable:
+            return False, None
+
+    # first hop, we perform a single-hop RGS from half-RGSs between memories (0 and 1)
+    # all photons between the two halfs are generated and measured
+    trial_is_running = rgs_protocol_helper_one_hop(conf, conf.alice, conf.bob, 0, policy, decoder)
+    if not trial_is_running:
+        return False, None
+
+    # subsequent hops along the path
+    for hop_index in range(1, conf.number_of_hops):
+        # join the two Bell pairs, equivalent to the action of joining two half-RGSs at RGSS (i-1) th
+        # (not counting the two end nodes; Alice and Bob)
+        trial_is_running = rgs_protocol_helper_one_hop(conf, conf.anchor_left, conf.anchor_right, hop_index, policy, decoder)
+        if not trial_is_running:
+            return False, None
+        #           2 * hop - 1 | 2 * hop        2 * hop + 1
+        # from: left --- (right | temp_left) --- temp_right
+        # swap: left --------------------------- temp_right
+        # want: left --- (right | temp_left)     temp_right
+        conf.t.cz(conf.bob, conf.anchor_left)
+        conf.noise_model.apply_two_qubit_gate_noise(conf.t, conf.bob, conf.anchor_left)
+        conf.t.h(conf.bob, conf.anchor_left)
+        conf.noise_model.apply_single_qubit_gate_noise(conf.t, conf.bob, conf.anchor_left)
+        conf.noise_model.apply_emitter_measurement_noise(conf.t, conf.bob, conf.anchor_left)
+        left_meas, right_meas = conf.t.measure(conf.bob), conf.t.measure(conf.anchor_left)
+        conf.t.reset_x(conf.bob, conf.anchor_left)
+        conf.t.swap(conf.bob, conf.anchor_right)
+
+        for meas, tree_index in [(left_meas, 2 * hop_index), (right_meas, 2 * hop_index - 1)]:
+            if not meas:
+                continue
+            for arm, root in enumerate(conf.measurement_trees[tree_index]):
+                conf.first_level_side_effects[tree_index][arm] = not conf.first_level_side_effects[tree_index][arm]
+                for u in root.children:
+                    u.has_z = not u.has_z
+
+    # (Protocol Step 1) Update measurements tree by assigning eigenvalues to the nodes taking side effects into account
+    helper_update_eigenvalue_with_side_effect(conf)
+
+    # (Protocol Step 2) Propagating side effects of BSMs of outer qubits into their connected inner qubits
+    # (Protocol Step 2/3?) Decoding logical measurements
+    if conf.streaming:
+        if not helper_apply_streamed_side_effects(conf):
+            return False, None
+    else:
+        for hop_index in range(conf.number_of_hops):
+            helper_propagate_bsm_side_effect(conf, hop_index)
+        if not helper_decode_logical_result(conf, decoder):
+            if prescreen:
+                raise RuntimeError(f"the trial passed the pre-screening but {decoder.__name__} could not decode the inner qubits")
+            return False, None
+
+    # (Protocol Step 3) Compute parity at each ABSA for Pauli frame corrections
+    # (Protocol Step 4) Combining all the parities from all ABSAs and correct at end nodes
+    combined_left_parity, combined_right_parity = False, False
+    for hop_index in range(conf.number_of_hops):
+        lp, rp = helper_compute_parity_for_end_nodes(conf, hop_index)
+        combined_left_parity ^= lp
+        combined_right_parity ^= rp
+    conf.end_node_parities = (combined_left_parity, combined_right_parity)
+
+    if combined_left_parity:
+        conf.t.z(conf.alice)
+    if combined_right_parity:
+        conf.t.z(conf.bob)
+
+    if readout is not None:
+        exp_xz, exp_zx, _ = readout.record(conf.t)
+    else:
+        exp_xz, exp_zx, _ = peek_bell_correlators(conf.t, conf.alice, conf.bob)
+
+    if exp_xz == exp_zx == 1:
+        conf.correct_bell_pair_count += 1
+        return True, True
+    elif exp_zx * exp_xz != 0:
+        conf.incorrect_bell_pair_count += 1
+        return True, False
+
+    conf.other_error_count += 1
+    return True, False
+
+
+def rgs_trial_experiment_run(
+    shots: int,
+    number_of_hops: int,
+    m: int,
+    bv: list[int],
+    photon_loss_probability: float,
+    channel_depolarizing_error_probability: float = 0,
+    decoder: ModuleType = tree_code_helper,
+    seed: int | None = None,
+    readout: BellStateReadout | None = None,
+    recorder: TrialRecorder | None = None,
+    policy: ArmSelectionPolicy = ArmSelectionPolicy.FIRST_SUCCESS,
+    emission_schedule: EmissionSchedule | None = None,
+    noise_model: NoiseModel | None = None,
+    streaming: bool = False,
+    control_variates: ControlVariateEstimate | None = None,
+    prescreen: bool = False,
+    presample_all_hops: bool = False,
+    show_progress_mark=False,
+    show_output=True,
+) -> tuple[int, int]:
+    """Run `shots` trials of the RGS protocol, accumulating the Bell pair quality into `readout` if given
+    and streaming one record per trial into `recorder` if given
+    (each trial is then seeded on its own, so it can be re-run from its record)
+    The inner qubits are generated by `emission_schedule` if given, see `emission_schedule.compile_emission_schedule`.
+    The emitters and detectors are noisy according to `noise_model` if given.
+    With `streaming`, the inner qubits are decoded while they are generated and no measurement tree is kept,
+    so the memory does not grow with the size of the trees (first-success policy and recursive generation only).
+    The component indicators of every trial are recorded into `control_variates` if given (all hops are then presampled).
+    With `prescreen`, the trials failing on the classically presampled losses and BSM outcomes are never simulated with stim.
+    With `presample_all_hops`, the losses and BSM outcomes of all hops are presampled and each trial is seeded on its own,
+    so the runs with the same seed see the same losses and BSM outcomes trial by trial, whatever the policy.
+    Returns: (number of successful trials, number of successful trials with the correct Bell state)"""
+    if prescreen and decoder.__name__ not in PRESCREEN_DECODERS:
+        raise ValueError(f"the pre-screening cannot predict the decoding of {decoder.__name__}, use one of {PRESCREEN_DECODERS}")
+    num_ticks = 10
+    progress_marks = [int(i * shots / num_ticks) for i in range(1, num_ticks)]
+    progress_marks.append(shots)
+
+    rng = np.random.default_rng(seed)
+    tab_sim = stim.TableauSimulator(seed=int(rng.integers(2**63)))
+    conf = RgsConfig(
+        number_of_hops,
+        m,
+        bv,
+        photon_loss_probability,
+        channel_depolarizing_error_probability,
+        tab_sim,
+        rng,
+        num_emitters=emission_schedule.num_emitters if emission_schedule is not None else None,
+        noise_model=noise_model,
+        streaming=streaming,
+    )
+    conf.emission_schedule = emission_schedule
+    actual_run_count = 0
+
+    if show_output:
+        print(
+            f"start RGS protocol trials for {number_of_hops} hops "
+            f"with photon loss probability between RGSS and ABSA {photon_loss_probability}."
+        )
+        print(f"      RGS parameters are given by m = {m} and branching parameters {bv}.")
+        print("============================")
+
+    success_count = 0
+    no_error_count = 0
+
+    while actual_run_count < shots:
+        if recorder is not None or presample_all_hops:
+            trial_seed = int(rng.integers(2**63))
+            conf.rng = np.random.default_rng(trial_seed)
+            conf.t = stim.TableauSimulator(seed=trial_seed)
+        is_presampled = presample_all_hops or control_variates is not None
+        is_successful, is_correct = rgs_protocol_trial(conf, decoder, readout, policy, is_presampled, prescreen)
+        if control_variates is not None:
+            control_variates.record_trial(conf, is_successful, is_correct)
+        if recorder is not None:
+            recorder.record_trial(trial_seed, conf, is_successful, is_correct)
+        success_count += is_successful
+        if is_successful:
+            no_error_count += is_correct  # type: ignore
+        actual_run_count += 1
+        # progress print
+        if show_output and show_progress_mark and actual_run_count in progress_marks:
+            print(f"    has been running for {actual_run_count} trials with {success_count} successful distribution(s).")
+
+    if recorder is not None:
+        recorder.flush()
+
+    if show_output:
+        print(f"RGS protocol trials with params ({number_of_hops}, {m}, {bv}, {photon_loss_probability})")
+        # the theoretical model with the effective loss (including the detector efficiency of the noise model)
+        theoretical = prob_rgs_trial(m, bv, 1 - conf.loss_probability, number_of_hops)
+        print(
+            f"        theoretical prob ({theoretical:03f}) "
+            f"succeeded with {success_count / actual_run_count}({success_count}/{actual_run_count})"
+        )
+        if success_count > 0:
+            error_count = success_count - no_error_count
+            print(f"        error probability: {error_count / success_count} ({error_count}/{success_count})")
+        print(f"    no_error:    {conf.correct_bell_pair_count}")
+        print(f"    wrong state: {conf.incorrect_bell_pair_count}")
+        print(f"    other state: {conf.other_error_count}")
+        if readout is not None:
+            print(f"    {readout.summary()}")
+        if control_variates is not None:
+            print(f"    {control_variates.summary()}")
+    return success_count, no_error_count
+
+
+def compare_arm_selection_policies(
+    shots: int,
+    number_of_hops: int,
+    m: int,
+    bv: list[int],
+    photon_loss_probability: float,
+    channel_depolarizing_error_probability: float = 0,
+    decoder: ModuleType = tree_code_helper,
+    seed: int | None = None,
+    policies: list[ArmSelectionPolicy] | None = None,
+    show_output=True,
+) -> dict[ArmSelectionPolicy, tuple[int, int]]:
+    """Run the same number of trials with each ABSA arm selection policy; all the policies run with the same seed and all
+    hops presampled, so the trials are paired: every policy sees the same losses and BSM outcomes
+    Returns: {policy: (number of successful trials, number of successful trials with the correct Bell state)}"""
+    if policies is None:
+        policies = list(ArmSelectionPolicy)
+    results = {}
+    for policy in policies:
+        results[policy] = rgs_trial_experiment_run(
+            shots,
+            number_of_hops,
+            m,
+            bv,
+            photon_loss_probability,
+            channel_depolarizing_error_probability,
+            decoder=decoder,
+            seed=seed,
+            policy=policy,
+            presample_all_hops=True,
+            show_output=False,
+        )
+
+    if show_output:
+        print(
+            "ABSA arm selection policies for "
+            f"({number_of_hops}, {m}, {bv}, {photon_loss_probability}, {channel_depolarizing_error_probability})"
+        )
+        baseline = results.get(ArmSelectionPolicy.FIRST_SUCCESS, (None, None))[0]
+        for policy, (success_count, no_error_count) in results.items():
+            line = f"    {policy.name:<20} success {success_count / shots:.6f} ({success_count}/{shots})"
+            if success_count > 0:
+                line += f", error {(success_count - no_error_count) / success_count:.6f}"
+            if baseline:
+                line += f", rate gain {success_count / baseline:.4f}x"
+            print(line)
+    return results
@@ -0,0 +1,231 @@
+#! /usr/bin/python3
+
+"""Headless parameter sweep runner.
+
+Reads a sweep spec (TOML or JSON) and runs every point of the cartesian product of the swept parameters, e.g.
+
+    shots = 100000
+    engine = "sequential"              # or "hop_parallel"
+    decoder = "tree_code_helper"       # or "majority_vote_tree_code_helper"
+    prescreen = false                  # classical pre-screening of the trials (sequential engine)
+    output = "results.jsonl"
+
+    [sweep]
+    number_of_hops = [1, 5]
+    m = [1, 4]
+    bv = [[1], [4, 2]]
+    loss_probability = [0, 0.1]
+    depolarizing_error_probability = [0]
+
+Progress is printed to stdout and one JSON line per point is appended to the output file.
+With the hop_parallel engine, one `HopOutcomeCache` and one pool of `num_processes` workers serve the whole sweep, so the
+hop samples are reused across the points that only differ in `number_of_hops`.
+`stim` and NumPy are only imported once a simulation actually starts so that `--help` and `--dry-run` return immediately.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+SWEEP_PARAMETERS = ["number_of_hops", "m", "bv", "loss_probability", "depolarizing_error_probability"]
+ENGINES = ["sequential", "hop_parallel"]
+DECODERS = ["tree_code_helper", "majority_vote_tree_code_helper", "lookup_tree_code_helper"]
+
+DEFAULT_SPEC = {
+    "shots": 1000,
+    "batch_shots": 1000,
+    "engine": "sequential",
+    "decoder": "tree_code_helper",
+    "num_processes": 1,
+    "prescreen": False,
+    "seed": None,
+    "output": None,
+    "trial_log_directory": None,
+    "sweep": {"depolarizing_error_probability": [0]},
+}
+
+
+def load_spec(path: str) -> dict:
+    """read a TOML or JSON sweep spec and fill in the defaults"""
+    if path.endswith(".toml"):
+        import tomllib
+
+        with open(path, "rb") as f:
+            spec = tomllib.load(f)
+    else:
+        with open(path) as f:
+            spec = json.load(f)
+
+    spec = {**DEFAULT_SPEC, **spec, "sweep": {**DEFAULT_SPEC["sweep"], **spec.get("sweep", {})}}
+    missing = [name for name in SWEEP_PARAMETERS if name not in spec["sweep"]]
+    if len(missing) > 0:
+        raise ValueError(f"sweep spec is missing the parameter(s) {missing}")
+    if spec["engine"] not in ENGINES:
+        raise ValueError(f'engine "{spec["engine"]}" is not one of {ENGINES}')
+    if spec["decoder"] not in DECODERS:
+        raise ValueError(f'decoder "{spec["decoder"]}" is not one of {DECODERS}')
+    if spec["engine"] == "hop_parallel":
+        # the hops are simulated independently of the trials, there is neither a trial to pre-screen nor to record
+        unsupported = [name for name in ["prescreen", "trial_log_directory"] if spec[name] not in (False, None)]
+        if len(unsupported) > 0:
+            raise ValueError(f"{unsupported} are not supported by the hop_parallel engine")
+    return spec
+
+
+def sweep_points(spec: dict) -> list[dict]:
+    values = [spec["sweep"][name] for name in SWEEP_PARAMETERS]
+    # a scalar means the parameter is not swept
+    values = [
+        v if isinstance(v, list) and (name != "bv" or isinstance(v[0], list)) else [v]
+        for name, v in zip(SWEEP_PARAMETERS, values)
+    ]
+    return [dict(zip(SWEEP_PARAMETERS, point)) for point in itertools.product(*values)]
+
+
+def run_point(spec: dict, point: dict, point_index: int, seed_sequence, log=print, cache=None) -> dict:
+    """run all shots of one sweep point in batches, logging the progress after each batch
+    `cache` is the `HopOutcomeCache` of the sweep for the hop_parallel engine (a new one for this point if None)"""
+    import importlib
+
+    from rgs_theoretical_model import prob_rgs_trial
+
+    decoder = importlib.import_module(spec["decoder"])
+    shots = spec["shots"]
+    batch_shots = spec["batch_shots"]
+
+    recorder = None
+    if spec["trial_log_directory"] is not None:
+        from trial_recorder import TrialRecorder
+
+        directory = os.path.join(spec["trial_log_directory"], f"point-{point_index:04d}")
+        recorder = TrialRecorder(directory, point["number_of_hops"], point["m"], metadata=point)
+
+    if spec["engine"] == "hop_parallel" and cache is None:
+        from hop_parallel import HopOutcomeCache
+
+        cache = HopOutcomeCache(spec["num_processes"], int(seed_sequence.generate_state(1, dtype="uint64")[0]))
+
+    start = time.perf_counter()
+    success_count = 0
+    no_error_count = 0
+    done = 0
+    while done < shots:
+        batch = min(batch_shots, shots - done)
+        batch_seed = int(seed_sequence.generate_state(1, dtype="uint64")[0])
+        seed_sequence = seed_sequence.spawn(1)[0]
+        if spec["engine"] == "sequential":
+            from rgs_engine import rgs_trial_experiment_run
+
+            result = rgs_trial_experiment_run(
+                batch,
+                point["number_of_hops"],
+                point["m"],
+                point["bv"],
+                point["loss_probability"],
+                point["depolarizing_error_probability"],
+                decoder=decoder,
+                seed=batch_seed,
+                recorder=recorder,
+                prescreen=spec["prescreen"],
+                show_output=False,
+            )
+        else:
+            from hop_parallel import hop_parallel_experiment_run
+
+            result = hop_parallel_experiment_run(
+                batch,
+                point["number_of_hops"],
+                point["m"],
+                point["bv"],
+                point["loss_probability"],
+                point["depolarizing_error_probability"],
+                decoder=decoder,
+                num_processes=spec["num_processes"],
+                cache=cache,
+                seed=batch_seed,
+                sample_offset=done * point["number_of_hops"],
+                show_output=False,
+            )
+        success_count += result[0]
+        no_error_count += result[1]
+        done += batch
+        log(f"    [{point_index}] {done}/{shots} shots, {success_count} successful, {success_count - no_error_count} with errors")
+
+    if recorder is not None:
+        recorder.close()
+
+    return {
+        **point,
+        "engine": spec["engine"],
+        "decoder": spec["decoder"],
+        "shots": shots,
+        "success_count": success_count,
+        "no_error_count": no_error_count,
+        "success_probability": success_count / shots,
+        "error_probability": (success_count - no_error_count) / success_count if success_count > 0 else None,
+        "theoretical_success_probability": prob_rgs_trial(
+            point["m"], point["bv"], 1 - point["loss_probability"], point["number_of_hops"]
+        ),
+        "elapsed_seconds": time.perf_counter() - start,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="rgs-sweep", description="Run an RGS protocol parameter sweep described by a TOML/JSON spec."
+    )
+    parser.add_argument("spec", help="path to the sweep spec (.toml or .json)")
+    parser.add_argument("-o", "--output", help="JSON lines file the results are appended to (overrides the spec)")
+    parser.add_argument("--shots", type=int, help="number of shots per point (overrides the spec)")
+    parser.add_argument("--num-processes", type=int, help="worker processes for the hop-parallel engine (overrides the spec)")
+    parser.add_argument("--seed", type=int, help="seed of the sweep (overrides the spec)")
+    parser.add_argument("--dry-run", action="store_true", help="only list the sweep points")
+    args = parser.parse_args(argv)
+
+    spec = load_spec(args.spec)
+    for name in ["output", "shots", "num_processes", "seed"]:
+        if getattr(args, name) is not None:
+            spec[name] = getattr(args, name)
+    points = sweep_points(spec)
+
+    print(f"sweep {args.spec}: {len(points)} point(s) x {spec['shots']} shots with the {spec['engine']} engine", flush=True)
+    if args.dry_run:
+        for i, point in enumerate(points):
+            print(f"    [{i}] {json.dumps(point)}")
+        return 0
+
+    import numpy as np
+
+    seed_sequence = np.random.SeedSequence(spec["seed"])
+    seed_sequences = seed_sequence.spawn(len(points))
+    cache, pool = None, None
+    if spec["engine"] == "hop_parallel":
+        import multiprocessing as mp
+
+        from hop_parallel import HopOutcomeCache
+
+        pool = mp.Pool(processes=spec["num_processes"]) if spec["num_processes"] > 1 else None
+        cache = HopOutcomeCache(spec["num_processes"], int(seed_sequence.generate_state(1, dtype="uint64")[0]), pool)
+    output = open(spec["output"], "a") if spec["output"] is not None else None
+    try:
+        for i, point in enumerate(points):
+            print(f"[{i}] start {json.dumps(point)}", flush=True)
+            result = run_point(spec, point, i, seed_sequences[i], log=lambda line: print(line, flush=True), cache=cache)
+            print(f"[{i}] done {json.dumps(result)}", flush=True)
+            if output is not None:
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+    finally:
+        if output is not None:
+            output.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#! usr/bin/python3
+
+"""Streaming (incremental) decoding of the tree code.
+
+The photons of an inner qubit are emitted in postorder, so the children of a node are complete before the node itself.
+Instead of storing the whole measurement tree and decoding it afterwards, every photon record (level, is_lost, eigenvalue)
+is folded into the summary of its parent right away:
+    z   the (direct or indirect) Z result of the node, None if it cannot be determined
+    x   the X result of the node times the Z results of its children, None if the node is lost or a child Z is missing
+A node only needs the summaries of its children, so one accumulator per level is kept (O(depth) memory per inner qubit)
+and it is reset as soon as its node is folded into the next level up.
+The decisions are the same as `tree_code_helper` (and `lookup_tree_code_helper`), or `majority_vote_tree_code_helper`
+with `majority_vote`. The eigenvalues must include the side effects known at emission; the side effects of the first level
+known later (outer emitter, entanglement swapping, BSM) flip every first-level X result,
+so they are XORed into the logical X result.
+"""
+
+import numpy as np
+
+# decoder modules with a streaming counterpart: name -> whether the decoder is the majority vote one
+STREAMING_DECODERS = {
+    "tree_code_helper": False,
+    "lookup_tree_code_helper": False,
+    "majority_vote_tree_code_helper": True,
+}
+
+
+def helper_majority(minus_count: int, plus_count: int) -> bool:
+    """majority of the results (True is the -1 eigenvalue), a tie is broken at random as in `majority_vote_tree_code_helper`"""
+    if minus_count == plus_count:
+        return bool(np.random.choice([True, False]))
+    return minus_count > plus_count
+
+
+class StreamingTreeDecoder:
+    """Fold the postorder photon records of one inner qubit (levels counted from 0 for the first level of the tree)"""
+
+    def __init__(self, depth: int, majority_vote: bool = False):
+        self.depth = depth
+        self.majority_vote = majority_vote
+        # accumulators of the children of the node currently open at the level above, index 0 is for the root
+        self.z_parity = [False] * depth
+        self.z_known = [True] * depth
+        self.first_x: list[bool | None] = [None] * depth
+        self.x_minus = [0] * depth
+        self.x_plus = [0] * depth
+
+    def __pop_children(self, level: int) -> tuple[bool, bool, bool | None, int, int]:
+        """summary of the children of a node at `level`, the accumulator is reset for the next node"""
+        if level == self.depth - 1:
+            return False, True, None, 0, 0
+        i = level + 1
+        children = (self.z_parity[i], self.z_known[i], self.first_x[i], self.x_minus[i], self.x_plus[i])
+        self.z_parity[i], self.z_known[i], self.first_x[i], self.x_minus[i], self.x_plus[i] = False, True, None, 0, 0
+        return children
+
+    def consume(self, level: int, is_lost: bool, eigenvalue: bool | None):
+        z_parity, z_known, first_x, x_minus, x_plus = self.__pop_children(level)
+        x = None if is_lost or not z_known else eigenvalue ^ z_parity  # type: ignore
+        if self.majority_vote and x_minus + x_plus > 0:
+            if x_minus == x_plus and not is_lost:
+                z = eigenvalue
+            else:
+                z = helper_majority(x_minus, x_plus)
+        elif self.majority_vote:
+            z = None if is_lost else eigenvalue
+        else:
+            z = first_x if is_lost else eigenvalue
+
+        if z is None:
+            self.z_known[level] = False
+        else:
+            self.z_parity[level] ^= z
+        if x is not None:
+            if self.first_x[level] is None:
+                self.first_x[level] = x
+            if x:
+                self.x_minus[level] += 1
+            else:
+                self.x_plus[level] += 1
+
+    def logical_z(self) -> bool | None:
+        return self.z_parity[0] if self.z_known[0] else None
+
+    def logical_x(self) -> bool | None:
+        if self.majority_vote:
+            return helper_majority(self.x_minus[0], self.x_plus[0]) if self.x_minus[0] + self.x_plus[0] > 0 else None
+        return self.first_x[0]
@@ -0,0 +1,239 @@
+#! usr/bin/python3
+
+"""Discrete-event timing simulation of the RGS protocol over a repeater chain.
+
+The per-trial success probability does not tell how many Bell pairs per second a chain delivers.
+Here every trial (one generation cycle of all the source nodes) is timed:
+    - a source node emits its photons one after the other, so an RGS (2m arms) takes
+      2m * num_qubits_per_rgs_arm(bv) * emission_time to generate (m arms for the half-RGS at the end nodes),
+      and a new cycle starts every max(generation time, 1 / repetition rate);
+    - the ABSA of a hop knows its outcome once the last photons of both neighbouring nodes have flown half the hop distance;
+    - each ABSA sends its outcome to Alice and Bob; an end node learns that a trial failed from the first failed hop
+      reaching it and that it succeeded once every hop has been heard from;
+    - Alice and Bob keep one memory per trial in flight, so with `end_node_memories` memories a new cycle waits for a
+      memory to be released, which makes long chains latency bound.
+The hop outcomes are drawn from simulated samples (`HopOutcomeCache`) or from the theoretical model.
+The geometry is fixed, so the message arrival times of a trial are computed at once and only the end-node events go
+through the event queue, which keeps chains of hundreds of hops fast.
+"""
+
+import heapq
+
+import numpy as np
+
+from emission_schedule import EmissionSchedule
+from hop_parallel import HOP_OUTCOME_DTYPE
+from node_qubit import num_qubits_per_rgs_arm
+from rgs_theoretical_model import prob_rgs_trial
+
+# speed of light in optical fiber (refractive index ~1.5)
+SPEED_OF_LIGHT_IN_FIBER_KM_PER_S = 2e5
+
+CYCLE = 0
+RELEASE_ALICE = 1
+RELEASE_BOB = 2
+DELIVERY = 3
+
+
+class ModelHopSampler:
+    """Hop outcomes drawn from the theoretical success probability of a hop (loss only, always the correct Bell pair)"""
+
+    def __init__(self, m: int, bv: list[int], photon_loss_probability: float):
+        self.success_probability = prob_rgs_trial(m, bv, 1 - photon_loss_probability, 1)
+
+    def sample(self, rng: np.random.Generator, trials: int, number_of_hops: int) -> np.ndarray:
+        outcomes = np.zeros((trials, number_of_hops), dtype=HOP_OUTCOME_DTYPE)
+        outcomes["success"] = rng.random((trials, number_of_hops)) < self.success_probability
+        outcomes["exp_xz"] = outcomes["exp_zx"] = np.where(outcomes["success"], 1, 0)
+        return outcomes
+
+
+class CachedHopSampler:
+    """Hop outcomes resampled from simulated single-hop samples, e.g., `HopOutcomeCache.get(...)`"""
+
+    def __init__(self, hop_outcomes: np.ndarray):
+        if len(hop_outcomes) == 0:
+            raise ValueError("no hop outcomes to sample from")
+        self.hop_outcomes = hop_outcomes
+
+    def sample(self, rng: np.random.Generator, trials: int, number_of_hops: int) -> np.ndarray:
+        return self.hop_outcomes[rng.integers(len(self.hop_outcomes), size=(trials, number_of_hops))]
+
+
+class ChainTiming:
+    """Timing parameters of a repeater chain (times in seconds, distances in km)
+    `hop_distances_km` is the distance between neighbouring nodes, either one value for all hops or one per hop
+    with an `emission_schedule`, an arm takes one `emission_time` per time step of the schedule instead of one per photon"""
+
+    def __init__(
+        self,
+        number_of_hops: int,
+        m: int,
+        bv: list[int],
+        hop_distances_km: float | list[float],
+        emission_time: float,
+        repetition_rate: float | None = None,
+        bsm_time: float = 0,
+        classical_processing_time: float = 0,
+        end_node_memories: int = 1,
+        speed_in_fiber_km_per_s: float = SPEED_OF_LIGHT_IN_FIBER_KM_PER_S,
+        emission_schedule: EmissionSchedule | None = None,
+    ):
+        if isinstance(hop_distances_km, list):
+            if len(hop_distances_km) != number_of_hops:
+                raise ValueError(f"{len(hop_distances_km)} hop distances given for {number_of_hops} hops")
+            distances = np.array(hop_distances_km, dtype=float)
+        else:
+            distances = np.full(number_of_hops, hop_distances_km, dtype=float)
+        if end_node_memories < 1:
+            raise ValueError("the end nodes need at least one memory")
+        self.number_of_hops = number_of_hops
+        self.end_node_memories = end_node_memories
+        self.classical_processing_time = classical_processing_time
+
+        # generation time of each node along the chain; half-RGSs at the two end nodes
+        if emission_schedule is not None:
+            # one time step per operation of the schedule and one for the outer photon
+            arm_generation_time = (emission_schedule.num_time_steps + 1) * emission_time
+        else:
+            arm_generation_time = num_qubits_per_rgs_arm(bv) * emission_time
+        generation_times = np.full(number_of_hops + 1, 2 * m * arm_generation_time)
+        generation_times[0] = generation_times[-1] = m * arm_generation_time
+        self.period = max(generation_times.max(), 1 / repetition_rate if repetition_rate else 0)
+
+        # time from the start of a cycle to the outcome of each ABSA and to its arrival at Alice and Bob
+        node_positions = np.concatenate([[0], np.cumsum(distances)])
+        absa_positions = node_positions[:-1] + distances / 2
+        absa_times = np.maximum(generation_times[:-1], generation_times[1:]) + distances / 2 / speed_in_fiber_km_per_s + bsm_time
+        self.to_alice = absa_times + absa_positions / speed_in_fiber_km_per_s
+        self.to_bob = absa_times + (node_positions[-1] - absa_positions) / speed_in_fiber_km_per_s
+
+
+class ChainTimingResult:
+    """Delivered Bell pairs of a timing simulation"""
+
+    def __init__(
+        self,
+        duration: float,
+        trials: int,
+        delivery_times: np.ndarray,
+        latencies: np.ndarray,
+        correct: np.ndarray,
+        blocked_time: float,
+    ):
+        self.duration = duration
+        self.trials = trials  # number of generation cycles started
+        self.delivery_times = delivery_times
+        self.latencies = latencies  # from the start of the cycle to the delivery at both end nodes
+        self.correct = correct
+        self.blocked_time = blocked_time  # time the sources waited for a free memory at the end nodes
+
+    def throughput(self) -> float:
+        """delivered Bell pairs per second"""
+        return len(self.delivery_times) / self.duration
+
+    def correct_throughput(self) -> float:
+        """delivered Bell pairs in the correct state per second"""
+        return int(np.sum(self.correct)) / self.duration
+
+    def inter_delivery_times(self) -> np.ndarray:
+        return np.diff(self.delivery_times)
+
+    def latency_percentiles(self, percentiles: list[float] | None = None) -> dict[float, float]:
+        """latency of the given percentiles (50, 90 and 99 if None)"""
+        if percentiles is None:
+            percentiles = [50, 90, 99]
+        if len(self.latencies) == 0:
+            return {p: np.nan for p in percentiles}
+        return dict(zip(percentiles, np.percentile(self.latencies, percentiles)))
+
+    def summary(self) -> str:
+        percentiles = ", ".join(f"p{p:g} {latency * 1e3:.4g} ms" for p, latency in self.latency_percentiles().items())
+        waits = self.inter_delivery_times()
+        mean_wait = f"{waits.mean() * 1e3:.4g} ms" if len(waits) > 0 else "n/a"
+        return (
+            f"{len(self.delivery_times)} Bell pairs in {self.duration:g} s from {self.trials} cycles: "
+            f"{self.throughput():.6g} pairs/s ({self.correct_throughput():.6g} correct pairs/s); "
+            f"latency {percentiles}; mean time between pairs {mean_wait}; "
+            f"sources blocked {self.blocked_time / self.duration:.2%} of the time"
+        )
+
+
+def simulate_chain_timing(
+    timing: ChainTiming, hop_sampler, duration: float, seed: int | None = None, batch_trials: int = 4096
+) -> ChainTimingResult:
+    """Run the discrete-event simulation for `duration` seconds of simulated time.
+    `hop_sampler` provides the hop outcomes, see `ModelHopSampler` and `CachedHopSampler`."""
+    rng = np.random.default_rng(seed)
+    hops = timing.number_of_hops
+    alice_all, bob_all = timing.to_alice.max(), timing.to_bob.max()
+
+    def __next_batch():
+        # per trial: success, correctness and the release times (relative to the start of the cycle) at both end nodes
+        outcomes = hop_sampler.sample(rng, batch_trials, hops)
+        success = np.all(outcomes["success"], axis=1)
+        correct = success & (np.prod(outcomes["exp_xz"], axis=1) == 1) & (np.prod(outcomes["exp_zx"], axis=1) == 1)
+        alice_release = np.where(success, alice_all, np.where(outcomes["success"], np.inf, timing.to_alice).min(axis=1))
+        bob_release = np.where(success, bob_all, np.where(outcomes["success"], np.inf, timing.to_bob).min(axis=1))
+        return list(zip(success.tolist(), correct.tolist(), alice_release.tolist(), bob_release.tolist()))
+
+    batch = []
+    events = [(0.0, 0, CYCLE, 0.0, False)]
+    sequence = 1
+    free_alice = free_bob = timing.end_node_memories
+    next_cycle_time = 0.0
+    blocked_since = None
+    blocked_time = 0.0
+    trials = 0
+    delivery_times = []
+    latencies = []
+    correct_flags = []
+
+    while len(events) > 0:
+        time, _, kind, start, is_correct = heapq.heappop(events)
+        if time > duration:
+            break
+
+        if kind == CYCLE:
+            if free_alice == 0 or free_bob == 0:
+                blocked_since = time
+                continue
+            if len(batch) == 0:
+                batch = __next_batch()
+                batch.reverse()
+            success, correct, alice_release, bob_release = batch.pop()
+            trials += 1
+            free_alice -= 1
+            free_bob -= 1
+            processing = timing.classical_processing_time
+            heapq.heappush(events, (time + alice_release + processing, sequence, RELEASE_ALICE, time, False))
+            heapq.heappush(events, (time + bob_release + processing, sequence + 1, RELEASE_BOB, time, False))
+            if success:
+                delivery_time = time + max(alice_release, bob_release) + processing
+                heapq.heappush(events, (delivery_time, sequence + 2, DELIVERY, time, correct))
+            next_cycle_time = time + timing.period
+            heapq.heappush(events, (next_cycle_time, sequence + 3, CYCLE, 0.0, False))
+            sequence += 4
+            continue
+
+        if kind == DELIVERY:
+            delivery_times.append(time)
+            latencies.append(time - start)
+            correct_flags.append(is_correct)
+            continue
+
+        if kind == RELEASE_ALICE:
+            free_alice += 1
+        else:
+            free_bob += 1
+        if blocked_since is not None and free_alice > 0 and free_bob > 0:
+            blocked_time += time - blocked_since
+            blocked_since = None
+            heapq.heappush(events, (max(time, next_cycle_time), sequence, CYCLE, 0.0, False))
+            sequence += 1
+
+    if blocked_since is not None:
+        blocked_time += duration - blocked_since
+    return ChainTimingResult(
+        duration, trials, np.array(delivery_times), np.array(latencies), np.array(correct_flags, dtype=bool), blocked_time
+    )
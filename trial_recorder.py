@@ -0,0 +1,136 @@
+#! usr/bin/python3
+
+"""Columnar per-trial result log.
+
+Every trial is stored as a fixed-width record, one raw binary file per column in a directory:
+    seed            uint64                  seed of the trial, re-running with it reproduces the trial
+    bsm_arm_index   int16  (hops,)          arm with the successful BSM at each ABSA, -1 if none (or the hop was not reached)
+    lost_photons    int32  (hops,)          number of lost photons in each hop
+    logical_results int8   (2 * hops, m)    decoded logical result of each arm, -1 if undecodable or not decoded
+    final_parity    bool   (2,)             parities applied at Alice and Bob
+    correctness     int8                    1 correct Bell pair, 0 wrong Bell pair, -1 failed at a BSM, -2 failed at decoding
+Records are buffered in fixed-size chunks and appended to the column files when a chunk is full,
+so the memory used by the recorder is bounded by the chunk size regardless of the number of shots.
+`TrialLogReader` memory-maps the column files for analysis with NumPy.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from rgs_config import RgsConfig
+
+CORRECT = 1
+INCORRECT = 0
+FAILED_BSM = -1
+FAILED_DECODING = -2
+
+
+def trial_log_columns(number_of_hops: int, m: int) -> dict[str, tuple[np.dtype, tuple[int, ...]]]:
+    return {
+        "seed": (np.dtype(np.uint64), ()),
+        "bsm_arm_index": (np.dtype(np.int16), (number_of_hops,)),
+        "lost_photons": (np.dtype(np.int32), (number_of_hops,)),
+        "logical_results": (np.dtype(np.int8), (2 * number_of_hops, m)),
+        "final_parity": (np.dtype(np.bool_), (2,)),
+        "correctness": (np.dtype(np.int8), ()),
+    }
+
+
+class TrialRecorder:
+    """Stream fixed-width trial records into a columnar log directory (see module docstring for the columns)"""
+
+    def __init__(self, directory: str, number_of_hops: int, m: int, chunk_size: int = 1 << 16, metadata: dict | None = None):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.columns = trial_log_columns(number_of_hops, m)
+        self.metadata = {"number_of_hops": number_of_hops, "m": m, **(metadata or {})}
+        self.rows = 0  # rows already written to the files
+        self.buffered = 0  # rows in the buffers
+        self.buffers = {name: np.empty((chunk_size, *shape), dtype=dtype) for name, (dtype, shape) in self.columns.items()}
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, "meta.json")):
+            raise FileExistsError(f"a trial log already exists in {directory}")
+        for name in self.columns:
+            open(self.__column_path(name), "wb").close()
+        self.__write_meta()
+
+    def __column_path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.bin")
+
+    def __write_meta(self):
+        meta = {
+            "rows": self.rows,
+            "columns": {name: {"dtype": dtype.str, "shape": list(shape)} for name, (dtype, shape) in self.columns.items()},
+            "metadata": self.metadata,
+        }
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def record(self, **values):
+        """append one record; every column must be given"""
+        for name, buffer in self.buffers.items():
+            buffer[self.buffered] = values[name]
+        self.buffered += 1
+        if self.buffered == self.chunk_size:
+            self.flush()
+
+    def record_trial(self, seed: int, conf: RgsConfig, is_successful: bool, is_correct: bool | None):
+        """append the record of the trial that was just run with `conf`"""
+        if is_successful:
+            correctness = CORRECT if is_correct else INCORRECT
+        elif any(arm == -1 for arm in conf.succeeded_bsm_arm_indices):
+            correctness = FAILED_BSM
+        else:
+            correctness = FAILED_DECODING
+        self.record(
+            seed=seed,
+            bsm_arm_index=conf.succeeded_bsm_arm_indices,
+            lost_photons=conf.lost_photons_per_hop,
+            logical_results=[[-1 if result is None else result for result in arms] for arms in conf.logical_results],
+            final_parity=conf.end_node_parities,
+            correctness=correctness,
+        )
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        for name, buffer in self.buffers.items():
+            with open(self.__column_path(name), "ab") as f:
+                f.write(buffer[: self.buffered].tobytes())
+        self.rows += self.buffered
+        self.buffered = 0
+        self.__write_meta()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrialLogReader:
+    """Memory-mapped read access to a trial log written by `TrialRecorder`"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.rows: int = meta["rows"]
+        self.metadata: dict = meta["metadata"]
+        self.columns = {name: (np.dtype(column["dtype"]), tuple(column["shape"])) for name, column in meta["columns"].items()}
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """read-only memory map of a column with shape (rows, *column shape)"""
+        dtype, shape = self.columns[name]
+        if self.rows == 0:
+            return np.empty((0, *shape), dtype=dtype)
+        return np.memmap(os.path.join(self.directory, f"{name}.bin"), dtype=dtype, mode="r", shape=(self.rows, *shape))